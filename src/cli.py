@@ -2,19 +2,193 @@
 ImageX - Regex for images
 https://github.com/Giantpizzahead/imagex
 Copyright (C) 2022 Giantpizzahead
+
+Command line interface. Finds templates in images and prints one JSON line per image, as soon as
+each image has been searched:
+
+    {"image": "shots/0001.png", "matches": [{"template": "icon.png", "box": [x, y, w, h]}]}
+
+The box is null if the template wasn't found. Images that can't be searched get an "error" field
+instead of matches. Templates are compiled once, and images are searched by a pool of workers that
+lives for the whole batch, so large batches only pay the startup cost once.
+
+Examples:
+    python src/cli.py image.png template.png
+    python src/cli.py "shots/**/*.png" -t icons/ --workers 8 > results.jsonl
+    find shots -name "*.png" | python src/cli.py - -t icon.png --executor process
+
+The serve command instead starts a match server (see imagex.server), which keeps the templates
+compiled between searches:
+
+    python src/cli.py serve -t icons/ --socket /tmp/imagex.sock
 """
 import argparse
+import glob
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Iterable, Iterator, TextIO
+
+import imagex
+
+# File extensions of the images found in directories
+IMAGE_EXTENSIONS = {".bmp", ".jpeg", ".jpg", ".npy", ".png", ".tif", ".tiff", ".webp"}
+# Input that stands for the manifest read from stdin
+STDIN = "-"
+
+
+def expand(pattern: str) -> Iterator[str]:
+    """Yields the image files of a path, directory (searched recursively) or glob pattern."""
+    if glob.has_magic(pattern):
+        paths = glob.iglob(pattern, recursive=True)
+    else:
+        paths = [pattern]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if Path(name).suffix.lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def read_manifest(lines: TextIO) -> Iterator[str]:
+    """
+    Yields the image paths of a manifest.
+
+    Each line is either a path, or a JSON object with the path in its "image" field. Blank lines
+    are skipped.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        yield json.loads(line)["image"] if line.startswith("{") else line
+
+
+def images(inputs: Iterable[str]) -> Iterator[str]:
+    """Yields the image paths of every input, lazily."""
+    for pattern in inputs:
+        if pattern == STDIN:
+            yield from read_manifest(sys.stdin)
+        else:
+            yield from expand(pattern)
+
+
+def serve(argv: list) -> None:
+    """Runs a match server until interrupted."""
+    parser = argparse.ArgumentParser(prog="imagex serve",
+                                     description="Serves searches for templates kept in memory")
+    parser.add_argument("-t", "--template", action="append", dest="templates", default=[],
+                        help="A template file, directory or glob pattern, named after its file "
+                             "(without the extension). Can be repeated.")
+    parser.add_argument("--host", default=imagex.server.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=imagex.server.DEFAULT_PORT)
+    parser.add_argument("--socket", metavar="PATH",
+                        help="Listen on a Unix socket instead of a port")
+    parser.add_argument("--scales", type=float, nargs=2, metavar=("MIN", "MAX"),
+                        default=imagex.pyramid.DEFAULT_SCALE_RANGE,
+                        help="Range of template scales to search")
+    parser.add_argument("--no-scales", action="store_true",
+                        help="Only search for templates at their original size")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of requests searched in parallel")
+    parser.add_argument("--store", metavar="DIR",
+                        help="Directory of compiled templates, shared between runs")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(argv)
+
+    templates = {Path(path).stem: imagex.Image(path)
+                 for pattern in args.templates for path in expand(pattern)}
+    address = args.socket if args.socket is not None else (args.host, args.port)
+    with imagex.MatchServer(templates, address, args.workers,
+                            None if args.no_scales else tuple(args.scales), args.store,
+                            args.verbose) as server:
+        print(f"Serving {len(templates)} template(s) on {server.address}", file=sys.stderr,
+              flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 def main():
     """Main entry point for the application script"""
-    parser = argparse.ArgumentParser()
-    parser.add_argument("image")
-    parser.add_argument("template")
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description="Finds templates in images, printing one JSON "
+                                                 "line per image")
+    parser.add_argument("inputs", nargs="+", metavar="image",
+                        help="Image files, directories or glob patterns, or - to read image paths "
+                             "(or JSON objects with an \"image\" field) from stdin, one per line. "
+                             "Without --template, the last one is the template.")
+    parser.add_argument("-t", "--template", action="append", dest="templates", default=[],
+                        help="A template file, directory or glob pattern. Can be repeated.")
+    parser.add_argument("--threshold", type=float, default=imagex.DEFAULT_THRESHOLD,
+                        help="Minimum normalized cross-correlation score of a match")
+    parser.add_argument("--scales", type=float, nargs=2, metavar=("MIN", "MAX"),
+                        default=imagex.pyramid.DEFAULT_SCALE_RANGE,
+                        help="Range of template scales to search")
+    parser.add_argument("--no-scales", action="store_true",
+                        help="Only search for templates at their original size")
+    parser.add_argument("--method", choices=imagex.correlation.METHODS,
+                        default=imagex.correlation.AUTO, help="Correlation engine")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of workers searching images in parallel")
+    parser.add_argument("--executor", choices=imagex.batch.EXECUTORS, default=imagex.THREAD,
+                        help="Whether workers are threads or processes")
+    parser.add_argument("--max-memory", type=int, metavar="BYTES",
+                        help="Search images larger than this memory budget in tiles")
+    parser.add_argument("--store", metavar="DIR",
+                        help="Directory of compiled templates, shared between runs")
     args = parser.parse_args()
 
-    image, template = args.image, args.template
-    print(image, template)
+    inputs, template_inputs = args.inputs, args.templates
+    if not template_inputs:
+        if len(inputs) < 2:
+            parser.error("no template given (use --template, or give it after the images)")
+        inputs, template_inputs = inputs[:-1], inputs[-1:]
+    template_paths = [path for pattern in template_inputs for path in expand(pattern)]
+    if not template_paths:
+        parser.error("no template found")
+    scales = None if args.no_scales else tuple(args.scales)
+    templates = [imagex.compile(imagex.Image(path), scales, store=args.store)
+                 for path in template_paths]
+
+    # Paths of the images being searched, by index
+    paths = {}
+
+    def indexed() -> Iterator[str]:
+        for index, path in enumerate(images(inputs)):
+            paths[index] = path
+            yield path
+
+    failed = 0
+    matches = []
+    results = imagex.find_many(indexed(), templates, args.threshold, args.method,
+                               workers=args.workers, executor=args.executor,
+                               max_memory=args.max_memory, skip_errors=True)
+    for result in results:
+        # The results of an image come together, in template order
+        matches.append({"template": template_paths[result.template],
+                        "box": None if result.box is None else list(result.box.to_tuple())})
+        if result.template < len(templates) - 1:
+            continue
+        line = {"image": paths.pop(result.image)}
+        if result.error is not None:
+            line["error"] = result.error
+            failed += 1
+        else:
+            line["matches"] = matches
+        print(json.dumps(line), flush=True)
+        matches = []
+    if failed:
+        print(f"{failed} image(s) could not be searched", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
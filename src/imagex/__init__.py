@@ -2,6 +2,44 @@
 ImageX - Regex for images
 https://github.com/Giantpizzahead/imagex
 Copyright (C) 2022 Giantpizzahead
+
+Submodules are imported lazily, the first time one of their names is used, so that importing the
+package doesn't pay for OpenCV and NumPy until a search actually needs them.
 """
+import importlib
+
+# The submodule that defines each public name
+_EXPORTS = {
+    "compile": "api", "find": "api", "find_all": "api", "find_any": "api", "find_exact": "api",
+    "Image": "image", "BoundingBox": "image", "BGR": "image", "RGB": "image",
+    "CompiledTemplate": "compiled", "DEFAULT_THRESHOLD": "compiled",
+    "EXACT_THRESHOLD": "compiled",
+    "find_async": "aio", "find_all_async": "aio", "AsyncPool": "aio",
+    "find_many": "batch", "BatchResult": "batch", "THREAD": "batch", "PROCESS": "batch",
+    "Tracker": "tracking", "find_stream": "tracking",
+    "Trace": "tracing", "TraceCollector": "tracing", "collect_traces": "tracing",
+    "TemplateSet": "template_set", "TemplateHit": "template_set",
+    "TemplateStore": "store",
+    "MatchServer": "server", "MatchClient": "server", "SharedImage": "server",
+}
+_SUBMODULES = {"aio", "api", "batch", "compiled", "correlation", "exact", "features",
+               "fourier_mellin", "image", "metrics", "peaks", "pyramid", "server", "store",
+               "template_set", "tiling", "tracing", "tracking", "transforms"}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f".{name}", __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # Later lookups don't go through __getattr__
+    globals()[name] = value
+    return value
+
 
-from .api import *
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_EXPORTS) | _SUBMODULES)
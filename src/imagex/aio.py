@@ -0,0 +1,174 @@
+"""
+Asyncio versions of find() and find_all(), which don't block the event loop.
+
+Searches run in the threads of an AsyncPool; OpenCV and NumPy release the GIL for the heavy
+kernels, so the event loop keeps running while they do. A pool bounds the number of searches in
+flight (queued or running), so that a burst of calls waits for a slot instead of holding every image
+and its working memory at once. The bound holds over every event loop (and thread) using the pool.
+
+Cancelling a call (or letting it time out) drops a search that hasn't started yet. A search that
+is already running can't be interrupted: it finishes in the background, its result is discarded,
+and it keeps its slot until then, so the bound on working memory still holds.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import os
+import threading
+from typing import Callable, Optional, Union
+
+from . import api, correlation, pyramid
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BoundingBox, Image
+
+# Number of searches in flight per worker thread, by default
+IN_FLIGHT_PER_WORKER = 2
+
+# The pool used when none is given, created on first use
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+class AsyncPool:
+    """Worker threads that run searches for coroutines, with a bounded number in flight."""
+
+    def __init__(self, workers: Optional[int] = None, max_in_flight: Optional[int] = None):
+        """
+        Args:
+            workers: The number of worker threads. Defaults to the number of CPUs.
+            max_in_flight: The maximum number of searches queued or running at once, over every
+                event loop using the pool. Defaults to IN_FLIGHT_PER_WORKER per worker.
+        """
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_in_flight = (self.workers * IN_FLIGHT_PER_WORKER if max_in_flight is None
+                              else max_in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, "imagex-async")
+        # asyncio.Semaphore only works within one event loop, so slots are counted under a thread
+        # lock instead, and calls waiting for one (from any loop) are queued in order
+        self._in_flight = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"AsyncPool(workers={self.workers}, max_in_flight={self.max_in_flight})"
+
+    @property
+    def in_flight(self) -> int:
+        """The number of searches queued or running."""
+        return self._in_flight
+
+    async def _acquire(self) -> None:
+        """Waits for a free slot, and takes it."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except BaseException:
+            with self._lock:
+                granted = waiter.done() and not waiter.cancelled()
+                if (loop, waiter) in self._waiters:
+                    self._waiters.remove((loop, waiter))
+            # If the slot was handed over but not granted yet, _grant() passes it on instead
+            if granted:
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        """Frees a slot, handing it over to the longest waiting call, if any. Thread-safe."""
+        with self._lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, waiter)
+                    return
+                except RuntimeError:
+                    # The event loop is closed
+                    pass
+            self._in_flight -= 1
+
+    def _grant(self, waiter: asyncio.Future) -> None:
+        """Gives a slot to a waiting call, in its event loop."""
+        if waiter.cancelled():
+            self._release()
+        else:
+            waiter.set_result(None)
+
+    async def run(self, function: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Runs a function in a worker thread and returns its result.
+
+        Args:
+            function: The function to run.
+            timeout: If given, the number of seconds to wait for a slot and the result, after which
+                asyncio.TimeoutError is raised.
+        """
+        return await asyncio.wait_for(self._run(functools.partial(function, *args, **kwargs)),
+                                      timeout)
+
+    async def _run(self, call: Callable):
+        await self._acquire()
+        try:
+            future = self._executor.submit(call)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the search is done or dropped, even if the caller gave up
+        future.add_done_callback(lambda _: self._release())
+        # Cancelling the wrapper cancels the search too, if it hasn't started yet
+        return await asyncio.wrap_future(future)
+
+    def close(self) -> None:
+        """Drops the queued searches, and waits for the running ones to finish."""
+        self._executor.shutdown(cancel_futures=True)
+
+
+def default_pool() -> AsyncPool:
+    """Returns the pool used when none is given, creating it on first use."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = AsyncPool()
+        return _default_pool
+
+
+async def find_async(image: Image, template: Union[Image, CompiledTemplate],
+                     threshold: float = DEFAULT_THRESHOLD, method: str = correlation.AUTO,
+                     scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                     max_memory: Optional[int] = None, timeout: Optional[float] = None,
+                     pool: Optional[AsyncPool] = None) -> Optional[BoundingBox]:
+    """
+    Finds the template in the image, without blocking the event loop. See imagex.find().
+
+    Args:
+        timeout: If given, the number of seconds to wait for the result, after which
+            asyncio.TimeoutError is raised.
+        pool: The AsyncPool to search in. Defaults to a pool shared by the process.
+    """
+    pool = default_pool() if pool is None else pool
+    return await pool.run(api.find, image, template, threshold, method, scales, max_memory,
+                          timeout=timeout)
+
+
+async def find_all_async(image: Image, template: Union[Image, CompiledTemplate],
+                         threshold: float = DEFAULT_THRESHOLD, max_results: Optional[int] = None,
+                         method: str = correlation.AUTO,
+                         scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                         max_memory: Optional[int] = None, timeout: Optional[float] = None,
+                         pool: Optional[AsyncPool] = None) -> list:
+    """
+    Finds every occurrence of the template in the image, without blocking the event loop. See
+    imagex.find_all(), and find_async() for the timeout and pool.
+    """
+    pool = default_pool() if pool is None else pool
+    return await pool.run(api.find_all, image, template, threshold, max_results, method, scales,
+                          max_memory, timeout=timeout)
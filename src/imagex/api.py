@@ -3,45 +3,197 @@ ImageX - Regex for images
 https://github.com/Giantpizzahead/imagex
 Copyright (C) 2022 Giantpizzahead
 """
-from typing import Optional
+import os
+from typing import TYPE_CHECKING, Hashable, Iterable, Mapping, Optional, Union
 
-import cv2
+from . import correlation, exact, pyramid, tracing
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BoundingBox, Image
+from .tracing import Trace
 
+if TYPE_CHECKING:
+    # Imported when first used, so that find() doesn't import them
+    from .store import TemplateStore
+    from .template_set import TemplateSet
 
-class BoundingBox:
-    """Represents a bounding box with the given top-left corner, width, and height."""
-    x: int
-    y: int
-    w: int
-    h: int
 
-    def __init__(self, x: int, y: int, w: int, h: int):
-        """Creates a rectangle with the given top-left corner, width, and height."""
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
+def compile(template: Image, scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+            angles: Optional[Iterable[float]] = (0,), flips: bool = False,
+            use_features: bool = False,
+            store: Optional[Union[str, os.PathLike, "TemplateStore"]] = None,
+            max_difference: Optional[float] = None) -> CompiledTemplate:
+    """
+    Compiles a template, doing all template-side preprocessing up front.
 
-    def to_tuple(self) -> tuple:
-        """Returns the bounding box as a tuple (x, y, w, h)."""
-        return self.x, self.y, self.w, self.h
+    Compile a template once when searching for it in many images.
 
-    def __str__(self) -> str:
-        return f"BoundingBox({self.x}, {self.y}, {self.w}, {self.h})"
+    Args:
+        template: The template to compile.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the template at its original size.
+        angles: The rotations of the template to search for, in degrees, or None to search for any
+            rotation.
+        flips: Whether to also search for the mirrored template.
+        use_features: Whether to first find the template by matching ORB keypoints, which is much
+            faster than correlation when searching for any scale and rotation in large images. Only
+            useful for templates with enough texture, and only used by find().
+        store: A TemplateStore (or the directory of one) to load the compiled template from, or
+            to save it to if it isn't there yet. Processes that load the same template from a store
+            share its memory.
+        max_difference: If given, windows of the image whose colors differ from the template's by
+            more than this RMS difference (in [0, 1]; correlation.MAX_RMS_DIFFERENCE is a
+            reasonable value) are rejected from their mean and standard deviation, without being
+            correlated. This makes searches in images that don't hold the template much faster,
+            but darker or lower contrast copies of the template are no longer found.
+    """
+    if store is not None:
+        from .store import TemplateStore
+        if not isinstance(store, TemplateStore):
+            store = TemplateStore(store)
+        return store.compile(template, scales, angles, flips, use_features, max_difference)
+    return CompiledTemplate(template, scales, angles, flips, use_features, max_difference)
 
-    def __repr__(self) -> str:
-        return self.__str__()
 
+def find(image: Image, template: Union[Image, CompiledTemplate],
+         threshold: float = DEFAULT_THRESHOLD, method: str = correlation.AUTO,
+         scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+         max_memory: Optional[int] = None, trace: bool = False,
+         max_difference: Optional[float] = None) -> Union[Optional[BoundingBox], Trace]:
+    """
+    Finds the template in the image and returns its bounding box (or None if not found).
 
-class Image:
-    """Represents an image."""
+    The template is first searched for at its original size. Unless that gives a (near) exact match,
+    a coarse-to-fine pyramid search is then done over the given range of scales.
 
-    def __init__(self, source):
-        """Creates an image from the given source."""
-        assert isinstance(source, str)
-        self.image = cv2.imread(source)
+    Args:
+        image: The image to search in.
+        template: The template to search for. Can be a compiled template, in which case scales is
+            ignored in favor of the compiled scales.
+        threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+        method: The correlation engine to use. By default, the cheapest one is picked based on the
+            image and template sizes.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the template at its original size.
+        max_memory: If given, images whose search would take more working memory than this many
+            bytes are searched in overlapping tiles, each within this budget. Images stored as .npy
+            files are memory-mapped, so they never need to fit in memory whole. Searches at the
+            template's original size give the same results as without tiles. Scaled searches
+            find the same matches, but their scores can differ by rounding (tiles have their own
+            pyramid levels), so matches that score (nearly) the same can come in another order.
+        trace: Whether to trace the call. If so, a Trace is returned instead, holding the result
+            along with the time and memory taken by each stage of the search. Tracing slows the
+            call down (see imagex.tracing).
+        max_difference: If given, the largest RMS color difference of a matching window, to reject
+            the others cheaply (see compile()). Overrides the compiled one.
+    """
+    with tracing.traced("find", trace) as current:
+        if not isinstance(template, CompiledTemplate):
+            template = compile(template, scales)
+        result = template.find(image, threshold, method, max_memory, max_difference)
+    if current is not None:
+        current.result = result
+    return current if trace else result
 
 
-def find(image: Image, template: Image) -> Optional[BoundingBox]:
-    """Finds the template in the image and returns its bounding box (or None if not found)."""
-    return None
+def find_all(image: Image, template: Union[Image, CompiledTemplate],
+             threshold: float = DEFAULT_THRESHOLD, max_results: Optional[int] = None,
+             method: str = correlation.AUTO,
+             scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+             max_memory: Optional[int] = None, trace: bool = False,
+             max_difference: Optional[float] = None) -> Union[list, Trace]:
+    """
+    Finds every occurrence of the template in the image and returns their bounding boxes.
+
+    Args:
+        image: The image to search in.
+        template: The template to search for. Can be a compiled template, in which case scales is
+            ignored in favor of the compiled scales.
+        threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+        max_results: If given, at most this many (best scoring) matches are returned.
+        method: The correlation engine to use.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the template at its original size.
+        max_memory: If given, images whose search would take more working memory than this many
+            bytes are searched in overlapping tiles, each within this budget. Images stored as .npy
+            files are memory-mapped, so they never need to fit in memory whole. Searches at the
+            template's original size give the same results as without tiles. Scaled searches
+            find the same matches, but their scores can differ by rounding (tiles have their own
+            pyramid levels), so matches that score (nearly) the same can come in another order.
+        trace: Whether to trace the call. If so, a Trace is returned instead, holding the result
+            along with the time and memory taken by each stage of the search. Tracing slows the
+            call down (see imagex.tracing).
+        max_difference: If given, the largest RMS color difference of a matching window, to reject
+            the others cheaply (see compile()). Overrides the compiled one.
+
+    Returns:
+        A list of bounding boxes, sorted by decreasing score. Empty if the template wasn't found.
+    """
+    with tracing.traced("find_all", trace) as current:
+        if not isinstance(template, CompiledTemplate):
+            template = compile(template, scales)
+        result = template.find_all(image, threshold, max_results, method, max_memory,
+                                   max_difference)
+    if current is not None:
+        current.result = result
+    return current if trace else result
+
+
+def find_any(image: Image,
+             templates: Union["TemplateSet", Mapping[Hashable, Image], Iterable[Image]],
+             threshold: float = DEFAULT_THRESHOLD, method: str = correlation.AUTO,
+             scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+             trace: bool = False, max_difference: Optional[float] = None) -> Union[list, Trace]:
+    """
+    Finds each of several templates in the image, in one pass over the image.
+
+    This is much faster than calling find() for every template: the image-side work is shared, and
+    templates of the same size are correlated together. Build a TemplateSet once when searching for
+    the same templates in many images.
+
+    Args:
+        image: The image to search in.
+        templates: The templates to search for, either as a TemplateSet, as a mapping from labels to
+            templates, or as a sequence (labelled by their index).
+        threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+        method: The correlation engine to use.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the templates at their original sizes. Ignored for a TemplateSet.
+        trace: Whether to trace the call. If so, a Trace is returned instead, holding the result
+            along with the time and memory taken by each stage of the search. Tracing slows the
+            call down (see imagex.tracing).
+        max_difference: If given, the largest RMS color difference of a matching window, to reject
+            the others cheaply (see compile()). Ignored for a TemplateSet.
+
+    Returns:
+        A list of TemplateHits (label, bounding box and score), holding the best match of every
+        template that was found, sorted by decreasing score.
+    """
+    from .template_set import TemplateSet
+    with tracing.traced("find_any", trace) as current:
+        if not isinstance(templates, TemplateSet):
+            templates = TemplateSet(templates, scales, max_difference=max_difference)
+        result = templates.find(image, threshold, method)
+    if current is not None:
+        current.result = result
+    return current if trace else result
+
+
+def find_exact(image: Image, template: Image) -> list:
+    """
+    Finds every pixel-perfect copy of the template in the image and returns their bounding boxes.
+
+    This runs in linear time, using a rolling hash of every window of the image. Transparent
+    pixels of the template match anything; templates with any are matched with FFTs instead.
+
+    Args:
+        image: The image to search in. Its alpha channel is ignored.
+        template: The template to search for.
+
+    Returns:
+        A list of bounding boxes, in row-major order. Empty if there is no exact copy.
+    """
+    h, w = template.image.shape[:2]
+    ys, xs = exact.match_exact(image.colors(image.channel_order),
+                               template.colors(image.channel_order),
+                               template.mask)
+    return [BoundingBox(x, y, w, h) for y, x in zip(ys.tolist(), xs.tolist())]
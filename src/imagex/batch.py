@@ -0,0 +1,148 @@
+"""
+Batch searches of many templates in many images, spread over a pool of workers.
+
+Templates are compiled once. Thread workers share the compiled templates directly; process
+workers receive them once, when the worker starts, so tasks only carry an image. Each task searches
+one image for every template, so the image is decoded once and its derived representations are
+shared by all templates.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import concurrent.futures
+import os
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
+
+from . import correlation, pyramid
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BoundingBox, Image
+
+# Executors
+THREAD = "thread"
+PROCESS = "process"
+EXECUTORS = [THREAD, PROCESS]
+# Number of tasks submitted per worker ahead of the results being consumed
+TASKS_PER_WORKER = 4
+
+# The compiled templates of a process worker, set once when the worker starts
+_worker_templates = None
+
+
+class BatchResult(NamedTuple):
+    """The result of searching for one template in one image."""
+    image: int  # Index of the image in the input
+    template: int  # Index of the template in the input
+    box: Optional[BoundingBox]  # The match, or None if the template wasn't found
+    error: Optional[str] = None  # Why the image couldn't be searched, if skip_errors was set
+
+
+def _init_worker(templates: list) -> None:
+    """Stores the compiled templates in a process worker."""
+    global _worker_templates
+    _worker_templates = templates
+
+
+def _search(image: Union[Image, str, os.PathLike], templates: Optional[list], threshold: float,
+            method: str, max_memory: Optional[int]) -> list:
+    """
+    Searches one image for every template.
+
+    Args:
+        image: The image, or the path to it.
+        templates: The compiled templates, or None to use those of the process worker.
+        threshold: The minimum score of a match.
+        method: The correlation engine to use.
+        max_memory: The memory budget of the search, as in CompiledTemplate.find().
+
+    Returns:
+        The bounding box (or None) of each template.
+    """
+    if not isinstance(image, Image):
+        image = Image(image)
+    templates = _worker_templates if templates is None else templates
+    return [template.find(image, threshold, method, max_memory) for template in templates]
+
+
+def find_many(images: Iterable[Union[Image, str, os.PathLike]],
+              templates: Iterable[Union[Image, CompiledTemplate]],
+              threshold: float = DEFAULT_THRESHOLD, method: str = correlation.AUTO,
+              scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+              workers: Optional[int] = None, executor: str = THREAD,
+              max_memory: Optional[int] = None,
+              skip_errors: bool = False) -> Iterator[BatchResult]:
+    """
+    Finds every template in every image, using a pool of workers.
+
+    Results are yielded as soon as each image has been searched, so they are not in input order.
+    Images are read from the iterable lazily, only a few per worker ahead of the results being
+    consumed, so it can be a generator over any number of images.
+
+    Args:
+        images: The images to search in, or paths to them. With the process executor, images are
+            pickled to be sent to the workers, so paths (or images that haven't been decoded yet)
+            are much cheaper to send than decoded images.
+        templates: The templates to search for. Templates that aren't compiled yet are compiled
+            once, with the given scales.
+        threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+        method: The correlation engine to use.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the templates at their original size.
+        workers: The number of workers. Defaults to the number of CPUs.
+        executor: THREAD to search in threads of this process, or PROCESS to search in worker
+            processes. Threads share all memory and work well since matching mostly runs outside
+            of the GIL; processes also parallelize the Python parts of the search.
+        max_memory: If given, the memory budget of searching one image, as in imagex.find().
+        skip_errors: Whether to carry on when an image can't be searched (like a file that can't
+            be decoded). If so, its results have no box and describe the error, instead of the
+            error being raised.
+
+    Yields:
+        A BatchResult for every image and template pair.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Invalid executor: {executor}")
+    templates = [t if isinstance(t, CompiledTemplate) else CompiledTemplate(t, scales)
+                 for t in templates]
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if executor == THREAD:
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+        shared = templates
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                      initargs=(templates,))
+        shared = None
+    pending = {}
+    images = enumerate(images)
+    exhausted = False
+    try:
+        while True:
+            # Keep a bounded number of tasks in flight
+            while not exhausted and len(pending) < workers * TASKS_PER_WORKER:
+                next_image = next(images, None)
+                if next_image is None:
+                    exhausted = True
+                    break
+                index, image = next_image
+                future = pool.submit(_search, image, shared, threshold, method, max_memory)
+                pending[future] = index
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    boxes = future.result()
+                except Exception as error:
+                    if not skip_errors:
+                        raise
+                    message = f"{type(error).__name__}: {error}"
+                    for template_index in range(len(templates)):
+                        yield BatchResult(index, template_index, None, message)
+                    continue
+                for template_index, box in enumerate(boxes):
+                    yield BatchResult(index, template_index, box)
+    finally:
+        # Don't wait for (or start) tasks whose results won't be consumed
+        pool.shutdown(cancel_futures=True)
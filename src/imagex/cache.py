@@ -0,0 +1,176 @@
+"""
+Bounded caches of derived image representations.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+import numpy as np
+
+from . import metrics
+
+# Default byte budget of the derived representations cached per image
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+
+def nbytes(value, seen: Optional[set] = None) -> int:
+    """
+    Returns the memory used by the arrays in a value.
+
+    Args:
+        value: An array, a tuple, list or dict of values, or an object with an arrays() method
+            returning the values it holds.
+        seen: The ids of arrays that were already counted, so that shared arrays are counted once.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    for key, array in _arrays(value).items():
+        if key not in seen:
+            seen.add(key)
+            total += array.nbytes
+    return total
+
+
+def _arrays(value, found: Optional[dict] = None) -> dict:
+    """Returns the arrays in a value (as accepted by nbytes()), keyed by id."""
+    found = {} if found is None else found
+    if isinstance(value, np.ndarray):
+        found[id(value)] = value
+        return found
+    if isinstance(value, dict):
+        value = list(value.values())
+    elif hasattr(value, "arrays"):
+        value = value.arrays()
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            _arrays(item, found)
+    return found
+
+
+class DerivedCache:
+    """
+    A least recently used cache of values derived from one image, bounded by their total size.
+
+    Sizes are measured with nbytes() when a value is added. Values that grow after being cached
+    (like a pyramid that computes its summed-area tables and spectra lazily) must report it with
+    remeasure(), or through a callback from watcher(), to be measured again. Arrays shared between
+    values are only counted once.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            max_bytes: The byte budget. Values are evicted (least recently used first) once the
+                cached values take up more than this.
+        """
+        self._max_bytes = max_bytes
+        self._values = OrderedDict()
+        # The arrays held by each value, keyed by id
+        self._held = {}
+        # The number of values holding each array (along with the array, so that its id stays
+        # unique while it's counted)
+        self._counts = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._values
+
+    @property
+    def max_bytes(self) -> int:
+        """The byte budget. Lowering it evicts values right away."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes: int) -> None:
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the cached values, as last measured."""
+        return self._nbytes
+
+    def get(self, key: Hashable, compute: Callable[[], object]):
+        """
+        Returns the cached value for a key, computing (and caching) it first if needed.
+
+        Args:
+            key: The key of the derived value.
+            compute: Computes the value if it isn't cached.
+        """
+        with self._lock:
+            metrics.record_cache("image", key in self._values)
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        value = compute()
+        with self._lock:
+            self._values[key] = value
+            self._measure(key)
+            self._evict()
+        return value
+
+    def remeasure(self, key: Hashable) -> None:
+        """Measures a cached value again after it grew, evicting values if needed."""
+        with self._lock:
+            if key in self._values:
+                self._measure(key)
+                self._evict()
+
+    def watcher(self, key: Hashable) -> Callable[[], None]:
+        """
+        Returns a function that calls remeasure(key), for a value to call whenever it grows.
+
+        The function only holds a weak reference to the cache, so cached values can keep it.
+        """
+        cache = weakref.ref(self)
+
+        def grown() -> None:
+            if cache() is not None:
+                cache().remeasure(key)
+        return grown
+
+    def clear(self) -> None:
+        """Removes every cached value."""
+        with self._lock:
+            self._values.clear()
+            self._held.clear()
+            self._counts.clear()
+            self._nbytes = 0
+
+    def _measure(self, key: Hashable) -> None:
+        """Updates the arrays counted for a value."""
+        held = _arrays(self._values[key])
+        old = self._held.get(key, {})
+        for array_id in held.keys() - old.keys():
+            self._count(array_id, held[array_id], 1)
+        for array_id in old.keys() - held.keys():
+            self._count(array_id, old[array_id], -1)
+        self._held[key] = held
+
+    def _count(self, array_id: int, array: np.ndarray, change: int) -> None:
+        """Changes the number of values holding an array."""
+        entry = self._counts.setdefault(array_id, [array, 0])
+        if entry[1] == 0:
+            self._nbytes += array.nbytes
+        entry[1] += change
+        if entry[1] == 0:
+            self._nbytes -= array.nbytes
+            del self._counts[array_id]
+
+    def _evict(self) -> None:
+        """Evicts the least recently used values until the cache fits in its budget."""
+        while self._values and self._nbytes > self._max_bytes:
+            key, _ = self._values.popitem(last=False)
+            for array_id, array in self._held.pop(key).items():
+                self._count(array_id, array, -1)
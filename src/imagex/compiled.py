@@ -0,0 +1,361 @@
+"""
+Precompiled templates.
+
+Like a compiled regular expression, a compiled template does all template-side preprocessing once
+(float conversion, rotated and mirrored variants, masks, resized copies, norms and FFT spectra), so
+that searching for it in many images only pays for the image-side work.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import time
+from typing import Iterable, Optional
+
+import numpy as np
+
+from . import (correlation, exact, features, fourier_mellin, metrics, peaks, pyramid, tiling,
+               tracing, transforms)
+from .correlation import Candidate
+from .image import BoundingBox, Image
+
+# Minimum score for a template position to be considered a match
+DEFAULT_THRESHOLD = 0.8
+# Score at which a match at the template's original size is accepted without searching other scales
+EXACT_THRESHOLD = 0.999
+
+
+class Variant(pyramid.ScaledTemplates):
+    """One rotated and/or mirrored version of a template."""
+
+    def __init__(self, pixels: np.ndarray, mask: Optional[np.ndarray] = None, angle: float = 0.0,
+                 flipped: bool = False):
+        """
+        Args:
+            pixels: The float32 pixels of the transformed template, of shape (h, w, C).
+            mask: An optional mask of shape (h, w).
+            angle: The angle the template was rotated by, in degrees.
+            flipped: Whether the template was mirrored (before being rotated).
+        """
+        super().__init__(pixels, mask)
+        self.angle = angle
+        self.flipped = flipped
+
+    @property
+    def prepared(self) -> correlation.PreparedTemplate:
+        """The variant at its original size, prepared for correlation."""
+        return self.sized(*self.shape[:2])
+
+    def prepare(self) -> None:
+        """Does the template-side work of correlating the variant at its original size up front."""
+        self.sized(*self.shape[:2])
+
+
+class CompiledTemplate:
+    """A template with all template-side preprocessing done, ready to be searched for in images."""
+
+    @tracing.timed("compile")
+    def __init__(self, template: Image, scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                 angles: Optional[Iterable[float]] = (0,), flips: bool = False,
+                 use_features: bool = False, max_difference: Optional[float] = None):
+        """
+        Compiles a template. Use imagex.compile() instead of calling this directly.
+
+        Args:
+            template: The template to compile.
+            scales: The (min_scale, max_scale) range of template scales to search, or None to only
+                search for the template at its original size.
+            angles: The rotations of the template to search for, in degrees, or None to search for
+                any rotation (estimated with the Fourier-Mellin transform).
+            flips: Whether to also search for the mirrored template. Together with a rotation of
+                180 degrees, this also covers vertical flips.
+            use_features: Whether to find the template by matching keypoints before correlating.
+            max_difference: If given, windows whose colors differ from the template's by more than
+                this RMS difference are rejected from their mean and standard deviation, without
+                being correlated (see correlation.match_template()). This makes searches that find
+                nothing much faster, but darker or lower contrast copies of the template are no
+                longer found.
+        """
+        if scales is not None and not 0 < scales[0] <= scales[1]:
+            raise ValueError(f"Invalid scale range: {scales}")
+        self.template = template
+        self.scales = scales
+        self.angles = None if angles is None else tuple(angles)
+        self.flips = flips
+        self.max_difference = max_difference
+        pixels, mask = template.pixels, template.mask
+        self.variants = []
+        for flipped in (False, True) if flips else (False,):
+            source, source_mask = pixels, mask
+            if flipped:
+                source = np.ascontiguousarray(np.flip(pixels, axis=1))
+                source_mask = None if mask is None else np.ascontiguousarray(np.flip(mask, axis=1))
+            for angle in (0,) if self.angles is None else self.angles:
+                rotated, rotated_mask = transforms.rotate(source, source_mask, angle)
+                variant = Variant(rotated, rotated_mask, angle, flipped)
+                # Precompute what every search needs
+                variant.prepare()
+                if self.angles is None:
+                    variant.log_polar = fourier_mellin.LogPolarTemplate(variant)
+                self.variants.append(variant)
+        self.features = features.FeatureTemplate(template, flips) if use_features else None
+
+    def search(self, image, method: str = correlation.AUTO, original: Optional[list] = None,
+               threshold: Optional[float] = None, scales: Optional[tuple] = None,
+               scaled: Optional[list] = None,
+               max_difference: Optional[float] = None) -> Optional[Candidate]:
+        """
+        Finds the best match of any variant of the template.
+
+        Args:
+            image: The image to search in, either as a Pyramid or as a float32 array, as returned by
+                correlation.to_float().
+            method: The correlation engine to use.
+            original: The best candidate of every variant at its original size, if already found
+                (like by a TemplateSet, which correlates templates of equal size together).
+            threshold: If given, scaled candidates that can't reach this score aren't refined.
+            scales: If given, the (min_scale, max_scale) range of scales to search instead of the
+                compiled one, like a narrow range around the scale of a previous match. Ignored if
+                the template was compiled to only be searched for at its original size.
+            scaled: The best candidate of every variant over the range of scales (as returned by
+                pyramid.search_scales()), if already found (like by a TemplateSet, which searches
+                the scales of templates of equal shape together).
+            max_difference: If given, the largest RMS color difference of a matching window to use
+                instead of the compiled one.
+
+        Returns:
+            The best candidate, or None if the template doesn't fit in the image.
+        """
+        scales = self.scales if scales is None or self.scales is None else scales
+        max_difference = self.max_difference if max_difference is None else max_difference
+        levels = image if isinstance(image, pyramid.Pyramid) else pyramid.Pyramid(image)
+        if original is None:
+            original = []
+            for variant in self.variants:
+                scores = correlation.match_template(levels[0], variant.prepared, method,
+                                                    levels.integrals(0), max_difference,
+                                                    levels.spectra(0))
+                original.append(correlation.best_candidate(scores, *variant.shape[:2]))
+        candidates = [candidate._replace(angle=variant.angle, flipped=variant.flipped)
+                      for variant, candidate in zip(self.variants, original)
+                      if candidate is not None]
+        best = correlation.pick_best(candidates)
+        if self.needs_scales(best, scales):
+            if scaled is None:
+                scaled = [pyramid.search_scales(levels, variant, scales, method, threshold,
+                                                max_difference)
+                          for variant in self.variants]
+            for variant, candidate in zip(self.variants, scaled):
+                if candidate is not None:
+                    candidates.append(candidate._replace(angle=variant.angle,
+                                                         flipped=variant.flipped))
+            best = correlation.pick_best(candidates)
+        if (best is None or best.score < EXACT_THRESHOLD) and self.angles is None:
+            for variant in self.variants:
+                rotated = fourier_mellin.search(levels, variant.log_polar, scales, method)
+                candidates.extend(c._replace(flipped=variant.flipped) for c in rotated[:1])
+            best = correlation.pick_best(candidates)
+        return best
+
+    def needs_scales(self, best: Optional[Candidate], scales: Optional[tuple] = None) -> bool:
+        """Returns whether search() goes on to search other scales, given its best candidate."""
+        scales = self.scales if scales is None else scales
+        return (best is None or best.score < EXACT_THRESHOLD) and scales is not None
+
+    def search_exact(self, pixels: np.ndarray, channel_order: str,
+                     hashes: Optional[np.ndarray] = None) -> Optional[Candidate]:
+        """
+        Finds the first (in row-major order) pixel-perfect copy of the unrotated template.
+
+        Transparent pixels of the template match anything.
+
+        Args:
+            pixels: The uint8 pixels of the image to search in. Alpha is ignored.
+            channel_order: The channel order of the pixels.
+            hashes: The image's window hashes for the template's size, as accepted by
+                exact.match_exact().
+
+        Returns:
+            A candidate with a score of 1, or None if there is no exact copy (or the template was
+            compiled without its unrotated version).
+        """
+        if self.angles is not None and 0 not in self.angles:
+            return None
+        if pixels.ndim == 3 and pixels.shape[2] == 4:
+            pixels = pixels[:, :, :3]
+        ys, xs = exact.match_exact(pixels, self.template.colors(channel_order), self.template.mask,
+                                   hashes)
+        if not len(ys):
+            return None
+        h, w = self.template.image.shape[:2]
+        return Candidate(1.0, int(xs[0]), int(ys[0]), w, h)
+
+    def match(self, image: Image, method: str = correlation.AUTO,
+              max_memory: Optional[int] = None, threshold: Optional[float] = None,
+              scales: Optional[tuple] = None,
+              max_difference: Optional[float] = None) -> Optional[Candidate]:
+        """
+        Finds the best match of the template in the image, along with its score.
+
+        Pixel-perfect copies of the template are looked up first, with a linear time rolling hash.
+        If the template was compiled with keypoints, they are matched next, and a verified match is
+        accepted if it scores at least features.ACCEPT_THRESHOLD. Otherwise, the template is
+        searched for at its original size. Unless that gives a (near) exact match, a coarse-to-fine
+        pyramid search is then done over the compiled range of scales.
+        If the template was compiled for any rotation, rotated matches are found last, by estimating
+        the rotation and scale of the most promising regions with the Fourier-Mellin transform.
+
+        Args:
+            image: The image to search in.
+            method: The correlation engine to use. By default, the cheapest one is picked based on
+                the image and template sizes.
+            max_memory: If given, and searching the whole image at once would take more working
+                memory than this many bytes, the image is searched in overlapping tiles instead.
+            threshold: If given, scaled candidates that can't reach this score are dropped early.
+            scales: If given, the range of scales to search instead of the compiled one. See
+                search().
+            max_difference: If given, the largest RMS color difference of a matching window to use
+                instead of the compiled one.
+
+        Returns:
+            The best candidate, or None if the template doesn't fit in the image.
+        """
+        if max_memory is not None and tiling.search_memory(image.image.shape) > max_memory:
+            return tiling.search(self, image, method, max_memory, threshold, scales,
+                                 max_difference)
+        best = self.search_exact(image.image, image.channel_order)
+        if best is None and self.features is not None:
+            feature_scales = self.scales if scales is None or self.scales is None else scales
+            best = self.features.search(image, feature_scales, self.angles, method)
+            if best is not None and best.score < features.ACCEPT_THRESHOLD:
+                best = correlation.pick_best([best, self.search(image.pyramid, method,
+                                                                threshold=threshold,
+                                                                scales=scales,
+                                                                max_difference=max_difference)])
+        if best is None:
+            best = self.search(image.pyramid, method, threshold=threshold, scales=scales,
+                               max_difference=max_difference)
+        return best
+
+    def find(self, image: Image, threshold: float = DEFAULT_THRESHOLD,
+             method: str = correlation.AUTO, max_memory: Optional[int] = None,
+             max_difference: Optional[float] = None) -> Optional[BoundingBox]:
+        """
+        Finds the template in the image and returns its bounding box (or None if not found).
+
+        See match() for how the template is searched for.
+
+        Args:
+            image: The image to search in.
+            threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+            method: The correlation engine to use. By default, the cheapest one is picked based on
+                the image and template sizes.
+            max_memory: If given, and searching the whole image at once would take more working
+                memory than this many bytes, the image is searched in overlapping tiles instead.
+            max_difference: If given, the largest RMS color difference of a matching window to use
+                instead of the compiled one.
+        """
+        start = time.perf_counter()
+        best = self.match(image, method, max_memory, threshold, max_difference=max_difference)
+        found = best is not None and best.score >= threshold
+        metrics.record_call("find", image.image.shape, time.perf_counter() - start, found)
+        return BoundingBox(best.x, best.y, best.w, best.h) if found else None
+
+    def search_all(self, image, threshold: float = DEFAULT_THRESHOLD,
+                   max_results: Optional[int] = None, method: str = correlation.AUTO,
+                   max_overlap: float = peaks.DEFAULT_MAX_OVERLAP,
+                   max_difference: Optional[float] = None) -> list:
+        """
+        Finds all matches of any variant of the template.
+
+        Peaks are kept as arrays until non-maximum suppression is done, so only the surviving
+        matches are turned into Candidate objects.
+
+        Args:
+            image: The image to search in, either as a Pyramid or as a float32 array, as returned by
+                correlation.to_float().
+            threshold: The minimum score of a match.
+            max_results: If given, at most this many (best scoring) matches are returned.
+            method: The correlation engine to use.
+            max_overlap: The maximum fraction of a match that may be covered by a better match.
+            max_difference: If given, the largest RMS color difference of a matching window to use
+                instead of the compiled one.
+
+        Returns:
+            A list of candidates, sorted by decreasing score.
+        """
+        max_difference = self.max_difference if max_difference is None else max_difference
+        levels = image if isinstance(image, pyramid.Pyramid) else pyramid.Pyramid(image)
+        boxes, scores, scales, angles, sources = [], [], [], [], []
+        for index, variant in enumerate(self.variants):
+            prepared = variant.prepared
+            score_map = correlation.match_template(levels[0], prepared, method, levels.integrals(0),
+                                                   max_difference, levels.spectra(0))
+            ys, xs, values = peaks.local_maxima(score_map, threshold)
+            boxes.append(np.stack([xs, ys, np.full_like(xs, prepared.w),
+                                   np.full_like(xs, prepared.h)], axis=1))
+            scores.append(values)
+            scales.append(np.ones(len(values)))
+            angles.append(np.full(len(values), variant.angle))
+            sources.append(np.full(len(values), index))
+            if self.scales is not None:
+                scaled = pyramid.search_scales_all(levels, variant, threshold, self.scales, method,
+                                                   max_difference=max_difference)
+                boxes.append(np.array([(c.x, c.y, c.w, c.h) for c in scaled],
+                                      np.intp).reshape(-1, 4))
+                scores.append(np.array([c.score for c in scaled]))
+                scales.append(np.array([c.scale for c in scaled]))
+                angles.append(np.full(len(scaled), variant.angle))
+                sources.append(np.full(len(scaled), index))
+            if self.angles is None:
+                rotated = [c for c in fourier_mellin.search(levels, variant.log_polar, self.scales,
+                                                            method) if c.score >= threshold]
+                boxes.append(np.array([(c.x, c.y, c.w, c.h) for c in rotated],
+                                      np.intp).reshape(-1, 4))
+                scores.append(np.array([c.score for c in rotated]))
+                scales.append(np.array([c.scale for c in rotated]))
+                angles.append(np.array([c.angle for c in rotated]))
+                sources.append(np.full(len(rotated), index))
+        boxes, scores = np.concatenate(boxes), np.concatenate(scores)
+        scales, angles = np.concatenate(scales), np.concatenate(angles)
+        sources = np.concatenate(sources)
+        results = []
+        for i in peaks.non_max_suppression(boxes, scores, max_overlap, max_results):
+            variant = self.variants[sources[i]]
+            x, y, w, h = boxes[i].tolist()
+            results.append(Candidate(float(scores[i]), x, y, w, h, float(scales[i]),
+                                     float(angles[i]), variant.flipped))
+        return results
+
+    def find_all(self, image: Image, threshold: float = DEFAULT_THRESHOLD,
+                 max_results: Optional[int] = None, method: str = correlation.AUTO,
+                 max_memory: Optional[int] = None, max_difference: Optional[float] = None) -> list:
+        """
+        Finds every occurrence of the template in the image.
+
+        Matches may overlap each other, as long as no more than 80% of a match is covered by a
+        better one.
+
+        Args:
+            image: The image to search in.
+            threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+            max_results: If given, at most this many (best scoring) matches are returned.
+            method: The correlation engine to use.
+            max_memory: If given, and searching the whole image at once would take more working
+                memory than this many bytes, the image is searched in overlapping tiles instead.
+            max_difference: If given, the largest RMS color difference of a matching window to use
+                instead of the compiled one.
+
+        Returns:
+            A list of bounding boxes, sorted by decreasing score. Empty if nothing was found.
+        """
+        start = time.perf_counter()
+        if max_memory is not None and tiling.search_memory(image.image.shape) > max_memory:
+            candidates = tiling.search_all(self, image, threshold, max_results, method,
+                                           peaks.DEFAULT_MAX_OVERLAP, max_memory, max_difference)
+        else:
+            candidates = self.search_all(image.pyramid, threshold, max_results, method,
+                                         max_difference=max_difference)
+        metrics.record_call("find_all", image.image.shape, time.perf_counter() - start,
+                            bool(candidates))
+        return [BoundingBox(c.x, c.y, c.w, c.h) for c in candidates]
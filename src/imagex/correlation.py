@@ -0,0 +1,613 @@
+"""
+Normalized cross-correlation engines.
+
+Both engines compute the same zero-mean normalized cross-correlation (ZNCC) score map. The spatial
+engine is backed by cv2.matchTemplate, while the frequency-domain engine correlates via FFT. Engines
+only produce the correlation numerator; the normalization is shared and computed from integral
+images, so the two are interchangeable and the cheaper one can be picked automatically.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import math
+import threading
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+from . import metrics, tracing
+
+# Correlation methods
+AUTO = "auto"
+SPATIAL = "spatial"
+FFT = "fft"
+METHODS = [AUTO, SPATIAL, FFT]
+
+# cv2.matchTemplate switches to a block DFT for large templates, which caps its cost per window
+SPATIAL_MAX_AREA = 128
+# Relative cost of one FFT operation compared to one multiply-add of the spatial engine
+FFT_COST_FACTOR = 1.0
+# Sum of squared deviations (per pixel) below which a template or window is considered flat
+FLAT_EPSILON = 1e-6
+# Number of padded shapes whose spectra a prepared template keeps. Spectra are as large as the
+# images they were computed for, so the least recently used ones are dropped beyond this.
+MAX_CACHED_SPECTRA = 4
+# Candidates scoring within this much of the best one are considered tied
+SCORE_TOLERANCE = 0.02
+# Largest RMS color difference (per pixel and channel) between a template and a matching window,
+# when the statistics prefilter is enabled
+MAX_RMS_DIFFERENCE = 0.3
+# Smallest template area for which checking window statistics is cheaper than correlating
+PREFILTER_MIN_AREA = 100
+# Only the bounding box of the windows that pass the statistics check is correlated if it holds
+# less than this fraction of all windows
+CROP_FRACTION = 0.5
+# Largest amount of memory (in bytes) used by one batch of inverse FFTs in match_templates()
+BATCH_MEMORY = 1 << 28
+
+
+class Candidate(NamedTuple):
+    """A scored template position, with the template scaled, mirrored and rotated as given."""
+    score: float
+    x: int
+    y: int
+    w: int
+    h: int
+    scale: float = 1.0
+    angle: float = 0.0
+    flipped: bool = False
+
+
+@tracing.timed("convert")
+def to_float(pixels: np.ndarray) -> np.ndarray:
+    """Converts uint8 pixels to a float32 array in [0, 1], always with a channel axis."""
+    pixels = pixels.astype(np.float32) / 255
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    return pixels
+
+
+def integral_image(pixels: np.ndarray) -> np.ndarray:
+    """
+    Computes the per-channel summed-area table of an image.
+
+    Args:
+        pixels: A float array of shape (H, W, C).
+
+    Returns:
+        A float64 array of shape (H+1, W+1, C), where entry (y, x) is the sum of all pixels above
+        and to the left of (y, x), exclusive.
+    """
+    height, width, channels = pixels.shape
+    integral = np.zeros((height + 1, width + 1, channels), np.float64)
+    np.cumsum(pixels, axis=0, dtype=np.float64, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+@tracing.timed("integrals")
+def integral_images(pixels: np.ndarray) -> tuple:
+    """Returns the summed-area tables of an image and of its squared pixels."""
+    return integral_image(pixels), integral_image(np.square(pixels))
+
+
+def window_sums(integral: np.ndarray, h: int, w: int) -> np.ndarray:
+    """
+    Computes the per-channel sum of every h x w window using a summed-area table.
+
+    Args:
+        integral: The summed-area table, as returned by integral_image().
+        h: The height of the window.
+        w: The width of the window.
+
+    Returns:
+        An array of shape (H-h+1, W-w+1, C), where entry (y, x) is the sum of the window with its
+        top-left corner at (x, y).
+    """
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+def sum_channels(array: np.ndarray) -> np.ndarray:
+    """
+    Sums an (H, W, C) array over its channels.
+
+    This is a matrix product with a vector of ones, which is several times faster than
+    array.sum(axis=2): NumPy reduces a short last axis one row at a time.
+    """
+    return array @ np.ones(array.shape[2], array.dtype)
+
+
+def plausible_windows(sums: np.ndarray, sq_sums: np.ndarray, template: "PreparedTemplate",
+                      max_difference: float = MAX_RMS_DIFFERENCE) -> np.ndarray:
+    """
+    Finds the windows whose statistics are close enough to the template's for them to match.
+
+    For any window, the mean squared difference from the template is at least the squared
+    difference of their means plus the squared difference of their standard deviations (per
+    channel). So windows where this lower bound already exceeds max_difference can be rejected
+    without correlating them.
+
+    Args:
+        sums: The per-channel sums of every window, as returned by window_sums().
+        sq_sums: The per-channel sums of squares of every window.
+        template: The (unmasked) template.
+        max_difference: The largest RMS color difference of a matching window.
+
+    Returns:
+        A boolean array of shape (H-h+1, W-w+1).
+    """
+    n = template.count
+    # In-place float32 arithmetic, since this has to be much cheaper than correlating
+    means = (sums / n).astype(np.float32)
+    stds = (sq_sums / n).astype(np.float32)
+    stds -= np.square(means)
+    np.sqrt(np.maximum(stds, 0, out=stds), out=stds)
+    stds -= template.std.astype(np.float32)
+    means -= template.mean.astype(np.float32)
+    bound = np.square(means, out=means) + np.square(stds, out=stds)
+    return sum_channels(bound) <= max_difference ** 2 * bound.shape[2]
+
+
+def fft_shape(image_shape: tuple) -> tuple:
+    """Returns the padded (height, width) used to correlate an image of the given shape via FFT."""
+    return cv2.getOptimalDFTSize(image_shape[0]), cv2.getOptimalDFTSize(image_shape[1])
+
+
+def choose_method(image_shape: tuple, template_shape: tuple,
+                  transforms: Optional[int] = None, correlations: int = 1) -> str:
+    """
+    Picks the cheapest correlation engine for the given image and template shapes.
+
+    The spatial engine costs one multiply-add per template pixel per window (up to a cap), while
+    each transform of the FFT engine costs O(N log N) in the padded image size regardless of the
+    template size.
+
+    Args:
+        image_shape: The shape of the image.
+        template_shape: The shape of the template.
+        transforms: The number of FFTs the frequency-domain engine needs. Defaults to one forward
+            FFT per image and template channel, plus one inverse FFT.
+        correlations: The number of multi-channel correlations the spatial engine needs.
+    """
+    height, width = image_shape[:2]
+    h, w = template_shape[:2]
+    if transforms is None:
+        channels = image_shape[2] if len(image_shape) > 2 else 1
+        transforms = 2 * channels + 1
+    spatial_cost = (correlations * (height - h + 1) * (width - w + 1)
+                    * min(h * w, SPATIAL_MAX_AREA))
+    fh, fw = fft_shape(image_shape)
+    fft_cost = FFT_COST_FACTOR * transforms * fh * fw * math.log2(fh * fw)
+    return SPATIAL if spatial_cost <= fft_cost else FFT
+
+
+# Guards the spectrum caches of prepared templates, which threads searching at once share
+_spectra_lock = threading.Lock()
+
+
+class PreparedTemplate:
+    """
+    A template with everything needed to correlate it precomputed.
+
+    Attributes:
+        pixels: A float32 array of shape (h, w, C).
+        mask: A float32 array of shape (h, w), where 1 marks the pixels that affect the score and 0
+            marks the ones that don't. None if every pixel counts.
+        count: The number of pixels that affect the score.
+        mean: The per-channel mean color of the template.
+        centered: The template with its mean subtracted, and zeroed outside of the mask.
+        variance: The sum of squared deviations from the mean, over all pixels and channels.
+        std: The per-channel standard deviation of the template.
+        flat: Whether the template is a single color, in which case ZNCC is undefined.
+    """
+
+    def __init__(self, pixels: np.ndarray, mask: Optional[np.ndarray] = None):
+        """
+        Prepares a template for correlation.
+
+        Args:
+            pixels: A float32 array of shape (h, w, C), as returned by to_float().
+            mask: An optional array of shape (h, w). Pixels where the mask is below 0.5 are ignored.
+        """
+        self.pixels = pixels
+        self.h, self.w = pixels.shape[:2]
+        self.mask = None
+        weights = 1
+        self.count = self.h * self.w
+        if mask is not None and not (mask >= 0.5).all():
+            self.mask = (mask >= 0.5).astype(np.float32)
+            weights = self.mask[:, :, np.newaxis]
+            self.count = max(1, int(self.mask.sum()))
+        self.mean = (pixels * weights).sum(axis=(0, 1)) / self.count
+        self.centered = ((pixels - self.mean) * weights).astype(np.float32)
+        self.variance = float(np.square(self.centered).sum())
+        self.std = np.sqrt(np.square(self.centered).sum(axis=(0, 1)) / self.count)
+        self.flat = self.variance <= FLAT_EPSILON * self.count
+        # Spectra by padded shape, least recently used first
+        self._spectra = {}
+
+    @property
+    def shape(self) -> tuple:
+        """The shape of the template's pixels."""
+        return self.pixels.shape
+
+    def has_spectrum(self, shape: tuple) -> bool:
+        """Returns whether the spectrum for the given padded shape is already computed."""
+        return shape in self._spectra
+
+    def spectrum(self, shape: tuple, cache: bool = True) -> np.ndarray:
+        """
+        Returns the spectrum of the centered template, zero-padded to the given shape.
+
+        Args:
+            shape: The padded shape.
+            cache: Whether to keep the spectrum for later calls. Spectra are as large as the image,
+                so they aren't kept when many templates are searched for at once.
+        """
+        metrics.record_cache("template_spectrum", shape in self._spectra)
+        return self._cached(shape, lambda: spectrum(self.centered, shape), cache)
+
+    def mask_spectrum(self, shape: tuple) -> np.ndarray:
+        """Returns the spectrum of the mask, zero-padded to the given shape."""
+        return self._cached(("mask", shape), lambda: spectrum(self.mask[:, :, np.newaxis], shape))
+
+    def _cached(self, key, compute: Callable[[], np.ndarray], cache: bool = True) -> np.ndarray:
+        """Returns a cached spectrum, computing it (and dropping the least recently used) if new."""
+        with _spectra_lock:
+            result = self._spectra.pop(key, None)
+            if result is not None:
+                # Put it back at the end, as the most recently used
+                self._spectra[key] = result
+                return result
+        result = compute()
+        if cache:
+            with _spectra_lock:
+                self._spectra[key] = result
+                while len(self._spectra) > MAX_CACHED_SPECTRA:
+                    del self._spectra[next(iter(self._spectra))]
+        return result
+
+
+def spectrum(pixels: np.ndarray, shape: tuple) -> np.ndarray:
+    """Returns the per-channel real FFT of an array of shape (h, w, C), zero-padded to shape."""
+    # Same as np.fft.rfft2(), but the row transforms are only done on the h nonzero rows
+    return np.fft.fft(np.fft.rfft(pixels, n=shape[1], axis=1), n=shape[0], axis=0)
+
+
+def correlate_spatial(image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    """
+    Computes the raw cross-correlation of every valid window with cv2.matchTemplate.
+
+    Args:
+        image: A float32 array of shape (H, W, C).
+        template: A float32 array of shape (h, w, C).
+
+    Returns:
+        A float array of shape (H-h+1, W-w+1), summed over channels.
+    """
+    return cv2.matchTemplate(image, template, cv2.TM_CCORR)
+
+
+def correlate_fft(image: np.ndarray, template: np.ndarray,
+                  template_spectrum: Optional[np.ndarray] = None,
+                  image_spectrum: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Computes the raw cross-correlation of every valid window in the frequency domain.
+
+    Channels are multiplied and summed in the frequency domain, so only one inverse FFT is needed.
+
+    Args:
+        image: A float32 array of shape (H, W, C).
+        template: A float32 array of shape (h, w, C).
+        template_spectrum: The template's spectrum, padded to fft_shape() of the image. Computed if
+            not given.
+        image_spectrum: The image's spectrum, padded to fft_shape() of the image. Computed if not
+            given.
+
+    Returns:
+        A float array of shape (H-h+1, W-w+1), summed over channels.
+    """
+    height, width = image.shape[:2]
+    h, w = template.shape[:2]
+    shape = fft_shape(image.shape)
+    if template_spectrum is None:
+        template_spectrum = spectrum(template, shape)
+    if image_spectrum is None:
+        image_spectrum = spectrum(image, shape)
+    product = (image_spectrum * np.conj(template_spectrum)).sum(axis=2)
+    correlation = np.fft.irfft2(product, s=shape)
+    return correlation[:height - h + 1, :width - w + 1]
+
+
+def _correlate_fft_batch(image_spectrum: np.ndarray, templates: list, shape: tuple,
+                         valid_shape: tuple) -> Iterator[np.ndarray]:
+    """Yields the raw cross-correlation of each template, doing the inverse FFTs in batches."""
+    batch = max(1, BATCH_MEMORY // (shape[0] * shape[1] * 8))
+    for i in range(0, len(templates), batch):
+        products = np.stack([np.einsum("yxc,yxc->yx", image_spectrum,
+                                       np.conj(template.spectrum(shape, False)))
+                             for template in templates[i:i + batch]])
+        correlations = np.fft.irfft2(products, s=shape, axes=(1, 2))
+        yield from correlations[:, :valid_shape[0], :valid_shape[1]]
+
+
+def _masked_sums(image: np.ndarray, template: "PreparedTemplate", method: str,
+                 spectra: dict) -> tuple:
+    """
+    Returns the per-channel masked sums and squared sums of every window of an image.
+
+    In the frequency domain, these are the image's (and squared image's) spectra times the
+    conjugate of the mask's spectrum, so every channel shares one mask transform and the image
+    transforms are cached with the image's other spectra.
+    """
+    if method == SPATIAL:
+        mask = template.mask
+        sums = [correlate_spatial(image[:, :, c], mask) for c in range(image.shape[2])]
+        sq_sums = [correlate_spatial(np.square(image[:, :, c]), mask)
+                   for c in range(image.shape[2])]
+        return np.stack(sums, axis=2), np.stack(sq_sums, axis=2)
+    height, width = image.shape[:2]
+    shape = fft_shape(image.shape)
+    if shape not in spectra:
+        spectra[shape] = spectrum(image, shape)
+    squared = ("squared", shape)
+    if squared not in spectra:
+        spectra[squared] = spectrum(np.square(image), shape)
+    mask_spectrum = np.conj(template.mask_spectrum(shape))
+    valid = (slice(0, height - template.h + 1), slice(0, width - template.w + 1))
+    sums = np.fft.irfft2(spectra[shape] * mask_spectrum, s=shape, axes=(0, 1))[valid]
+    sq_sums = np.fft.irfft2(spectra[squared] * mask_spectrum, s=shape, axes=(0, 1))[valid]
+    return sums, sq_sums
+
+
+@tracing.timed("correlate")
+def match_template(image: np.ndarray, template, method: str = AUTO,
+                   integrals: Optional[tuple] = None, max_difference: Optional[float] = None,
+                   spectra: Optional[dict] = None) -> np.ndarray:
+    """
+    Computes the normalized cross-correlation score of every valid template position.
+
+    Textured templates are scored with ZNCC, which is invariant to brightness and contrast. ZNCC is
+    undefined for flat (single color) templates, so those are instead scored as 1 minus the RMS
+    color difference. Either way, a score of 1 is a perfect match. Pixels outside of the template's
+    mask (if it has one) don't affect the score.
+
+    If max_difference is given, windows whose mean and standard deviation show that their colors
+    differ too much from the template's are scored 0 without being correlated (see
+    plausible_windows()), and if no window is left, nothing is correlated at all. This can save
+    most of the work, but the scores are then no longer invariant to brightness and contrast: a
+    darker or lower contrast copy of the template scores 0 instead of 1.
+
+    Args:
+        image: A float32 array of shape (H, W, C), as returned by to_float().
+        template: The template, either as a PreparedTemplate or as a float32 array of shape
+            (h, w, C), as returned by to_float().
+        method: The correlation engine to use (one of METHODS).
+        integrals: The image's summed-area tables, as returned by integral_images(). Computed if
+            not given.
+        max_difference: The largest RMS color difference of a matching window (MAX_RMS_DIFFERENCE
+            is a reasonable value), or None to correlate every window. Ignored for masked and
+            small templates.
+        spectra: A cache of the image's FFT spectra, keyed by padded shape, shared between calls
+            with the same image. Spectra are added to it as needed.
+
+    Returns:
+        A float32 array of shape (H-h+1, W-w+1). Empty if the template is larger than the image.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid method: {method}")
+    if not isinstance(template, PreparedTemplate):
+        template = PreparedTemplate(template)
+    height, width, channels = image.shape
+    h, w, n = template.h, template.w, template.count
+    if h > height or w > width:
+        return np.zeros((0, 0), np.float32)
+
+    if spectra is None:
+        spectra = {}
+    # Window statistics, from integral images or (for masked templates) mask correlations
+    if template.mask is not None:
+        if method == AUTO:
+            # Besides the numerator, the masked sums and squared sums of each channel
+            shape = fft_shape(image.shape)
+            transforms = (2 * channels + 1 + (0 if template.has_spectrum(shape) else channels + 1)
+                          + (0 if shape in spectra else 2 * channels))
+            method = choose_method(image.shape, template.shape, transforms, correlations=3)
+        sums, sq_sums = _masked_sums(image, template, method, spectra)
+    else:
+        if integrals is None:
+            integrals = integral_images(image)
+        sums = window_sums(integrals[0], h, w)
+        sq_sums = window_sums(integrals[1], h, w)
+
+    mean = template.mean
+    if template.flat:
+        # Flat template: sum of squared differences, expanded in terms of window sums
+        metrics.CORRELATIONS.inc("flat")
+        ssd = sum_channels(sq_sums - 2 * mean * sums + n * np.square(mean))
+        return (1 - np.sqrt(np.maximum(ssd, 0) / (n * channels))).astype(np.float32)
+
+    scores = np.zeros(sums.shape[:2], np.float32)
+    if max_difference is not None and template.mask is None and n >= PREFILTER_MIN_AREA:
+        plausible = plausible_windows(sums, sq_sums, template, max_difference)
+        if not plausible.any():
+            metrics.CORRELATIONS.inc("rejected")
+            return scores
+    else:
+        plausible = True
+    window_var = sum_channels(sq_sums - np.square(sums) / n)
+    textured = (window_var > FLAT_EPSILON * n) & plausible
+    ys, xs = np.nonzero(textured)
+    if len(ys) == 0:
+        metrics.CORRELATIONS.inc("rejected")
+        return scores
+
+    # Only correlate the region that holds every remaining window, if that saves enough work.
+    # Masked templates have already transformed the whole image for their window statistics.
+    y1, y2, x1, x2 = 0, scores.shape[0], 0, scores.shape[1]
+    if (template.mask is None and
+            (ys.max() - ys.min() + 1) * (xs.max() - xs.min() + 1) < CROP_FRACTION * scores.size):
+        y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        image = image[y1:y2 + h - 1, x1:x2 + w - 1]
+        # The cached spectra are of the whole image
+        spectra = {}
+    shape = fft_shape(image.shape)
+    if method == AUTO:
+        transforms = (1 + (0 if template.has_spectrum(shape) else channels)
+                      + (0 if shape in spectra else channels))
+        method = choose_method(image.shape, template.shape, transforms)
+    metrics.CORRELATIONS.inc(method)
+    if method == SPATIAL:
+        numerator = correlate_spatial(image, template.centered)
+    else:
+        metrics.record_cache("image_spectrum", shape in spectra)
+        if shape not in spectra:
+            spectra[shape] = spectrum(image, shape)
+        numerator = correlate_fft(image, template.centered, template.spectrum(shape),
+                                  spectra[shape])
+
+    region = textured[y1:y2, x1:x2]
+    scores[y1:y2, x1:x2][region] = (numerator[region]
+                                    / np.sqrt(window_var[y1:y2, x1:x2][region] * template.variance))
+    return np.clip(scores, -1, 1)
+
+
+@tracing.timed("batch")
+def match_templates(image: np.ndarray, templates: list, method: str = AUTO,
+                    integrals: Optional[tuple] = None, max_difference: Optional[float] = None,
+                    spectra: Optional[dict] = None) -> list:
+    """
+    Computes the score maps of several templates of the same size at once.
+
+    Scores are the same as match_template()'s, but the window statistics are only computed once
+    for all templates, and in the frequency domain, the image is only transformed once and the
+    inverse FFTs are done in batches. Masked and flat templates are scored one by one.
+
+    Args:
+        image: A float32 array of shape (H, W, C), as returned by to_float().
+        templates: The templates, either as PreparedTemplates or as float32 arrays of shape
+            (h, w, C). All of them must have the same shape.
+        method: The correlation engine to use (one of METHODS).
+        integrals: The image's summed-area tables, as returned by integral_images(). Computed if
+            not given.
+        max_difference: The largest RMS color difference of a matching window, or None to
+            correlate every window. See match_template().
+        spectra: A cache of the image's FFT spectra, as accepted by match_template().
+
+    Returns:
+        A list of float32 arrays of shape (H-h+1, W-w+1), in the order of the templates.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid method: {method}")
+    templates = [template if isinstance(template, PreparedTemplate) else PreparedTemplate(template)
+                 for template in templates]
+    if len({template.shape for template in templates}) > 1:
+        raise ValueError("Templates must all have the same shape")
+    if spectra is None:
+        spectra = {}
+    scores = [None] * len(templates)
+    batched = []
+    for i, template in enumerate(templates):
+        if template.mask is None and not template.flat:
+            batched.append(i)
+        else:
+            scores[i] = match_template(image, template, method, integrals, max_difference, spectra)
+    if not batched:
+        return scores
+    height, width, channels = image.shape
+    h, w = templates[batched[0]].h, templates[batched[0]].w
+    if h > height or w > width:
+        for i in batched:
+            scores[i] = np.zeros((0, 0), np.float32)
+        return scores
+
+    # Window statistics, shared by every template
+    if integrals is None:
+        integrals = integral_images(image)
+    sums = window_sums(integrals[0], h, w)
+    sq_sums = window_sums(integrals[1], h, w)
+    n = h * w
+    window_var = sum_channels(sq_sums - np.square(sums) / n)
+    textured = window_var > FLAT_EPSILON * n
+    prefilter = max_difference is not None and n >= PREFILTER_MIN_AREA
+    if prefilter:
+        # The bound of plausible_windows(), expanded so that the part that only depends on the
+        # windows is computed once: |s - t|^2 = |s|^2 - 2 s.t + |t|^2, where s stacks the means
+        # and standard deviations of a window, and t those of a template
+        stats = np.concatenate([(sums / n).astype(np.float32), np.zeros_like(sums, np.float32)],
+                               axis=2)
+        stds = stats[:, :, channels:]
+        stds[:] = sq_sums / n
+        stds -= np.square(stats[:, :, :channels])
+        np.sqrt(np.maximum(stds, 0, out=stds), out=stds)
+        norms = sum_channels(np.square(stats))
+        limit = max_difference ** 2 * channels
+    group = []
+    for i in batched:
+        windows = textured
+        if prefilter:
+            target = np.concatenate([templates[i].mean, templates[i].std]).astype(np.float32)
+            windows = textured & (norms - 2 * (stats @ target) <= limit - target @ target)
+        if windows.any():
+            group.append((i, windows))
+        else:
+            metrics.CORRELATIONS.inc("rejected")
+            scores[i] = np.zeros(window_var.shape, np.float32)
+    if not group:
+        return scores
+
+    shape = fft_shape(image.shape)
+    if method == AUTO:
+        uncached = sum(not templates[i].has_spectrum(shape) for i, _ in group)
+        transforms = len(group) + channels * uncached + (0 if shape in spectra else channels)
+        method = choose_method(image.shape, (h, w), transforms, correlations=len(group))
+    metrics.CORRELATIONS.inc(method, amount=len(group))
+    if method == SPATIAL:
+        numerators = (correlate_spatial(image, templates[i].centered) for i, _ in group)
+    else:
+        metrics.record_cache("image_spectrum", shape in spectra)
+        if shape not in spectra:
+            spectra[shape] = spectrum(image, shape)
+        numerators = _correlate_fft_batch(spectra[shape], [templates[i] for i, _ in group], shape,
+                                          window_var.shape)
+    for (i, windows), numerator in zip(group, numerators):
+        result = np.zeros(window_var.shape, np.float32)
+        result[windows] = (numerator[windows]
+                           / np.sqrt(window_var[windows] * templates[i].variance))
+        scores[i] = np.clip(result, -1, 1)
+    return scores
+
+
+def best_candidate(scores: np.ndarray, h: int, w: int, scale: float = 1.0) -> Optional[Candidate]:
+    """Returns the highest scoring position in a score map, or None if the map is empty."""
+    if scores.size == 0:
+        return None
+    y, x = np.unravel_index(np.argmax(scores), scores.shape)
+    return Candidate(float(scores[y, x]), int(x), int(y), w, h, scale)
+
+
+def pick_best(candidates: list) -> Optional[Candidate]:
+    """
+    Picks the best of several candidates, or None if there are none.
+
+    The highest score wins, except that a larger candidate which contains it and is tied with it
+    (within SCORE_TOLERANCE) wins instead. This matters for flat templates, where any smaller scale
+    of the template also fits inside the matched region. Larger candidates elsewhere in the image
+    need a higher score, like any other candidate.
+    """
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda candidate: candidate.score)
+    containing = [candidate for candidate in candidates
+                  if candidate.score >= best.score - SCORE_TOLERANCE and _contains(candidate, best)]
+    return max(containing, key=lambda candidate: (candidate.w * candidate.h, candidate.score))
+
+
+def _contains(outer: Candidate, inner: Candidate) -> bool:
+    """Returns whether one candidate's box covers most of another's."""
+    w = min(outer.x + outer.w, inner.x + inner.w) - max(outer.x, inner.x)
+    h = min(outer.y + outer.h, inner.y + inner.h) - max(outer.y, inner.y)
+    return w > 0 and h > 0 and w * h >= 0.5 * inner.w * inner.h
@@ -0,0 +1,165 @@
+"""
+Exact (pixel-perfect) template matching with a 2D rolling hash.
+
+Every h x w window of the image is hashed Rabin-Karp style: first each row of w pixels, then each
+column of h row hashes. Both passes are computed for all windows at once from prefix sums, so
+hashing takes linear time in the size of the image. Only windows whose hash equals the template's
+hash are compared pixel by pixel.
+
+Templates with transparent pixels can't be hashed, since those pixels match anything. Instead, the
+sum of squared differences over the opaque pixels of every window is computed with FFTs, and only
+windows where it is (up to rounding) zero are compared pixel by pixel.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+from typing import Optional
+
+import numpy as np
+
+from . import correlation, tracing
+
+# Prime modulus of the hashes. Products of two hashes must fit in 63 bits.
+MODULUS = 2 ** 31 - 1
+# Hash bases for the row and column passes
+ROW_BASE = 1_000_003
+COLUMN_BASE = 998_244_353 % MODULUS
+# Number of pixels compared at once when verifying hash hits
+VERIFY_CHUNK_PIXELS = 1 << 22
+# Largest masked sum of squared differences of a window that is verified, to absorb FFT rounding
+MASKED_TOLERANCE = 0.5
+
+
+def _as_channels(pixels: np.ndarray) -> np.ndarray:
+    """Returns uint8 pixels with a channel axis."""
+    return pixels[:, :, np.newaxis] if pixels.ndim == 2 else pixels
+
+
+def _pack(pixels: np.ndarray) -> np.ndarray:
+    """Packs the (up to 4) uint8 channels of every pixel into one integer below the modulus."""
+    packed = np.zeros(pixels.shape[:2], np.int64)
+    for channel in range(pixels.shape[2]):
+        packed |= pixels[:, :, channel].astype(np.int64) << (8 * channel)
+    return packed % MODULUS
+
+
+def _powers(base: int, count: int) -> np.ndarray:
+    """Returns base ** i % MODULUS for i in [0, count)."""
+    powers = np.ones(count, np.int64)
+    for i in range(1, count):
+        powers[i] = powers[i - 1] * base % MODULUS
+    return powers
+
+
+def _rolling_hashes(values: np.ndarray, length: int, base: int) -> np.ndarray:
+    """
+    Hashes every run of `length` consecutive values along the last axis.
+
+    The hash of run [x, x + length) is sum(values[x + j] * base ** (length - 1 - j)) mod MODULUS.
+    Values are first divided by base ** x (as a modular inverse), so that the hash of every run is a
+    difference of two prefix sums, scaled back by base ** (x + length - 1).
+
+    Args:
+        values: An int64 array with values below MODULUS. At most 2 ** 32 values per run of the
+            last axis, so the prefix sums can't overflow.
+        length: The length of a run.
+        base: The hash base.
+
+    Returns:
+        An int64 array with the last axis shortened to (size - length + 1).
+    """
+    size = values.shape[-1]
+    inverse_powers = _powers(pow(base, -1, MODULUS), size)
+    prefix = np.zeros(values.shape[:-1] + (size + 1,), np.int64)
+    np.cumsum(values * inverse_powers % MODULUS, axis=-1, out=prefix[..., 1:])
+    prefix %= MODULUS
+    runs = (prefix[..., length:] - prefix[..., :-length]) % MODULUS
+    return runs * _powers(base, size)[length - 1:] % MODULUS
+
+
+def window_hashes(pixels: np.ndarray, h: int, w: int) -> np.ndarray:
+    """
+    Computes the hash of every h x w window of an image.
+
+    Args:
+        pixels: A uint8 array of shape (H, W) or (H, W, C), with at most 4 channels.
+        h: The height of a window.
+        w: The width of a window.
+
+    Returns:
+        An int64 array of shape (H - h + 1, W - w + 1).
+    """
+    rows = _rolling_hashes(_pack(_as_channels(pixels)), w, ROW_BASE)
+    return _rolling_hashes(rows.T, h, COLUMN_BASE).T
+
+
+def masked_differences(image: np.ndarray, template: np.ndarray, opaque: np.ndarray) -> np.ndarray:
+    """
+    Computes the sum of squared differences over the opaque template pixels of every window.
+
+    The sum is expanded as sum(m * I^2) - 2 * sum(m * T * I) + sum(m * T^2), where m is the mask,
+    and both correlations are done for all channels at once in the frequency domain.
+
+    Args:
+        image: A uint8 array of shape (H, W, C).
+        template: A uint8 array of shape (h, w, C).
+        opaque: A boolean array of shape (h, w), marking the pixels that count.
+
+    Returns:
+        A float64 array of shape (H - h + 1, W - w + 1).
+    """
+    height, width = image.shape[:2]
+    h, w = opaque.shape
+    shape = correlation.fft_shape(image.shape)
+    weights = opaque.astype(np.float64)
+    image = image.astype(np.float64)
+    template = template * weights[:, :, np.newaxis]
+    image_spectrum = np.fft.rfft2(image, s=shape, axes=(0, 1))
+    squared_spectrum = np.fft.rfft2(np.square(image), s=shape, axes=(0, 1))
+    mask_spectrum = np.conj(np.fft.rfft2(weights, s=shape))[:, :, np.newaxis]
+    template_spectrum = np.conj(np.fft.rfft2(template, s=shape, axes=(0, 1)))
+    total = (squared_spectrum * mask_spectrum - 2 * image_spectrum * template_spectrum).sum(axis=2)
+    differences = np.fft.irfft2(total, s=shape)[:height - h + 1, :width - w + 1]
+    return differences + np.square(template).sum()
+
+
+@tracing.timed("exact")
+def match_exact(image: np.ndarray, template: np.ndarray,
+                mask: Optional[np.ndarray] = None, hashes: Optional[np.ndarray] = None) -> tuple:
+    """
+    Finds every position where the template appears in the image, pixel for pixel.
+
+    Args:
+        image: The uint8 image to search in, of shape (H, W) or (H, W, C).
+        template: The uint8 template, of shape (h, w) or (h, w, C).
+        mask: An optional array of shape (h, w). Template pixels where the mask is below 0.5 match
+            any image pixel.
+        hashes: The image's window hashes for the template's size, as returned by window_hashes(),
+            to share them between templates of the same size. Computed if not given.
+
+    Returns:
+        The (ys, xs) of the top-left corners of all exact matches, in row-major order.
+    """
+    image, template = _as_channels(image), _as_channels(template)
+    h, w, channels = template.shape
+    empty = np.zeros(0, np.intp)
+    if channels != image.shape[2] or h > image.shape[0] or w > image.shape[1]:
+        return empty, empty
+    opaque = None if mask is None or (mask >= 0.5).all() else mask >= 0.5
+    if opaque is None:
+        target = window_hashes(template, h, w)[0, 0]
+        if hashes is None:
+            hashes = window_hashes(image, h, w)
+        ys, xs = np.nonzero(hashes == target)
+    else:
+        ys, xs = np.nonzero(masked_differences(image, template, opaque) <= MASKED_TOLERANCE)
+    # Verify the candidates, a chunk at a time
+    windows = np.lib.stride_tricks.sliding_window_view(image, (h, w, channels))[:, :, 0]
+    chunk = max(1, VERIFY_CHUNK_PIXELS // template.size)
+    ignored = False if opaque is None else ~opaque[:, :, np.newaxis]
+    verified = np.concatenate([
+        np.all((windows[ys[i:i + chunk], xs[i:i + chunk]] == template) | ignored, axis=(1, 2, 3))
+        for i in range(0, len(ys), chunk)
+    ]) if len(ys) else np.zeros(0, bool)
+    return ys[verified], xs[verified]
@@ -0,0 +1,204 @@
+"""
+Feature-based search for scaled, rotated and mirrored templates.
+
+Exhaustively correlating every scale and angle of a template gets expensive on large images. When
+the template has enough texture, ORB keypoints are much cheaper: their descriptors are extracted
+from the template once, at compile time, and indexed for approximate nearest neighbour search (LSH,
+since ORB descriptors are binary). Each image's keypoints are matched against the index, and the
+similarity transform (scale, rotation and translation) that places the template is estimated from
+the matches with RANSAC. A single correlation around the estimated position then verifies it.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import math
+import threading
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from . import correlation, fourier_mellin, pyramid, tracing, transforms
+from .correlation import Candidate
+from .image import BGR, Image
+
+# Maximum number of keypoints extracted from a template and from an image
+MAX_TEMPLATE_FEATURES = 1000
+MAX_IMAGE_FEATURES = 5000
+# Size of the patch an ORB descriptor is computed from (and the border without keypoints)
+PATCH_SIZE = 15
+# Parameters of the LSH index of template descriptors (FLANN's algorithm number 6)
+FLANN_INDEX_LSH = 6
+LSH_TABLES = 6
+LSH_KEY_SIZE = 12
+LSH_PROBE_LEVEL = 1
+# Ratio between the distances of the nearest and second nearest template descriptors of a match
+MAX_DISTANCE_RATIO = 0.8
+# Minimum number of matches consistent with the estimated transform
+MIN_INLIERS = 6
+# Maximum distance (in pixels) between a matched keypoint and where the transform puts it
+RANSAC_THRESHOLD = 3.0
+# Maximum difference (in degrees) between the estimated angle and a compiled angle
+ANGLE_TOLERANCE = 10.0
+# Extra margin (in pixels) around the estimated position when verifying it
+VERIFY_MARGIN = 4
+# Score at which a verified match is accepted without correlation-based search
+ACCEPT_THRESHOLD = 0.9
+
+
+def _orb(max_features: int) -> cv2.ORB:
+    """Returns an ORB detector. Detectors aren't thread-safe, so each call makes a new one."""
+    return cv2.ORB_create(max_features, edgeThreshold=PATCH_SIZE, patchSize=PATCH_SIZE)
+
+
+def detect(pixels: np.ndarray, max_features: int, mask: Optional[np.ndarray] = None) -> tuple:
+    """
+    Extracts ORB keypoints and descriptors.
+
+    Args:
+        pixels: A uint8 array of shape (H, W, 3) in BGR order.
+        max_features: The maximum number of keypoints.
+        mask: An optional array of shape (H, W). Keypoints are only extracted where it is at least
+            0.5.
+
+    Returns:
+        The (x, y) positions of the keypoints as a float32 array of shape (N, 2), and their
+        descriptors as a uint8 array of shape (N, 32) (or None if there are no keypoints).
+    """
+    gray = cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_BGR2GRAY)
+    if mask is not None:
+        mask = (mask >= 0.5).astype(np.uint8)
+    keypoints, descriptors = _orb(max_features).detectAndCompute(gray, mask)
+    points = np.array([keypoint.pt for keypoint in keypoints], np.float32).reshape(-1, 2)
+    return points, descriptors
+
+
+class FeatureTemplate:
+    """The keypoints of a template (and of its mirror image), indexed for matching."""
+
+    def __init__(self, template: Image, flips: bool = False):
+        """
+        Args:
+            template: The template.
+            flips: Whether to also match the mirrored template.
+        """
+        colors, mask = template.colors(BGR), template.mask
+        self.h, self.w = colors.shape[:2]
+        # Resized copies of the template (and its mirror image), for verification
+        self.templates = [pyramid.ScaledTemplates(template.pixels, mask)]
+        self.points, self.descriptors = [], []
+        for flipped in (False, True) if flips else (False,):
+            if flipped:
+                colors = np.flip(colors, axis=1)
+                mask = None if mask is None else np.ascontiguousarray(np.flip(mask, axis=1))
+                self.templates.append(pyramid.ScaledTemplates(
+                    np.ascontiguousarray(np.flip(template.pixels, axis=1)), mask))
+            points, descriptors = detect(colors, MAX_TEMPLATE_FEATURES, mask)
+            self.points.append(points)
+            self.descriptors.append(np.zeros((0, 32), np.uint8) if descriptors is None
+                                    else descriptors)
+        self._matcher = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # The index and lock can't be pickled, and are rebuilt when needed
+        state = self.__dict__.copy()
+        state["_matcher"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def matcher(self) -> cv2.FlannBasedMatcher:
+        """The LSH index of the template's descriptors, built on first use."""
+        with self._lock:
+            if self._matcher is None:
+                index = dict(algorithm=FLANN_INDEX_LSH, table_number=LSH_TABLES,
+                             key_size=LSH_KEY_SIZE, multi_probe_level=LSH_PROBE_LEVEL)
+                matcher = cv2.FlannBasedMatcher(index, {})
+                matcher.add(self.descriptors)
+                matcher.train()
+                self._matcher = matcher
+            return self._matcher
+
+    def _matches(self, descriptors: np.ndarray) -> list:
+        """Returns the (image index, template index) pairs of good matches, per variant."""
+        matches = [[] for _ in self.descriptors]
+        for i, neighbours in enumerate(self.matcher.knnMatch(descriptors, k=2)):
+            if not neighbours:
+                continue
+            nearest = neighbours[0]
+            ambiguous = len(neighbours) > 1 and (nearest.distance
+                                                 > MAX_DISTANCE_RATIO * neighbours[1].distance)
+            if ambiguous:
+                continue
+            matches[nearest.imgIdx].append((i, nearest.trainIdx))
+        return matches
+
+    def _verify(self, image: Image, index: int, matrix: np.ndarray, scale: float, angle: float,
+                method: str) -> Optional[Candidate]:
+        """Correlates the transformed template around where the estimated transform puts it."""
+        h, w = max(1, round(self.h * scale)), max(1, round(self.w * scale))
+        if min(h, w) < pyramid.MIN_SCALED_SIZE:
+            return None
+        sized = self.templates[index].sized(h, w)
+        pixels, mask = transforms.rotate(sized.pixels, sized.mask, angle)
+        cx, cy = matrix @ np.array([self.w / 2, self.h / 2, 1])
+        candidate = fourier_mellin.verify(image.pyramid, correlation.PreparedTemplate(pixels, mask),
+                                          round(cx), round(cy), VERIFY_MARGIN, method)
+        if candidate is None:
+            return None
+        return candidate._replace(scale=scale, angle=angle, flipped=index == 1)
+
+    @tracing.timed("features")
+    def search(self, image: Image, scales: Optional[tuple] = None, angles: Optional[tuple] = None,
+               method: str = correlation.AUTO) -> Optional[Candidate]:
+        """
+        Finds the template by matching keypoints.
+
+        Args:
+            image: The image to search in.
+            scales: The (min_scale, max_scale) range of template scales to accept, or None to only
+                accept the template at its original size.
+            angles: The rotations of the template to accept, in degrees, or None to accept any.
+            method: The correlation engine to use for verification.
+
+        Returns:
+            The best verified candidate, or None if no transform could be estimated.
+        """
+        points, descriptors = image.derived(
+            "features", lambda: detect(image.colors(BGR), MAX_IMAGE_FEATURES))
+        if descriptors is None or not any(len(d) for d in self.descriptors):
+            return None
+        candidates = []
+        for index, pairs in enumerate(self._matches(descriptors)):
+            tracing.count("feature matches", len(pairs))
+            if len(pairs) < MIN_INLIERS:
+                continue
+            image_indices, template_indices = np.array(pairs).T
+            matrix, inliers = cv2.estimateAffinePartial2D(
+                self.points[index][template_indices], points[image_indices], method=cv2.RANSAC,
+                ransacReprojThreshold=RANSAC_THRESHOLD)
+            if matrix is None or inliers.sum() < MIN_INLIERS:
+                continue
+            # The y-axis points down, so a counterclockwise rotation has a negative sine
+            scale = math.hypot(matrix[0, 0], matrix[1, 0])
+            angle = math.degrees(math.atan2(-matrix[1, 0], matrix[0, 0])) % 360
+            if scales is None:
+                scale = 1.0
+            elif not scales[0] <= scale <= scales[1]:
+                continue
+            if angles is not None:
+                # Snap to the nearest compiled angle
+                nearest = min(angles, key=lambda a: abs((a - angle + 180) % 360 - 180))
+                if abs((nearest - angle + 180) % 360 - 180) > ANGLE_TOLERANCE:
+                    continue
+                angle = nearest
+            candidate = self._verify(image, index, matrix, scale, angle, method)
+            if candidate is not None:
+                candidates.append(candidate)
+        return correlation.pick_best(candidates)
@@ -0,0 +1,71 @@
+"""
+Atomic file writes.
+
+Files are written to a temporary file in the same directory, which then replaces them, so that
+readers (like metrics scrapers, or processes loading a template store entry) never see a partially
+written file.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import contextlib
+import os
+import tempfile
+from typing import Iterator, Optional, Union
+
+
+@contextlib.contextmanager
+def replace_atomically(path: Union[str, os.PathLike], mode: str = "wb") -> Iterator:
+    """
+    Opens a temporary file to write, which replaces the file at path once closed.
+
+    The file gets the usual permissions of new files (0o666 minus the umask). If writing or
+    replacing fails, the temporary file is removed, and the file at path is left as it was.
+
+    Args:
+        path: The file to replace.
+        mode: The mode to open the temporary file in ("w" or "wb").
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file = tempfile.NamedTemporaryFile(mode, dir=directory, delete=False)
+    try:
+        with file:
+            yield file
+        # Temporary files are only readable by their owner, unlike the file they replace
+        os.chmod(file.name, 0o666 & ~umask())
+        os.replace(file.name, path)
+    except BaseException:
+        os.unlink(file.name)
+        raise
+
+
+def _proc_umask() -> Optional[int]:
+    """Reads the umask from /proc (on Linux), returning None if it isn't there."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    return None
+
+
+def _set_umask() -> int:
+    """Reads the umask by setting it, which changes it for every thread in the meantime."""
+    # Restrictive meanwhile, so that files created by other threads aren't more accessible
+    mask = os.umask(0o077)
+    os.umask(mask)
+    return mask
+
+
+# Setting the umask to read it races with other threads creating files, so where it can't be read
+# from /proc, it's only set once, at import
+_import_umask = _set_umask() if _proc_umask() is None else None
+
+
+def umask() -> int:
+    """Returns the process's umask (or, where it can't be read from /proc, its umask at import)."""
+    mask = _proc_umask()
+    return _import_umask if mask is None else mask
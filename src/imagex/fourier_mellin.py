@@ -0,0 +1,311 @@
+"""
+Rotation and scale estimation with the Fourier-Mellin transform.
+
+The magnitude of an image's Fourier spectrum doesn't depend on where the image is, and rotating or
+scaling the image rotates or (inversely) scales its spectrum. In log-polar coordinates, both become
+plain shifts, which phase correlation recovers in one shot. So instead of correlating every angle
+and scale of the template against the image, each candidate region only needs one log-polar phase
+correlation, followed by a verification correlation for the few strongest (angle, scale) estimates.
+
+Candidate regions are picked with a rotation-invariant statistic: the mean color inside a disc
+inscribed in the template, compared against the mean color of a disc around every image pixel.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import math
+import threading
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from . import correlation, peaks, pyramid, tracing, transforms
+from .correlation import Candidate, PreparedTemplate
+
+# Side length of the log-polar spectra
+SPECTRUM_SIZE = 64
+# Ratio between consecutive scales whose candidate regions are searched (the transform estimates
+# the remaining scale difference)
+SCALE_BAND = 1.5
+# Minimum radius (in pixels) of the disc used to pick candidate regions, on a pyramid level
+MIN_DISC_RADIUS = 4
+# Number of candidate regions per scale band
+MAX_REGIONS = 5
+# Maximum overlap between the discs of two candidate regions
+REGION_OVERLAP = 0.25
+# Number of (angle, scale) estimates per candidate region
+MAX_ESTIMATES = 5
+# Number of estimates verified (each at two angles) per scale band, strongest first among those of
+# every candidate region
+MAX_VERIFIED = 15
+# Number of times the best verified estimate of a region is refined, halving the step each time
+REFINE_ITERATIONS = 3
+# Extra margin around a candidate region when verifying an estimate, relative to the radius of the
+# scaled template's inscribed disc (the disc statistics only roughly locate the template)
+VERIFY_MARGIN = 0.5
+# Extra margin (in pixels) around a verified match when refining it
+REFINE_MARGIN = 2
+# Regions with a lower standard deviation than this are flat, so the transform can't be estimated
+FLAT_STD = 1e-3
+# Number of transformed templates kept per template (the least recently used are dropped)
+MAX_TRANSFORMED = 16
+
+# Radius bins of the log-polar transform per unit of natural log of the radius
+_LOG_BASE = SPECTRUM_SIZE / math.log(SPECTRUM_SIZE / 2)
+# Window that fades out towards the edge of the inscribed disc, so only rotation-invariant content
+# is compared
+_RADII = np.hypot(*np.meshgrid(*[np.linspace(-1, 1, SPECTRUM_SIZE)] * 2))
+_WINDOW = np.where(_RADII < 1, (1 + np.cos(np.pi * np.minimum(_RADII, 1))) / 2, 0)
+# High-pass filter that suppresses the (uninformative) low frequencies around the spectrum's center
+_EMPHASIS = np.cos(np.pi * np.linspace(-0.5, 0.5, SPECTRUM_SIZE))
+_HIGH_PASS = ((1 - np.outer(_EMPHASIS, _EMPHASIS)) * (2 - np.outer(_EMPHASIS, _EMPHASIS)))
+# Guards the caches of transformed templates (a lock per template couldn't be pickled)
+_transformed_lock = threading.Lock()
+
+
+def log_polar_spectrum(patch: np.ndarray) -> np.ndarray:
+    """
+    Computes the spectrum of the log-polar Fourier magnitude of the disc inscribed in a patch.
+
+    Args:
+        patch: A float32 array of shape (S, S, C).
+
+    Returns:
+        A complex array of shape (SPECTRUM_SIZE, SPECTRUM_SIZE), ready for phase correlation.
+    """
+    gray = transforms.resize(patch.mean(axis=2, keepdims=True), SPECTRUM_SIZE, SPECTRUM_SIZE)
+    gray = gray[:, :, 0]
+    gray = (gray - gray[_RADII < 1].mean()) * _WINDOW
+    magnitude = (np.abs(np.fft.fftshift(np.fft.fft2(gray))) * _HIGH_PASS).astype(np.float32)
+    center = SPECTRUM_SIZE / 2
+    log_polar = cv2.warpPolar(magnitude, (SPECTRUM_SIZE, SPECTRUM_SIZE), (center, center), center,
+                              cv2.WARP_POLAR_LOG | cv2.INTER_LINEAR)
+    return np.fft.fft2(log_polar)
+
+
+def _subpixel_offset(surface: np.ndarray, ys: np.ndarray, xs: np.ndarray,
+                     axis: int) -> np.ndarray:
+    """Refines peak positions along one axis by fitting a parabola through their neighbours."""
+    step = np.array([1, 0]) if axis == 0 else np.array([0, 1])
+    size = SPECTRUM_SIZE
+    before = surface[(ys - step[0]) % size, (xs - step[1]) % size]
+    after = surface[(ys + step[0]) % size, (xs + step[1]) % size]
+    curvature = before - 2 * surface[ys, xs] + after
+    peaked = curvature < 0
+    offset = np.where(peaked, (before - after) / (2 * np.where(peaked, curvature, -1)), 0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def estimate(template_spectrum: np.ndarray, region_spectrum: np.ndarray,
+             max_estimates: int = MAX_ESTIMATES) -> list:
+    """
+    Estimates how a region is rotated and scaled relative to a template.
+
+    Args:
+        template_spectrum: The template's log_polar_spectrum().
+        region_spectrum: The region's log_polar_spectrum(). The region must be sampled at the same
+            resolution as the template (relative to their patch sizes).
+        max_estimates: The number of estimates to return.
+
+    Returns:
+        A list of (angle, scale, response) estimates, strongest first. The angle (in degrees) is
+        only known up to 180 degrees, since magnitude spectra are symmetric.
+    """
+    cross = template_spectrum * np.conj(region_spectrum)
+    cross /= np.abs(cross) + 1e-12
+    surface = np.fft.fftshift(np.real(np.fft.ifft2(cross))).astype(np.float32)
+    ys, xs, values = peaks.local_maxima(surface, -math.inf, max_estimates)
+    center = SPECTRUM_SIZE // 2
+    angles = (ys + _subpixel_offset(surface, ys, xs, 0) - center) * 360 / SPECTRUM_SIZE
+    scales = np.exp((xs + _subpixel_offset(surface, ys, xs, 1) - center) / _LOG_BASE)
+    return list(zip(angles.tolist(), scales.tolist(), values.tolist()))
+
+
+class LogPolarTemplate:
+    """A template with the state needed for Fourier-Mellin search precomputed."""
+
+    def __init__(self, template: pyramid.ScaledTemplates):
+        """
+        Args:
+            template: The (unrotated) template.
+        """
+        self.template = template
+        pixels = template.pixels
+        h, w = pixels.shape[:2]
+        self.h, self.w = h, w
+        # Only the disc inscribed in the template looks the same under any rotation
+        self.side = min(h, w)
+        y, x = (h - self.side) // 2, (w - self.side) // 2
+        self.spectrum = log_polar_spectrum(pixels[y:y + self.side, x:x + self.side])
+        self.radius = self.side / 2
+        # Mean color of the inscribed disc, which doesn't change when the template is rotated
+        disc = np.zeros((h, w), np.uint8)
+        cv2.circle(disc, (w // 2, h // 2), max(1, int(self.radius)), 1, cv2.FILLED)
+        self.disc_mean = pixels[disc.astype(bool)].mean(axis=0)
+        self._transformed = {}
+
+    def transformed(self, angle: float, scale: float) -> PreparedTemplate:
+        """
+        Returns the template rotated and scaled as given.
+
+        The MAX_TRANSFORMED most recently used results are cached for (nearly) equal estimates,
+        which mostly come from refining a match.
+        """
+        key = (round(angle, 1), round(scale, 3))
+        with _transformed_lock:
+            prepared = self._transformed.pop(key, None)
+            if prepared is not None:
+                # Put it back at the end, as the most recently used
+                self._transformed[key] = prepared
+                return prepared
+        h, w = max(1, round(self.h * scale)), max(1, round(self.w * scale))
+        sized = self.template.sized(h, w)
+        pixels, mask = transforms.rotate(sized.pixels, sized.mask, angle)
+        prepared = PreparedTemplate(pixels, mask)
+        with _transformed_lock:
+            self._transformed[key] = prepared
+            while len(self._transformed) > MAX_TRANSFORMED:
+                del self._transformed[next(iter(self._transformed))]
+        return prepared
+
+
+def _disc_kernel(radius: float) -> np.ndarray:
+    """Returns a normalized disc-shaped averaging kernel."""
+    size = 2 * math.ceil(radius) + 1
+    kernel = np.zeros((size, size), np.float32)
+    cv2.circle(kernel, (size // 2, size // 2), max(1, round(radius)), 1, cv2.FILLED)
+    return kernel / kernel.sum()
+
+
+def _regions(levels: pyramid.Pyramid, template: LogPolarTemplate, scale: float) -> list:
+    """Returns the (cx, cy) centers of the candidate regions for one scale band."""
+    radius = template.radius * scale
+    level_index = 0
+    while level_index + 1 < len(levels) and radius / 2 ** (level_index + 1) >= MIN_DISC_RADIUS:
+        level_index += 1
+    factor = 2 ** level_index
+    level = levels[level_index]
+    means = cv2.filter2D(level, -1, _disc_kernel(radius / factor), borderType=cv2.BORDER_REFLECT)
+    means = means.reshape(level.shape)
+    similarity = -np.square(means - template.disc_mean).sum(axis=2).astype(np.float32)
+    ys, xs, values = peaks.local_maxima(similarity, -math.inf)
+    # Flat areas are plateaus of local maxima, so keep regions apart
+    side = max(1, round(2 * radius / factor))
+    boxes = np.stack([xs, ys, np.full_like(xs, side), np.full_like(xs, side)], axis=1)
+    keep = peaks.non_max_suppression(boxes, values, REGION_OVERLAP, MAX_REGIONS)
+    return [(x * factor + factor // 2, y * factor + factor // 2)
+            for x, y in zip(xs[keep].tolist(), ys[keep].tolist())]
+
+
+def _crop_square(pixels: np.ndarray, cx: int, cy: int, side: int) -> np.ndarray:
+    """Crops a square centered at (cx, cy), filling the parts outside the image with its mean."""
+    height, width, channels = pixels.shape
+    square = np.empty((side, side, channels), np.float32)
+    x1, y1 = cx - side // 2, cy - side // 2
+    crop = pixels[max(0, y1):max(0, y1 + side), max(0, x1):max(0, x1 + side)]
+    square[:] = crop.mean(axis=(0, 1)) if crop.size else 0
+    square[max(0, -y1):max(0, -y1) + crop.shape[0], max(0, -x1):max(0, -x1) + crop.shape[1]] = crop
+    return square
+
+
+@tracing.timed("verify")
+def verify(levels: pyramid.Pyramid, prepared: PreparedTemplate, cx: int, cy: int, margin: int,
+           method: str) -> Optional[Candidate]:
+    """Correlates a transformed template in a small region around (cx, cy)."""
+    pixels = levels[0]
+    height, width = pixels.shape[:2]
+    x1 = max(0, cx - prepared.w // 2 - margin)
+    y1 = max(0, cy - prepared.h // 2 - margin)
+    x2 = min(width, cx + (prepared.w + 1) // 2 + margin)
+    y2 = min(height, cy + (prepared.h + 1) // 2 + margin)
+    integral, sq_integral = levels.integrals(0)
+    scores = correlation.match_template(pixels[y1:y2, x1:x2], prepared, method,
+                                        (integral[y1:y2 + 1, x1:x2 + 1],
+                                         sq_integral[y1:y2 + 1, x1:x2 + 1]))
+    candidate = correlation.best_candidate(scores, prepared.h, prepared.w)
+    if candidate is None:
+        return None
+    return candidate._replace(x=candidate.x + x1, y=candidate.y + y1)
+
+
+def _verify_estimate(levels: pyramid.Pyramid, template: LogPolarTemplate, angle: float,
+                     scale: float, scales: Optional[tuple], cx: int, cy: int, margin: int,
+                     method: str) -> Optional[Candidate]:
+    """Verifies one (angle, scale) estimate, returning None if the scale is out of range."""
+    if scales is not None and not scales[0] <= scale <= scales[1]:
+        return None
+    if min(template.h, template.w) * scale < pyramid.MIN_SCALED_SIZE:
+        return None
+    candidate = verify(levels, template.transformed(angle % 360, scale), cx, cy, margin, method)
+    return None if candidate is None else candidate._replace(scale=scale, angle=angle % 360)
+
+
+def _refine(levels: pyramid.Pyramid, template: LogPolarTemplate, candidate: Candidate,
+            scales: Optional[tuple], method: str) -> Candidate:
+    """Refines the angle and scale of a verified estimate by local search."""
+    angle_step, scale_step = 360 / SPECTRUM_SIZE, math.exp(1 / _LOG_BASE)
+    for _ in range(REFINE_ITERATIONS):
+        cx, cy = candidate.x + candidate.w // 2, candidate.y + candidate.h // 2
+        neighbours = [(candidate.angle - angle_step, candidate.scale),
+                      (candidate.angle + angle_step, candidate.scale)]
+        if scales is not None:
+            neighbours += [(candidate.angle, candidate.scale / scale_step),
+                           (candidate.angle, candidate.scale * scale_step)]
+        for angle, scale in neighbours:
+            result = _verify_estimate(levels, template, angle, scale, scales, cx, cy,
+                                      REFINE_MARGIN, method)
+            if result is not None and result.score > candidate.score:
+                candidate = result
+        angle_step, scale_step = angle_step / 2, math.sqrt(scale_step)
+    return candidate
+
+
+@tracing.timed("rotation")
+def search(image, template: LogPolarTemplate, scales: Optional[tuple] = None,
+           method: str = correlation.AUTO) -> list:
+    """
+    Finds rotated (and scaled) matches of the template.
+
+    Args:
+        image: The image, either as a Pyramid or as a float32 array of shape (H, W, C).
+        template: The template, prepared for Fourier-Mellin search.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the template at its original size.
+        method: The correlation engine to use for verification.
+
+    Returns:
+        The best verified candidate of every candidate region that had an estimate verified,
+        sorted by decreasing score.
+    """
+    levels = image if isinstance(image, pyramid.Pyramid) else pyramid.Pyramid(image)
+    bands = [1.0] if scales is None else pyramid.scale_range(*scales, SCALE_BAND).tolist()
+    results = []
+    for band in bands:
+        side = round(template.side * band)
+        if side < pyramid.MIN_SCALED_SIZE:
+            continue
+        margin = math.ceil(template.radius * band * VERIFY_MARGIN)
+        estimates = []
+        for cx, cy in _regions(levels, template, band):
+            square = _crop_square(levels[0], cx, cy, side)
+            if not square.std() > FLAT_STD:
+                continue
+            estimates += [(response, cx, cy, angle, factor) for angle, factor, response
+                          in estimate(template.spectrum, log_polar_spectrum(square))]
+        estimates.sort(key=lambda e: e[0], reverse=True)
+        best = {}
+        for _, cx, cy, angle, factor in estimates[:MAX_VERIFIED]:
+            scale = band * factor if scales is not None else 1.0
+            # Magnitude spectra can't tell apart rotations that differ by 180 degrees
+            for candidate_angle in (angle, angle + 180):
+                candidate = _verify_estimate(levels, template, candidate_angle, scale, scales, cx,
+                                             cy, margin, method)
+                if candidate is not None and (best.get((cx, cy)) is None
+                                              or candidate.score > best[cx, cy].score):
+                    best[cx, cy] = candidate
+        results += [_refine(levels, template, candidate, scales, method)
+                    for candidate in best.values()]
+    results.sort(key=lambda c: c.score, reverse=True)
+    return results
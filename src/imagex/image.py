@@ -0,0 +1,284 @@
+"""
+Image and bounding box types.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import os
+from typing import Callable, Hashable, Optional, Union
+
+import cv2
+import numpy as np
+
+from . import correlation, tracing
+from .cache import DerivedCache
+from .pyramid import Pyramid
+
+# Channel orders
+BGR = "bgr"
+RGB = "rgb"
+CHANNEL_ORDERS = [BGR, RGB]
+
+# Types of image sources
+FILE = "file"
+NPY = "npy"
+BYTES = "bytes"
+
+
+class BoundingBox:
+    """Represents a bounding box with the given top-left corner, width, and height."""
+    x: int
+    y: int
+    w: int
+    h: int
+
+    def __init__(self, x: int, y: int, w: int, h: int):
+        """Creates a rectangle with the given top-left corner, width, and height."""
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+
+    def to_tuple(self) -> tuple:
+        """Returns the bounding box as a tuple (x, y, w, h)."""
+        return self.x, self.y, self.w, self.h
+
+    def __str__(self) -> str:
+        return f"BoundingBox({self.x}, {self.y}, {self.w}, {self.h})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class Image:
+    """
+    Represents an image.
+
+    Images are decoded lazily, the first time their pixels are needed, and arrays are wrapped
+    without being copied. Channels can be in BGR order (like OpenCV) or RGB order; images and
+    templates with different orders can be matched against each other.
+
+    A fourth channel holds alpha. Pixels of a template that are more than half transparent don't
+    affect matching; the alpha channel of an image that is searched in is ignored.
+    """
+
+    def __init__(self, source: Union[str, os.PathLike], channel_order: str = BGR):
+        """
+        Creates an image from a file.
+
+        Args:
+            source: The path to an image file, or to a .npy file holding a uint8 array of shape
+                (H, W), (H, W, 3) or (H, W, 4). NumPy files are memory-mapped instead of read,
+                except for grayscale ones, which are converted to BGR.
+            channel_order: The order of the channels in a .npy file (BGR or RGB). Other image
+                files are always decoded as BGR, or BGRA if they have an alpha channel.
+        """
+        if not isinstance(source, (str, os.PathLike)):
+            raise TypeError(f"Invalid image source: {source!r}")
+        path = os.fspath(source)
+        if path.lower().endswith(".npy"):
+            self._init(path, NPY, channel_order)
+        else:
+            self._init(path, FILE, BGR)
+
+    def _init(self, source, source_type: Optional[str], channel_order: str) -> None:
+        """Sets up an image whose pixels are loaded from the given source on first access."""
+        if channel_order not in CHANNEL_ORDERS:
+            raise ValueError(f"Invalid channel order: {channel_order}")
+        self._source = source
+        self._source_type = source_type
+        self._image = None
+        self.channel_order = channel_order
+
+    def __getstate__(self) -> dict:
+        # Derived data is cheaper to recompute than to pickle, and memory-mapped files are sent
+        # as their paths, so that copies of the image (like in worker processes) map them too
+        state = self.__dict__.copy()
+        state.pop("_cache", None)
+        if isinstance(self._image, np.memmap) and self._source_type == NPY:
+            state["_source"], state["_image"] = self._image.filename, None
+        return state
+
+    @classmethod
+    def from_array(cls, array, channel_order: str = BGR, shape: Optional[tuple] = None) -> "Image":
+        """
+        Wraps an array (or any object supporting the buffer protocol) as an image, without copying.
+
+        Args:
+            array: A uint8 array of shape (H, W), (H, W, 3) or (H, W, 4). Changes to the array are
+                visible to the image until its pixels are first used for matching. Grayscale
+                arrays of shape (H, W) are copied to BGR instead, so they match color images.
+            channel_order: The order of the array's channels (BGR or RGB).
+            shape: The shape of the pixels, for flat arrays and raw buffers (like the buf of a
+                multiprocessing.shared_memory.SharedMemory). The buffer may be larger than the
+                pixels, which are then at its start.
+
+        Raises:
+            ValueError: If the array doesn't hold uint8 pixels of a supported shape.
+        """
+        # NumPy would make an array of one string from bytes
+        pixels = np.frombuffer(array, np.uint8) if isinstance(array, bytes) else np.asarray(array)
+        if shape is not None:
+            shape = tuple(shape)
+            size = int(np.prod(shape))
+            if pixels.ndim != 1 or pixels.size < size:
+                raise ValueError(f"Can't view an array of shape {pixels.shape} as shape {shape}")
+            pixels = pixels[:size].reshape(shape)
+        _check_pixels(pixels)
+        image = cls.__new__(cls)
+        image._init(None, None, channel_order)
+        image._image = _gray_to_bgr(pixels)
+        return image
+
+    @classmethod
+    def from_bytes(cls, data) -> "Image":
+        """
+        Creates an image from an encoded image file (PNG, JPEG, etc.) in memory.
+
+        Args:
+            data: The encoded image, as bytes, a bytearray or a memoryview. Decoded on first use.
+        """
+        image = cls.__new__(cls)
+        image._init(data, BYTES, BGR)
+        return image
+
+    @property
+    def image(self) -> np.ndarray:
+        """The image's pixels, as a uint8 array in the image's channel order."""
+        if self._image is None:
+            self._image = self._decode()
+            self._source = None
+        return self._image
+
+    @image.setter
+    def image(self, array: np.ndarray) -> None:
+        # Derived data is stale now
+        self.cache.clear()
+        if "channel_order" not in self.__dict__:
+            self._init(None, None, BGR)
+        self._source = None
+        self._image = array
+
+    @tracing.timed("decode")
+    def _decode(self) -> np.ndarray:
+        """Loads the image's pixels from its source."""
+        if self._source_type == NPY:
+            pixels = np.load(self._source, mmap_mode="r")
+            _check_pixels(pixels)
+            return _gray_to_bgr(pixels)
+        if self._source_type == FILE:
+            pixels = cv2.imread(self._source, cv2.IMREAD_UNCHANGED)
+        else:
+            pixels = cv2.imdecode(np.frombuffer(self._source, np.uint8), cv2.IMREAD_UNCHANGED)
+        if pixels is None:
+            source = self._source if self._source_type == FILE else "<bytes>"
+            raise ValueError(f"Could not decode image: {source}")
+        return _to_bgr(pixels)
+
+    @property
+    def decoded(self) -> bool:
+        """Whether the image's pixels have been loaded yet."""
+        return self._image is not None
+
+    def array(self, channel_order: str = BGR) -> np.ndarray:
+        """Returns the image's pixels in the given channel order, as a view if possible."""
+        pixels = self.image
+        if channel_order == self.channel_order or pixels.ndim == 2:
+            return pixels
+        if pixels.shape[2] == 3:
+            return pixels[:, :, ::-1]
+        # Swap the color channels, keeping alpha last
+        return pixels[:, :, [2, 1, 0, 3]]
+
+    def colors(self, channel_order: str = BGR) -> np.ndarray:
+        """Returns the image's color channels (without alpha) in the given channel order."""
+        pixels = self.array(channel_order)
+        return pixels[:, :, :3] if pixels.ndim == 3 and pixels.shape[2] == 4 else pixels
+
+    @property
+    def alpha(self) -> Optional[np.ndarray]:
+        """The image's uint8 alpha channel, or None if it has none."""
+        pixels = self.image
+        return pixels[:, :, 3] if pixels.ndim == 3 and pixels.shape[2] == 4 else None
+
+    @property
+    def mask(self) -> Optional[np.ndarray]:
+        """The image's alpha as float32 weights in [0, 1], or None if the image is opaque."""
+        alpha = self.alpha
+        if alpha is None:
+            return None
+        return self.derived("mask", lambda: None if alpha.min() == 255
+                            else alpha.astype(np.float32) / 255)
+
+    @property
+    def cache(self) -> DerivedCache:
+        """The cache of representations derived from the image's pixels."""
+        if "_cache" not in self.__dict__:
+            self._cache = DerivedCache()
+        return self._cache
+
+    def derived(self, key: Hashable, compute: Callable[[], object]):
+        """
+        Returns a representation derived from the image's pixels, computing it on first use.
+
+        Derived representations are kept in the image's cache, so everything searched for in the
+        same image shares them. Set image.cache.max_bytes to change how much memory they may use.
+
+        Args:
+            key: The name of the representation.
+            compute: Computes the representation if it isn't cached.
+        """
+        return self.cache.get(key, compute)
+
+    @property
+    def pixels(self) -> np.ndarray:
+        """The image's colors as float32 pixels in [0, 1] and BGR order."""
+        return self.derived("pixels", lambda: correlation.to_float(self.colors(BGR)))
+
+    @property
+    def integrals(self) -> tuple:
+        """
+        The summed-area tables of the image's pixels and squared pixels.
+
+        These give the per-channel mean and variance of any window in constant time, which lets
+        the matcher reject windows (and whole images) without correlating them.
+        """
+        return self.derived("integrals", lambda: correlation.integral_images(self.pixels))
+
+    @property
+    def pyramid(self) -> Pyramid:
+        """The image's Gaussian pyramid, with its summed-area tables and FFT spectra."""
+        return self.derived("pyramid", lambda: Pyramid(self.pixels, self.integrals,
+                                                       self.cache.watcher("pyramid")))
+
+
+def _check_pixels(pixels: np.ndarray) -> None:
+    """Checks that an array holds uint8 pixels of shape (H, W), (H, W, 3) or (H, W, 4)."""
+    if pixels.dtype != np.uint8:
+        raise ValueError(f"Pixels must be uint8, not {pixels.dtype}")
+    if pixels.ndim not in (2, 3):
+        raise ValueError(f"Pixels must have 2 or 3 dimensions, not shape {pixels.shape}")
+    if pixels.ndim == 3 and pixels.shape[2] not in (3, 4):
+        raise ValueError(f"Pixels must have 3 or 4 channels, not {pixels.shape[2]}")
+    if pixels.size == 0:
+        raise ValueError(f"Pixels can't be empty, but have shape {pixels.shape}")
+
+
+def _gray_to_bgr(pixels: np.ndarray) -> np.ndarray:
+    """Converts grayscale pixels of shape (H, W) to BGR, so that they match color images."""
+    return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR) if pixels.ndim == 2 else pixels
+
+
+def _to_bgr(pixels: np.ndarray) -> np.ndarray:
+    """Converts decoded pixels of any layout to 8-bit BGR, or BGRA if they have alpha."""
+    if pixels.dtype == np.uint16:
+        pixels = (pixels >> 8).astype(np.uint8)
+    elif pixels.dtype != np.uint8:
+        pixels = np.clip(pixels * 255, 0, 255).astype(np.uint8)
+    if pixels.ndim == 2:
+        return _gray_to_bgr(pixels)
+    if pixels.shape[2] == 2:
+        # Gray and alpha
+        return pixels[:, :, [0, 0, 0, 1]]
+    return pixels
@@ -0,0 +1,295 @@
+"""
+Process-wide metrics of every search.
+
+Counters and histograms are updated by every find() and find_all() call (including those made by
+compiled templates, batches and trackers), and can be exported in the Prometheus text format or as
+JSON, to a file or to a callback. Each process has its own registry, so worker processes export
+their own metrics (include the process id in the file name to keep them apart).
+
+Updating a metric takes a lock and a dict lookup. Set metrics.enabled = False to turn all updates
+off.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import json
+import math
+import os
+import threading
+from typing import Callable, Optional, Union
+
+from . import files
+
+# Export formats
+PROMETHEUS = "prometheus"
+JSON = "json"
+FORMATS = [PROMETHEUS, JSON]
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   math.inf)
+# Upper bounds of the batch size buckets, in requests
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, math.inf)
+# Upper bounds of the image size buckets, in pixels, along with their label values
+SIZE_BUCKETS = ((100_000, "<=0.1MP"), (1_000_000, "<=1MP"), (4_000_000, "<=4MP"),
+                (16_000_000, "<=16MP"), (math.inf, ">16MP"))
+
+# Whether metrics are updated
+enabled = True
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Formats labels for the Prometheus text format."""
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    """Formats a number for the Prometheus text format."""
+    if value == math.inf:
+        return "+Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """Adds to the count of the given label values (in the order of the label names)."""
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        """Returns the count of the given label values."""
+        return self._values.get(labels, 0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def to_json(self) -> list:
+        with self._lock:
+            return [{"labels": dict(zip(self.label_names, labels)), "value": value}
+                    for labels, value in self._values.items()]
+
+    def to_prometheus(self) -> list:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                    for labels, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets, per combination of label values."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Each value is [count per bucket (not cumulative), sum of the observed values]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Records a value for the given label values (in the order of the label names)."""
+        # NaN fits in no bucket, and would make the sum NaN for good
+        if not enabled or math.isnan(value):
+            return
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts = self._values.setdefault(labels, [[0] * len(self.buckets), 0.0])
+            counts[0][index] += 1
+            counts[1] += value
+
+    def count(self, *labels: str) -> int:
+        """Returns the number of values observed for the given label values."""
+        return sum(self._values[labels][0]) if labels in self._values else 0
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def to_json(self) -> list:
+        with self._lock:
+            return [{"labels": dict(zip(self.label_names, labels)),
+                     "buckets": {_format_value(bound): count
+                                 for bound, count in zip(self.buckets, _cumulative(counts))},
+                     "sum": total, "count": sum(counts)}
+                    for labels, (counts, total) in self._values.items()]
+
+    def to_prometheus(self) -> list:
+        lines = []
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, _cumulative(counts)):
+                    le = f'le="{_format_value(bound)}"'
+                    bucket = _format_labels(self.label_names, labels, le)
+                    lines.append(f"{self.name}_bucket{bucket} {count}")
+                names = _format_labels(self.label_names, labels)
+                lines.append(f"{self.name}_sum{names} {_format_value(total)}")
+                lines.append(f"{self.name}_count{names} {sum(counts)}")
+        return lines
+
+
+def _cumulative(counts: list) -> list:
+    """Returns the running totals of a list of counts."""
+    totals, total = [], 0
+    for count in counts:
+        total += count
+        totals.append(total)
+    return totals
+
+
+class Registry:
+    """A named collection of metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric: Union[Counter, Histogram]) -> Union[Counter, Histogram]:
+        """Adds a metric to the registry and returns it."""
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self) -> None:
+        """Resets every metric."""
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def to_json(self) -> dict:
+        """Returns every metric as JSON-serializable data."""
+        return {name: {"type": metric.type, "help": metric.description,
+                       "values": metric.to_json()}
+                for name, metric in self.metrics.items()}
+
+    def to_prometheus(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.description}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def export(self, target: Union[str, os.PathLike, Callable[[str], None]],
+               format: str = PROMETHEUS) -> None:
+        """
+        Exports every metric.
+
+        Args:
+            target: A file to write the metrics to, or a function to call with them. Files are
+                replaced atomically, so a scraper never sees a partially written file, and get the
+                usual permissions of new files (0o666 minus the umask).
+            format: PROMETHEUS or JSON.
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Invalid format: {format}")
+        text = self.to_prometheus() if format == PROMETHEUS else json.dumps(self.to_json())
+        if callable(target):
+            target(text)
+            return
+        with files.replace_atomically(target, "w") as file:
+            file.write(text)
+
+
+class PeriodicExporter:
+    """Exports a registry's metrics in a background thread, at a fixed interval."""
+
+    def __init__(self, registry: Registry, target, interval: float, format: str = PROMETHEUS):
+        """
+        Starts exporting. See Registry.export() for the target and format.
+
+        Args:
+            interval: The time between exports, in seconds.
+        """
+        self._stopped = threading.Event()
+
+        def run():
+            while not self._stopped.wait(interval):
+                registry.export(target, format)
+
+        self._thread = threading.Thread(target=run, name="imagex-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops exporting."""
+        self._stopped.set()
+        self._thread.join()
+
+
+REGISTRY = Registry()
+CALLS = REGISTRY.add(Counter(
+    "imagex_calls_total", "Searches, by function and whether anything was found",
+    ("function", "result")))
+CALL_SECONDS = REGISTRY.add(Histogram(
+    "imagex_call_seconds", "Latency of searches, by function and image size",
+    ("function", "image_size")))
+CORRELATIONS = REGISTRY.add(Counter(
+    "imagex_correlations_total", "Score maps computed, by correlation engine (or shortcut)",
+    ("engine",)))
+CACHE_REQUESTS = REGISTRY.add(Counter(
+    "imagex_cache_requests_total", "Lookups of cached template and image data, by cache and result",
+    ("cache", "result")))
+SERVER_BATCH_REQUESTS = REGISTRY.add(Histogram(
+    "imagex_server_batch_requests", "Requests served together by one batch of a match server",
+    buckets=BATCH_BUCKETS))
+
+
+def size_bucket(shape: tuple) -> str:
+    """Returns the image size label of an image shape."""
+    pixels = shape[0] * shape[1]
+    return next(label for bound, label in SIZE_BUCKETS if pixels <= bound)
+
+
+def record_call(function: str, shape: Optional[tuple], seconds: float, found: bool) -> None:
+    """Records one search."""
+    if not enabled:
+        return
+    CALLS.inc(function, "hit" if found else "miss")
+    if shape is not None:
+        CALL_SECONDS.observe(seconds, function, size_bucket(shape))
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """Records one cache lookup."""
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def export(target: Union[str, os.PathLike, Callable[[str], None]],
+           format: str = PROMETHEUS) -> None:
+    """Exports the process-wide metrics to a file or callback. See Registry.export()."""
+    REGISTRY.export(target, format)
+
+
+def export_every(interval: float, target: Union[str, os.PathLike, Callable[[str], None]],
+                 format: str = PROMETHEUS) -> PeriodicExporter:
+    """
+    Exports the process-wide metrics every interval seconds, in a background thread.
+
+    Returns:
+        The exporter. Call its stop() method to stop exporting.
+    """
+    return PeriodicExporter(REGISTRY, target, interval, format)
+
+
+def reset() -> None:
+    """Resets the process-wide metrics."""
+    REGISTRY.reset()
@@ -0,0 +1,165 @@
+"""
+Peak extraction and non-maximum suppression for score maps.
+
+Both steps are vectorized with NumPy. Local maxima are found with a single dilation of the score
+map, and flat plateaus of equal maxima are reduced to one peak each with a connected components
+pass. Suppression compares blocks of boxes against each other at once, so its Python loop runs
+once per block rather than once per kept box.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from . import tracing
+
+# Maximum fraction of the smaller of two matches that may be covered by the other one
+DEFAULT_MAX_OVERLAP = 0.8
+# Number of boxes compared against each other at once by non-maximum suppression
+NMS_BLOCK_SIZE = 512
+
+
+@tracing.timed("peaks")
+def local_maxima(scores: np.ndarray, threshold: float,
+                 max_peaks: Optional[int] = None) -> tuple:
+    """
+    Finds the local maxima of a score map that are at least the threshold.
+
+    A plateau of equal maxima (like the windows inside a region that a flat template fits anywhere
+    in) is a single peak, at its first pixel in row-major order.
+
+    Args:
+        scores: A float32 score map.
+        threshold: The minimum score of a peak.
+        max_peaks: If given, only the highest scoring peaks are returned.
+
+    Returns:
+        The (ys, xs, values) of the peaks, sorted by decreasing score.
+    """
+    if scores.size == 0:
+        empty = np.zeros(0, np.intp)
+        return empty, empty, np.zeros(0, np.float32)
+    dilated = cv2.dilate(scores, np.ones((3, 3), np.uint8))
+    maxima = (scores >= dilated) & (scores >= threshold)
+    ys, xs = np.nonzero(maxima)
+    if len(ys) > 1:
+        # Neighbouring maxima are always equal, so connected maxima form a plateau
+        _, labels = cv2.connectedComponents(maxima.view(np.uint8), connectivity=8)
+        _, first = np.unique(labels[ys, xs], return_index=True)
+        if len(first) < len(ys):
+            first.sort()
+            ys, xs = ys[first], xs[first]
+    values = scores[ys, xs]
+    order = np.argsort(-values, kind="stable")[:max_peaks]
+    return ys[order], xs[order], values[order]
+
+
+@tracing.timed("nms")
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray,
+                        max_overlap: float = DEFAULT_MAX_OVERLAP,
+                        max_results: Optional[int] = None) -> np.ndarray:
+    """
+    Greedily keeps the highest scoring boxes, dropping boxes that overlap a kept box too much.
+
+    Overlap is measured relative to the smaller box, so that a match is only suppressed if most of
+    it is covered by a better match.
+
+    Args:
+        boxes: An integer array of shape (N, 4), where each row is (x, y, w, h).
+        scores: A float array of shape (N,).
+        max_overlap: The maximum allowed overlap between two kept boxes, between 0 and 1.
+        max_results: If given, at most this many boxes are kept.
+
+    Returns:
+        The indices of the kept boxes, sorted by decreasing score.
+    """
+    limit = len(boxes) if max_results is None else min(max_results, len(boxes))
+    if limit == 0:
+        return np.zeros(0, np.intp)
+    order = np.argsort(-scores, kind="stable")
+    boxes = np.asarray(boxes, np.int64)[order]
+    kept = np.zeros((0, 4), np.int64)
+    keep = []
+    count = 0
+    for start in range(0, len(boxes), NMS_BLOCK_SIZE):
+        block = boxes[start:start + NMS_BLOCK_SIZE]
+        # Boxes covered by an already kept (better) box are dropped
+        alive = ~_covered(kept, block, max_overlap)
+        # Within the block, box j is kept if no kept box before it covers it. Starting with every
+        # box kept, each round settles at least the next box in score order, so this converges
+        # to the greedy result, usually in a few rounds.
+        suppresses = np.triu(_overlap(block[:, np.newaxis], block[np.newaxis]) > max_overlap, 1)
+        survivors = alive
+        while True:
+            covered = (suppresses & survivors[:, np.newaxis]).any(axis=0)
+            updated = alive & ~covered
+            if np.array_equal(updated, survivors):
+                break
+            survivors = updated
+        indices = np.nonzero(survivors)[0][:limit - count]
+        keep.append(order[start + indices])
+        kept = np.concatenate([kept, block[indices]])
+        count += len(indices)
+        if count >= limit:
+            break
+    return np.concatenate(keep)
+
+
+def _covered(kept: np.ndarray, boxes: np.ndarray, max_overlap: float) -> np.ndarray:
+    """
+    Finds the boxes that some kept box overlaps by more than max_overlap.
+
+    Only pairs whose x ranges can intersect are compared: the kept boxes are sorted by their left
+    edge, so the candidates for each box are a contiguous range, found by binary search.
+
+    Returns:
+        A boolean array of shape (len(boxes),).
+    """
+    if not len(kept):
+        return np.zeros(len(boxes), bool)
+    order = np.argsort(kept[:, 0], kind="stable")
+    lefts = kept[order, 0]
+    starts = np.searchsorted(lefts, boxes[:, 0] - kept[:, 2].max(), "right")
+    ends = np.searchsorted(lefts, boxes[:, 0] + boxes[:, 2], "left")
+    counts = np.maximum(ends - starts, 0)
+    # Expand the ranges into (box, kept box) pairs
+    box_indices = np.repeat(np.arange(len(boxes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    kept_indices = order[np.repeat(starts, counts) + offsets]
+    covered = np.zeros(len(boxes), bool)
+    overlapping = _overlap(kept[kept_indices], boxes[box_indices]) > max_overlap
+    covered[box_indices[overlapping]] = True
+    return covered
+
+
+def _overlap(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns the overlap of pairs of boxes, relative to the smaller box of each pair.
+
+    Args:
+        a: An integer array of shape (..., 4), where each row is (x, y, w, h).
+        b: An integer array that broadcasts against a.
+
+    Returns:
+        A float array of the broadcast shape, without the last axis.
+    """
+    overlap_w = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) \
+        - np.maximum(a[..., 0], b[..., 0])
+    overlap_h = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) \
+        - np.maximum(a[..., 1], b[..., 1])
+    areas = np.minimum(a[..., 2] * a[..., 3], b[..., 2] * b[..., 3])
+    return np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None) / np.maximum(areas, 1)
+
+
+def suppress_candidates(candidates: list, max_overlap: float = DEFAULT_MAX_OVERLAP,
+                        max_results: Optional[int] = None) -> list:
+    """Runs non-maximum suppression on a list of correlation.Candidate objects."""
+    if not candidates:
+        return []
+    boxes = np.array([(c.x, c.y, c.w, c.h) for c in candidates], np.int64)
+    scores = np.array([c.score for c in candidates], np.float64)
+    return [candidates[i] for i in non_max_suppression(boxes, scores, max_overlap, max_results)]
@@ -0,0 +1,418 @@
+"""
+Coarse-to-fine image pyramid search for scale-invariant matching.
+
+Every scale in a dense range is first searched on a downsampled copy of the image, where the scaled
+template is just large enough to be matched reliably. Only the best few candidates survive, and
+their scale and position are refined at successively finer pyramid levels, each time searching a
+small neighbourhood of scales in a small region around the previous estimate.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import math
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+from . import correlation, metrics, peaks, tracing
+from .transforms import resize
+from .correlation import Candidate, PreparedTemplate
+
+# Default range of template scales to search
+DEFAULT_SCALE_RANGE = (0.1, 10.0)
+# Ratio between consecutive scales searched at the coarsest level
+SCALE_STEP = 1.1
+# Minimum side length of a template on a pyramid level for that level to be searched
+MIN_LEVEL_SIZE = 8
+# Minimum side length of a scaled template at full resolution
+MIN_SCALED_SIZE = 8
+# Number of coarse candidates that are refined when looking for the best match
+MAX_CANDIDATES = 5
+# Number of coarse candidates that are refined when looking for all matches
+MAX_ALL_CANDIDATES = 200
+# How far below the threshold a coarse score may be for the candidate to still be refined
+COARSE_SLACK = 0.2
+# Extra margin (in pixels) around an upsampled candidate when refining it
+REFINE_MARGIN = 3
+
+
+@tracing.timed("pyramid")
+def build_pyramid(pixels: np.ndarray, min_size: int = MIN_LEVEL_SIZE) -> list:
+    """
+    Builds a Gaussian pyramid of an image.
+
+    Args:
+        pixels: A float image of shape (H, W, C).
+        min_size: Levels are added while both sides of the next level are at least this long.
+
+    Returns:
+        A list of levels, where level 0 is the image itself and each level is half the size of the
+        previous one.
+    """
+    levels = [pixels]
+    while min(levels[-1].shape[:2]) // 2 >= min_size:
+        level = levels[-1]
+        down = cv2.pyrDown(level)
+        levels.append(down.reshape(*down.shape[:2], level.shape[2]))
+    return levels
+
+
+class ScaledTemplates:
+    """Resized copies of a template (and its mask), prepared for correlation and cached by size."""
+
+    def __init__(self, pixels: np.ndarray, mask: Optional[np.ndarray] = None):
+        """
+        Args:
+            pixels: A float32 template of shape (h, w, C).
+            mask: An optional mask of shape (h, w), as accepted by PreparedTemplate.
+        """
+        self.pixels = pixels
+        self.mask = mask
+        self._sized = {}
+
+    @property
+    def shape(self) -> tuple:
+        """The shape of the original template."""
+        return self.pixels.shape
+
+    def sized(self, h: int, w: int) -> PreparedTemplate:
+        """Returns the template resized to the given height and width."""
+        metrics.record_cache("template_size", (h, w) in self._sized)
+        if (h, w) not in self._sized:
+            pixels, mask = self.pixels, self.mask
+            if (h, w) != pixels.shape[:2]:
+                pixels = resize(pixels, w, h)
+                if mask is not None:
+                    mask = resize(mask[:, :, np.newaxis], w, h)[:, :, 0]
+            self._sized[(h, w)] = PreparedTemplate(pixels, mask)
+        return self._sized[(h, w)]
+
+
+def scale_range(min_scale: float, max_scale: float, step: float = SCALE_STEP) -> np.ndarray:
+    """Returns geometrically spaced scales from min_scale to max_scale (inclusive)."""
+    count = max(1, math.ceil(math.log(max_scale / min_scale) / math.log(step)) + 1)
+    return np.geomspace(min_scale, max_scale, count)
+
+
+def _scaled_size(template: ScaledTemplates, scale: float, level: int) -> tuple:
+    """Returns the (h, w) of a scaled template on the given pyramid level."""
+    factor = scale / 2 ** level
+    return (max(1, round(template.shape[0] * factor)),
+            max(1, round(template.shape[1] * factor)))
+
+
+def _coarsest_level(template: ScaledTemplates, scale: float, num_levels: int) -> int:
+    """Returns the coarsest pyramid level where the scaled template is still large enough."""
+    level = 0
+    while (level + 1 < num_levels
+           and min(_scaled_size(template, scale, level + 1)) >= MIN_LEVEL_SIZE):
+        level += 1
+    return level
+
+
+class _Spectra(dict):
+    """The FFT spectra of a pyramid level, keyed by padded shape, which reports when it grows."""
+
+    def __init__(self, grown: Optional[Callable[[], None]] = None):
+        super().__init__()
+        self._grown = grown
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        if self._grown is not None:
+            self._grown()
+
+
+class Pyramid:
+    """The levels of an image pyramid, along with their lazily computed summed-area tables."""
+
+    def __init__(self, pixels: np.ndarray, integrals: Optional[tuple] = None,
+                 grown: Optional[Callable[[], None]] = None):
+        """
+        Builds the pyramid of an image.
+
+        Args:
+            pixels: A float32 image of shape (H, W, C).
+            integrals: The image's summed-area tables, if they are already computed.
+            grown: Called whenever summed-area tables or spectra are added, like
+                DerivedCache.watcher(), so that a cache can measure the pyramid again.
+        """
+        self.levels = build_pyramid(pixels)
+        self._integrals = [integrals] + [None] * (len(self.levels) - 1)
+        self._spectra = [_Spectra(grown) for _ in self.levels]
+        self._grown = grown
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.levels[index]
+
+    def integrals(self, index: int) -> tuple:
+        """Returns the summed-area tables of the given level."""
+        if self._integrals[index] is None:
+            self._integrals[index] = correlation.integral_images(self.levels[index])
+            if self._grown is not None:
+                self._grown()
+        return self._integrals[index]
+
+    def spectra(self, index: int) -> dict:
+        """Returns the cache of the given level's FFT spectra, keyed by padded shape."""
+        return self._spectra[index]
+
+    def arrays(self) -> list:
+        """Returns every array held by the pyramid, for memory accounting."""
+        return [self.levels, self._integrals, self._spectra]
+
+
+def _score_scaled(levels: Pyramid, template: ScaledTemplates, scale: float, level_index: int,
+                  method: str, roi: Optional[tuple] = None,
+                  max_difference: Optional[float] = None) -> tuple:
+    """
+    Scores a scaled template on one pyramid level, optionally within a region of interest.
+
+    Args:
+        levels: The image pyramid.
+        template: The template to scale.
+        scale: The scale of the template, relative to the full resolution image.
+        level_index: The index of the pyramid level.
+        method: The correlation engine to use.
+        roi: If given, only windows inside this (x1, y1, x2, y2) region are searched.
+        max_difference: If given, the largest RMS color difference of a matching window (see
+            correlation.match_template()).
+
+    Returns:
+        The (scores, x1, y1, h, w), where (x1, y1) is the offset of the score map in level
+        coordinates and (h, w) is the size of the scaled template on the level.
+    """
+    h, w = _scaled_size(template, scale, level_index)
+    level = levels[level_index]
+    integral, sq_integral = levels.integrals(level_index)
+    x1, y1 = 0, 0
+    spectra = levels.spectra(level_index)
+    if roi is not None:
+        # Window sums only depend on differences of the tables, so they can be cropped directly
+        x1, y1, x2, y2 = roi
+        level = level[y1:y2, x1:x2]
+        integral = integral[y1:y2 + 1, x1:x2 + 1]
+        sq_integral = sq_integral[y1:y2 + 1, x1:x2 + 1]
+        spectra = None
+    scores = correlation.match_template(level, template.sized(h, w), method,
+                                        (integral, sq_integral), max_difference, spectra)
+    return scores, x1, y1, h, w
+
+
+def _match_scaled(levels: Pyramid, template: ScaledTemplates, scale: float, level_index: int,
+                  method: str, roi: Optional[tuple] = None,
+                  max_difference: Optional[float] = None) -> Optional[Candidate]:
+    """
+    Matches a scaled template on one pyramid level, optionally within a region of interest.
+
+    Returns:
+        The best candidate, in level coordinates, or None if the template does not fit.
+    """
+    scores, x1, y1, h, w = _score_scaled(levels, template, scale, level_index, method, roi,
+                                         max_difference)
+    candidate = correlation.best_candidate(scores, h, w, scale)
+    if candidate is None:
+        return None
+    return candidate._replace(x=candidate.x + x1, y=candidate.y + y1)
+
+
+@tracing.timed("refine")
+def _refine(levels: Pyramid, template: ScaledTemplates, candidate: Candidate, level_index: int,
+            step: float, method: str, max_difference: Optional[float] = None) -> Candidate:
+    """Refines a candidate found on the given level down to full resolution."""
+    while level_index > 0:
+        level_index -= 1
+        step = math.sqrt(step)
+        height, width = levels[level_index].shape[:2]
+        best = None
+        for scale in (candidate.scale / step, candidate.scale, candidate.scale * step):
+            h, w = _scaled_size(template, scale, level_index)
+            margin_x = REFINE_MARGIN + math.ceil(abs(w - 2 * candidate.w) / 2)
+            margin_y = REFINE_MARGIN + math.ceil(abs(h - 2 * candidate.h) / 2)
+            roi = (max(0, 2 * candidate.x - margin_x), max(0, 2 * candidate.y - margin_y),
+                   min(width, 2 * candidate.x + w + margin_x),
+                   min(height, 2 * candidate.y + h + margin_y))
+            result = _match_scaled(levels, template, scale, level_index, method, roi,
+                                   max_difference)
+            if result is not None and (best is None or result.score > best.score):
+                best = result
+        if best is None:
+            break
+        candidate = best
+    return candidate
+
+
+def _coarse_scales(levels: Pyramid, template: ScaledTemplates, scales: tuple):
+    """Yields the (scale, level_index) pairs to search in the coarse stage."""
+    height, width = levels[0].shape[:2]
+    searched = set()
+    for scale in scale_range(*scales):
+        h, w = _scaled_size(template, scale, 0)
+        if min(h, w) < MIN_SCALED_SIZE or h > height or w > width:
+            continue
+        level_index = _coarsest_level(template, scale, len(levels))
+        # Nearby scales of small templates often round to the same size
+        key = (level_index, _scaled_size(template, scale, level_index))
+        if key in searched:
+            continue
+        searched.add(key)
+        yield scale, level_index
+
+
+@tracing.timed("scales")
+def search_scales(image, template, scales: tuple = DEFAULT_SCALE_RANGE,
+                  method: str = correlation.AUTO,
+                  threshold: Optional[float] = None,
+                  max_difference: Optional[float] = None) -> Optional[Candidate]:
+    """
+    Finds the best match of the template over a range of scales, coarse to fine.
+
+    Args:
+        image: The image, either as a Pyramid or as a float32 array of shape (H, W, C).
+        template: The template, either as ScaledTemplates or as a float32 array of shape (h, w, C).
+        scales: The (min_scale, max_scale) range of template scales to search.
+        method: The correlation engine to use.
+        threshold: If given, coarse candidates scoring more than COARSE_SLACK below it aren't
+            refined, and None is returned if no candidate is left.
+        max_difference: If given, windows whose colors differ from the template's by more than
+            this RMS difference are rejected without being correlated (see
+            correlation.match_template()).
+
+    Returns:
+        The best candidate at full resolution, or None if no scale of the template fits (or none
+        could reach the threshold).
+    """
+    if not isinstance(template, ScaledTemplates):
+        template = ScaledTemplates(template)
+    levels = image if isinstance(image, Pyramid) else Pyramid(image)
+
+    # Search every scale on its coarsest usable level, keeping the best position of each
+    coarse = []
+    for scale, level_index in _coarse_scales(levels, template, scales):
+        candidate = _match_scaled(levels, template, scale, level_index, method,
+                                  max_difference=max_difference)
+        _add_coarse(coarse, candidate, level_index, threshold)
+    return _refine_best(levels, template, coarse, method, max_difference)
+
+
+@tracing.timed("scales")
+def search_scales_batch(image, templates: list, scales: tuple = DEFAULT_SCALE_RANGE,
+                        method: str = correlation.AUTO,
+                        threshold: Optional[float] = None,
+                        max_difference: Optional[float] = None) -> list:
+    """
+    Finds the best match of each of several templates of the same shape, over a range of scales.
+
+    The results are the same as search_scales()'s for each template, but in the coarse stage,
+    templates of the same shape are scaled to the same sizes on the same levels, so every scale is
+    correlated for all of them at once with correlation.match_templates(). The refinement stage
+    searches around each template's own candidates, so it is still done template by template.
+
+    Args:
+        image: The image, either as a Pyramid or as a float32 array of shape (H, W, C).
+        templates: The templates, as ScaledTemplates. All of them must have the same shape.
+        scales: The (min_scale, max_scale) range of template scales to search.
+        method: The correlation engine to use.
+        threshold: If given, coarse candidates scoring more than COARSE_SLACK below it aren't
+            refined.
+        max_difference: If given, the largest RMS color difference of a matching window (see
+            search_scales()).
+
+    Returns:
+        The best candidate of each template (as returned by search_scales()), in order.
+    """
+    if len({template.shape for template in templates}) > 1:
+        raise ValueError("Templates must all have the same shape")
+    levels = image if isinstance(image, Pyramid) else Pyramid(image)
+    coarse = [[] for _ in templates]
+    if templates:
+        for scale, level_index in _coarse_scales(levels, templates[0], scales):
+            h, w = _scaled_size(templates[0], scale, level_index)
+            score_maps = correlation.match_templates(
+                levels[level_index], [template.sized(h, w) for template in templates], method,
+                levels.integrals(level_index), max_difference, levels.spectra(level_index))
+            for found, scores in zip(coarse, score_maps):
+                _add_coarse(found, correlation.best_candidate(scores, h, w, scale), level_index,
+                            threshold)
+    return [_refine_best(levels, template, found, method, max_difference)
+            for template, found in zip(templates, coarse)]
+
+
+def _add_coarse(coarse: list, candidate: Optional[Candidate], level_index: int,
+                threshold: Optional[float]) -> None:
+    """Adds the best candidate of a coarse scale to the candidates to refine, if it's promising."""
+    # A score of 0 means that every window was rejected (or flat)
+    if candidate is None or candidate.score == 0:
+        return
+    if threshold is None or candidate.score >= threshold - COARSE_SLACK:
+        coarse.append((candidate, level_index))
+        tracing.count(f"level {level_index} candidates")
+
+
+def _refine_best(levels: Pyramid, template: ScaledTemplates, coarse: list,
+                 method: str, max_difference: Optional[float] = None) -> Optional[Candidate]:
+    """Refines the best (candidate, level index) pairs of the coarse stage, returning the best."""
+    if not coarse:
+        return None
+    coarse.sort(key=lambda c: (c[0].score, c[0].w * c[0].h), reverse=True)
+    refined = [_refine(levels, template, candidate, level_index, SCALE_STEP, method,
+                       max_difference)
+               for candidate, level_index in coarse[:MAX_CANDIDATES]]
+    return correlation.pick_best(refined)
+
+
+@tracing.timed("scales")
+def search_scales_all(image, template, threshold: float, scales: tuple = DEFAULT_SCALE_RANGE,
+                      method: str = correlation.AUTO,
+                      max_candidates: int = MAX_ALL_CANDIDATES,
+                      max_difference: Optional[float] = None) -> list:
+    """
+    Finds all matches of the template over a range of scales, coarse to fine.
+
+    Every local maximum of every coarse score map that could still reach the threshold becomes a
+    candidate. Candidates are suppressed across scales before being refined, so each location is
+    only refined once.
+
+    Args:
+        image: The image, either as a Pyramid or as a float32 array of shape (H, W, C).
+        template: The template, either as ScaledTemplates or as a float32 array of shape (h, w, C).
+        threshold: The minimum score of a match.
+        scales: The (min_scale, max_scale) range of template scales to search.
+        method: The correlation engine to use.
+        max_candidates: The maximum number of coarse candidates to refine.
+        max_difference: If given, the largest RMS color difference of a matching window (see
+            search_scales()).
+
+    Returns:
+        A list of refined candidates scoring at least the threshold. These can still overlap.
+    """
+    if not isinstance(template, ScaledTemplates):
+        template = ScaledTemplates(template)
+    levels = image if isinstance(image, Pyramid) else Pyramid(image)
+
+    coarse, boxes, scores, level_indices = [], [], [], []
+    for scale, level_index in _coarse_scales(levels, template, scales):
+        score_map, _, _, h, w = _score_scaled(levels, template, scale, level_index, method,
+                                              max_difference=max_difference)
+        ys, xs, values = peaks.local_maxima(score_map, threshold - COARSE_SLACK, max_candidates)
+        factor = 2 ** level_index
+        tracing.count(f"level {level_index} candidates", len(values))
+        for x, y, score in zip(xs.tolist(), ys.tolist(), values.tolist()):
+            coarse.append(Candidate(score, x, y, w, h, scale))
+            boxes.append((x * factor, y * factor, w * factor, h * factor))
+            scores.append(score)
+            level_indices.append(level_index)
+    if not coarse:
+        return []
+
+    keep = peaks.non_max_suppression(np.array(boxes, np.int64), np.array(scores),
+                                     max_results=max_candidates)
+    refined = [_refine(levels, template, coarse[i], level_indices[i], SCALE_STEP, method,
+                       max_difference)
+               for i in keep]
+    return [candidate for candidate in refined if candidate.score >= threshold]
@@ -0,0 +1,588 @@
+"""
+A long-running local match server, which keeps compiled templates and their caches warm.
+
+Searching from a fresh process pays for the interpreter, the imports and compiling the templates
+before any matching is done. A match server pays for those once, and then answers searches over
+HTTP/1.1, on a localhost port or a Unix socket. Connections are kept alive between requests.
+
+Endpoints:
+    POST /find: Searches an image for templates. The body is an encoded image file (PNG, JPEG,
+        etc.), or raw uint8 pixels if the X-Image-Shape header gives their shape ("H,W" or
+        "H,W,C"). Instead of a body, the shm and shape parameters can name a shared memory segment
+        holding the pixels, so that large images aren't copied through the socket. Other
+        parameters: template (repeatable, defaults to every template), threshold, method, order
+        (the channel order of raw pixels), all (find every match instead of the best one) and
+        max_results. Responds {"matches": [{"template": name, "box": [x, y, w, h] or null}]}, or
+        "boxes" instead of "box" when finding every match.
+    GET /templates: Lists the names of the templates.
+    PUT /templates/<name>: Compiles the encoded image in the body as a template. Parameters:
+        scales ("MIN,MAX", or "none" to only search at the original size).
+    GET /metrics: The process-wide metrics, in the Prometheus text format (or as JSON with
+        format=json).
+
+Requests are searched by a fixed number of worker threads. While every worker is busy, requests
+queue up; a worker that becomes free takes every queued request for the same image at once, and
+decodes the image and computes its pyramid and spectra only once for all of them. Errors are
+reported as {"error": message}, with status 400 for bad requests.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+import urllib.parse
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from typing import Iterable, Mapping, NamedTuple, Optional, Union
+
+import numpy as np
+
+from . import correlation, metrics, pyramid
+from .api import compile
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BGR, BoundingBox, Image
+from .store import TemplateStore
+
+# Default address of a server
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Kinds of image sources
+ENCODED = "encoded"
+PIXELS = "pixels"
+SHARED = "shared"
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 30
+
+
+class SharedImage(NamedTuple):
+    """Raw uint8 pixels held in a shared memory segment, to be searched by a match server."""
+    name: str  # Name of the segment, as in multiprocessing.shared_memory.SharedMemory
+    shape: tuple  # (H, W) or (H, W, C)
+
+
+class ServerError(RuntimeError):
+    """An error response from a match server."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class _Source(NamedTuple):
+    """Where the pixels of a request's image come from."""
+    kind: str
+    data: Union[bytes, str]  # The body, or the name of a shared memory segment
+    shape: Optional[tuple]
+    channel_order: str
+
+    def open(self) -> tuple:
+        """Returns the image, along with the shared memory segment it's in (or None)."""
+        if self.kind == ENCODED:
+            return Image.from_bytes(self.data), None
+        if self.kind == PIXELS:
+            if len(self.data) != np.prod(self.shape):
+                raise ValueError(f"Body has {len(self.data)} bytes, not {np.prod(self.shape)}")
+            return Image.from_array(self.data, self.channel_order, self.shape), None
+        segment = _attach(self.data)
+        if segment.size < np.prod(self.shape):
+            segment.close()
+            raise ValueError(f"Shared memory {self.data} is smaller than the shape {self.shape}")
+        return Image.from_array(segment.buf, self.channel_order, self.shape), segment
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attaches to an existing shared memory segment, which stays owned by its creator."""
+    segment = shared_memory.SharedMemory(name)
+    if sys.version_info < (3, 13) and os.name == "posix":
+        # Before Python 3.13, attaching registers the segment to be unlinked when this process exits
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class _Request(NamedTuple):
+    """A search of one image for some templates."""
+    source: _Source
+    templates: tuple  # Names of the templates
+    threshold: float
+    method: str
+    find_all: bool
+    max_results: Optional[int]
+    start: float  # When the request was received, as a time.perf_counter() value
+    future: concurrent.futures.Future
+
+
+class _Batcher:
+    """Worker threads that search queued requests, batching those for the same image."""
+
+    def __init__(self, server: "MatchServer", workers: int):
+        self._server = server
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work, name=f"imagex-server-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, request: _Request) -> None:
+        with self._condition:
+            self._pending.append(request)
+            self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            for request in self._pending:
+                request.future.set_exception(RuntimeError("The server was closed"))
+            self._pending.clear()
+        for thread in self._threads:
+            thread.join()
+
+    def _take(self) -> Optional[list]:
+        """Waits for a request, and takes it along with every queued request for the same image."""
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            first = self._pending.popleft()
+            batch, rest = [first], collections.deque()
+            for request in self._pending:
+                # Comparing bodies is much cheaper than searching the same image twice
+                (batch if request.source == first.source else rest).append(request)
+            self._pending = rest
+            return batch
+
+    def _work(self) -> None:
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            metrics.SERVER_BATCH_REQUESTS.observe(len(batch))
+            try:
+                self._search(batch)
+            except Exception as error:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+
+    def _search(self, batch: list) -> None:
+        """Searches the image of a batch once for each distinct search in it."""
+        image, segment = batch[0].source.open()
+        try:
+            results = {}
+            for request in batch:
+                found = []
+                for name in request.templates:
+                    key = (name, request.threshold, request.method, request.find_all,
+                           request.max_results)
+                    if key not in results:
+                        template = self._server.templates[name]
+                        if request.find_all:
+                            results[key] = template.find_all(image, request.threshold,
+                                                             request.max_results, request.method)
+                        else:
+                            results[key] = template.find(image, request.threshold, request.method)
+                    found.append(results[key])
+                metrics.record_call("serve", image.image.shape, time.perf_counter() - request.start,
+                                    any(found))
+                request.future.set_result(found)
+        finally:
+            if segment is not None:
+                del image, results
+                try:
+                    segment.close()
+                except BufferError:
+                    # Something still views the pixels; the segment is closed once it's collected
+                    pass
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests of one connection."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "imagex"
+
+    def setup(self) -> None:
+        # Responses are written in two parts, which Nagle's algorithm would delay
+        self.disable_nagle_algorithm = self.request.family != socket.AF_UNIX
+        super().setup()
+
+    def address_string(self) -> str:
+        # Clients of Unix sockets have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.match_server.verbose:
+            super().log_message(format, *args)
+
+    def _respond(self, status: int, body: Union[bytes, str, dict],
+                 content_type: str = "application/json") -> None:
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        size = int(self.headers.get("Content-Length", 0))
+        if size < 0:
+            raise ValueError(f"Invalid Content-Length: {size}")
+        if size > MAX_BODY:
+            raise ValueError(f"Body of {size} bytes is too large")
+        return self.rfile.read(size)
+
+    def _handle(self, method: str) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        # Always read the body, so that the connection can be reused after errors
+        try:
+            body = self._body()
+        except ValueError as error:
+            self.close_connection = True
+            self._respond(400, {"error": str(error)})
+            return
+        server = self.server.match_server
+        try:
+            if method == "POST" and url.path == "/find":
+                self._respond(200, server._find(query, body, self.headers))
+            elif method == "GET" and url.path == "/templates":
+                self._respond(200, {"templates": sorted(server.templates)})
+            elif method == "PUT" and url.path.startswith("/templates/"):
+                name = urllib.parse.unquote(url.path[len("/templates/"):])
+                scales = _parse_scales(query.get("scales", [None])[0])
+                server.add_template(name, Image.from_bytes(body), scales)
+                self._respond(200, {"template": name})
+            elif method == "GET" and url.path == "/metrics":
+                if query.get("format", [metrics.PROMETHEUS])[0] == metrics.JSON:
+                    self._respond(200, metrics.REGISTRY.to_json())
+                else:
+                    self._respond(200, metrics.REGISTRY.to_prometheus(),
+                                  "text/plain; version=0.0.4")
+            else:
+                self._respond(404, {"error": f"Not found: {method} {url.path}"})
+        except (KeyError, ValueError, TypeError, FileNotFoundError) as error:
+            message = f"Unknown template: {error}" if isinstance(error, KeyError) else str(error)
+            self._respond(400, {"error": message})
+        except Exception as error:
+            self._respond(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+
+def _parse_shape(text: str) -> tuple:
+    shape = tuple(int(size) for size in text.split(","))
+    if len(shape) not in (2, 3) or min(shape) <= 0 or (len(shape) == 3 and shape[2] not in (3, 4)):
+        raise ValueError(f"Invalid image shape: {text} (must be H,W or H,W,C with 3 or 4 channels)")
+    return shape
+
+
+def _parse_scales(text: Optional[str]) -> Optional[tuple]:
+    if text is None:
+        return pyramid.DEFAULT_SCALE_RANGE
+    if text.lower() == "none":
+        return None
+    scales = tuple(float(scale) for scale in text.split(","))
+    if len(scales) != 2:
+        raise ValueError(f"Invalid scales: {text}")
+    return scales
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MatchServer:
+    """
+    A server that searches images for compiled templates, kept in memory between requests.
+
+    Use it as a context manager, or call close() when done.
+    """
+
+    def __init__(self, templates: Mapping[str, Union[Image, CompiledTemplate]] = None,
+                 address: Union[tuple, str, os.PathLike] = (DEFAULT_HOST, DEFAULT_PORT),
+                 workers: Optional[int] = None,
+                 scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                 store: Optional[Union[str, os.PathLike, TemplateStore]] = None,
+                 verbose: bool = False):
+        """
+        Compiles the templates and starts listening. Requests are served once serve_forever() or
+        start() is called.
+
+        Args:
+            templates: The templates to search for, by name. More can be added while serving.
+            address: A (host, port) pair to listen on (port 0 picks a free port), or the path of
+                a Unix socket. A stale socket file at the path is replaced.
+            workers: The number of requests searched at once. Defaults to the number of CPUs.
+            scales: The range of scales templates are compiled with (see imagex.compile()).
+            store: A TemplateStore (or the directory of one) to load compiled templates from.
+            verbose: Whether to log every request to stderr.
+        """
+        self.scales = scales
+        self.store = store
+        self.verbose = verbose
+        self.templates = {}
+        for name, template in (templates or {}).items():
+            self.add_template(name, template)
+        if isinstance(address, tuple):
+            self._httpd = _TCPServer(address, _Handler)
+        else:
+            path = os.fspath(address)
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            self._httpd = _UnixServer(path, _Handler)
+        self._httpd.match_server = self
+        self._batcher = _Batcher(self, (os.cpu_count() or 1) if workers is None else workers)
+        self._thread = None
+
+    @property
+    def address(self) -> Union[tuple, str]:
+        """The address the server listens on, as a (host, port) pair or a Unix socket path."""
+        return self._httpd.server_address
+
+    def add_template(self, name: str, template: Union[Image, CompiledTemplate],
+                     scales: Optional[tuple] = None) -> None:
+        """
+        Compiles a template and adds it (replacing any template of the same name).
+
+        Args:
+            scales: The range of scales to compile the template with. Defaults to the server's.
+        """
+        if not isinstance(template, CompiledTemplate):
+            template = compile(template, self.scales if scales is None else scales,
+                               store=self.store)
+        self.templates[name] = template
+
+    def _find(self, query: dict, body: bytes, headers) -> dict:
+        """Searches the image of a /find request."""
+        order = query.get("order", [BGR])[0]
+        if "shm" in query:
+            if "shape" not in query:
+                raise ValueError("Missing query parameter: shape (of the shared memory image)")
+            source = _Source(SHARED, query["shm"][0], _parse_shape(query["shape"][0]), order)
+        elif headers.get("X-Image-Shape"):
+            source = _Source(PIXELS, body, _parse_shape(headers["X-Image-Shape"]), order)
+        elif body:
+            source = _Source(ENCODED, body, None, BGR)
+        else:
+            raise ValueError("No image given")
+        names = tuple(query.get("template", sorted(self.templates)))
+        for name in names:
+            if name not in self.templates:
+                raise KeyError(name)
+        method = query.get("method", [correlation.AUTO])[0]
+        if method not in correlation.METHODS:
+            raise ValueError(f"Invalid method: {method}")
+        find_all = query.get("all", ["0"])[0] not in ("0", "false")
+        max_results = int(query["max_results"][0]) if "max_results" in query else None
+        if max_results is not None and max_results < 1:
+            raise ValueError(f"Invalid max_results: {max_results} (must be at least 1)")
+        future = concurrent.futures.Future()
+        self._batcher.submit(_Request(
+            source, names, float(query.get("threshold", [DEFAULT_THRESHOLD])[0]), method, find_all,
+            max_results, time.perf_counter(), future))
+        found = future.result()
+        if find_all:
+            return {"matches": [{"template": name, "boxes": [list(box.to_tuple()) for box in boxes]}
+                                for name, boxes in zip(names, found)]}
+        return {"matches": [{"template": name, "box": None if box is None else list(box.to_tuple())}
+                            for name, box in zip(names, found)]}
+
+    def serve_forever(self) -> None:
+        """Serves requests until close() is called."""
+        self._httpd.serve_forever()
+
+    def start(self) -> "MatchServer":
+        """Serves requests in a background thread, and returns the server."""
+        self._thread = threading.Thread(target=self.serve_forever, name="imagex-server",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Stops serving and releases the address."""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+        self._batcher.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def __enter__(self) -> "MatchServer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class MatchClient:
+    """
+    A client of a match server, which keeps its connection open between requests.
+
+    A client sends one request at a time; use one client per thread to send requests concurrently.
+    """
+
+    def __init__(self, address: Union[tuple, str, os.PathLike] = (DEFAULT_HOST, DEFAULT_PORT),
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            address: The server's (host, port) pair, or the path of its Unix socket.
+            timeout: The timeout of each request, in seconds.
+        """
+        if isinstance(address, tuple):
+            self._connection = http.client.HTTPConnection(*address, timeout=timeout)
+        else:
+            self._connection = _UnixConnection(os.fspath(address), timeout)
+
+    def _request(self, method: str, path: str, query: Iterable[tuple] = (), body: bytes = None,
+                 headers: Optional[dict] = None) -> bytes:
+        """Sends a request and returns the body of the response, raising a ServerError if failed."""
+        url = path + ("?" + urllib.parse.urlencode(list(query)) if query else "")
+        headers = dict(headers or {})
+        headers["Content-Length"] = str(0 if body is None else len(body))
+        try:
+            self._connection.request(method, url, body, headers)
+            response = self._connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # Reconnect on the next request
+            self._connection.close()
+            raise
+        if response.status != 200:
+            try:
+                message = json.loads(data)["error"]
+            except (ValueError, KeyError):
+                message = data.decode(errors="replace")
+            raise ServerError(response.status, message)
+        return data
+
+    def _find(self, image, templates: Optional[Iterable[str]], threshold: float, method: str,
+              channel_order: str, extra: list) -> list:
+        query = [("template", name) for name in templates or []]
+        query += [("threshold", threshold), ("method", method)] + extra
+        body, headers = None, {}
+        if isinstance(image, SharedImage):
+            query += [("shm", image.name), ("shape", ",".join(map(str, image.shape))),
+                      ("order", channel_order)]
+        elif isinstance(image, np.ndarray):
+            if image.dtype != np.uint8:
+                raise TypeError(f"Invalid image dtype: {image.dtype}")
+            body = np.ascontiguousarray(image).data.cast("B")
+            headers["X-Image-Shape"] = ",".join(map(str, image.shape))
+            query.append(("order", channel_order))
+        elif isinstance(image, (str, os.PathLike)):
+            body = Path(image).read_bytes()
+        else:
+            body = image
+        return json.loads(self._request("POST", "/find", query, body, headers))["matches"]
+
+    def find(self, image: Union[bytes, np.ndarray, SharedImage, str, os.PathLike],
+             templates: Optional[Iterable[str]] = None, threshold: float = DEFAULT_THRESHOLD,
+             method: str = correlation.AUTO, channel_order: str = BGR) -> dict:
+        """
+        Finds templates in an image.
+
+        Args:
+            image: The image to search in: an encoded image file (as bytes, or the path to it), a
+                uint8 array of pixels, or a SharedImage.
+            templates: The names of the templates to search for. Defaults to all of them.
+            threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+            method: The correlation engine to use.
+            channel_order: The order of the channels of an array or shared image.
+
+        Returns:
+            A dict from each template's name to its bounding box, or None if it wasn't found.
+        """
+        matches = self._find(image, templates, threshold, method, channel_order, [])
+        return {match["template"]: None if match["box"] is None else BoundingBox(*match["box"])
+                for match in matches}
+
+    def find_all(self, image: Union[bytes, np.ndarray, SharedImage, str, os.PathLike],
+                 templates: Optional[Iterable[str]] = None, threshold: float = DEFAULT_THRESHOLD,
+                 max_results: Optional[int] = None, method: str = correlation.AUTO,
+                 channel_order: str = BGR) -> dict:
+        """
+        Finds every occurrence of templates in an image. See find() for the arguments.
+
+        Returns:
+            A dict from each template's name to its bounding boxes, sorted by decreasing score.
+        """
+        extra = [("all", 1)] + ([] if max_results is None else [("max_results", max_results)])
+        matches = self._find(image, templates, threshold, method, channel_order, extra)
+        return {match["template"]: [BoundingBox(*box) for box in match["boxes"]]
+                for match in matches}
+
+    def add_template(self, name: str, template: Union[bytes, str, os.PathLike],
+                     scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE) -> None:
+        """
+        Compiles a template on the server.
+
+        Args:
+            template: The template, as an encoded image file or the path to one.
+            scales: The range of scales to search, or None to only search the original size.
+        """
+        if isinstance(template, (str, os.PathLike)):
+            template = Path(template).read_bytes()
+        scales = "none" if scales is None else ",".join(map(str, scales))
+        self._request("PUT", f"/templates/{urllib.parse.quote(name, safe='')}",
+                      [("scales", scales)], template)
+
+    def templates(self) -> list:
+        """Returns the names of the server's templates."""
+        return json.loads(self._request("GET", "/templates"))["templates"]
+
+    def metrics(self, format: str = metrics.PROMETHEUS) -> Union[str, dict]:
+        """Returns the server's metrics, as Prometheus text or (with format=JSON) as a dict."""
+        data = self._request("GET", "/metrics", [("format", format)])
+        return json.loads(data) if format == metrics.JSON else data.decode()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "MatchClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
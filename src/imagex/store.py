@@ -0,0 +1,155 @@
+"""
+An on-disk store of compiled templates.
+
+Compiling a template builds all of its variants, masks, log-polar spectra and keypoint descriptors.
+A store saves that state once, so that other processes (like the workers of a server) load it
+instead of compiling the template again. Entries are keyed by the template's pixels and compile
+parameters, and are memory-mapped read-only when loaded: every process that loads an entry shares
+the same physical pages of its arrays.
+
+An entry is a single file, holding a JSON header, a pickle of the compiled template with its NumPy
+arrays left out of band (pickle protocol 5), and the raw bytes of those arrays. The pickle and each
+array start at a multiple of ALIGNMENT bytes. Unpickling can run arbitrary code, so only load
+stores from trusted locations.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import hashlib
+import json
+import mmap
+import os
+import pickle
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from . import files, metrics, pyramid
+from .compiled import CompiledTemplate
+from .image import BGR, Image
+
+# Version of the store's format and of the compiled template state. Bump it when either changes, so
+# that old entries are ignored instead of loaded.
+STORE_VERSION = 2
+# Identifies store entries
+MAGIC = b"IMAGEX-TEMPLATE\n"
+# Alignment of the array data in an entry, in bytes
+ALIGNMENT = 64
+# File extension of store entries
+SUFFIX = ".template"
+
+
+def _aligned(offset: int) -> int:
+    """Rounds an offset up to the next multiple of ALIGNMENT."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class TemplateStore:
+    """A directory of compiled templates, shared between processes."""
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        """
+        Args:
+            path: The directory of the store. Created when the first template is saved.
+        """
+        self.path = Path(path)
+
+    def __repr__(self) -> str:
+        return f"TemplateStore({str(self.path)!r})"
+
+    def key(self, template: Image, scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+            angles: Optional[Iterable[float]] = (0,), flips: bool = False,
+            use_features: bool = False) -> str:
+        """Returns the key of a template compiled with the given parameters (see compile())."""
+        pixels = template.array(BGR)
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": STORE_VERSION, "shape": pixels.shape, "dtype": str(pixels.dtype),
+            "scales": None if scales is None else [float(scale) for scale in scales],
+            "angles": None if angles is None else [float(angle) for angle in angles],
+            "flips": flips, "use_features": use_features,
+        }, sort_keys=True).encode())
+        digest.update(pixels.tobytes())
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.path / f"{key}{SUFFIX}"
+
+    def load(self, key: str) -> Optional[CompiledTemplate]:
+        """
+        Loads a compiled template, memory-mapping its arrays (which are read-only).
+
+        Returns:
+            The compiled template, or None if the store doesn't have it (or has an entry written by
+            a different version of the store, or a corrupt one).
+        """
+        try:
+            with open(self._entry(key), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised for empty files
+            return None
+        view = memoryview(data)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            return None
+        header_size = int.from_bytes(view[len(MAGIC):len(MAGIC) + 8], "little")
+        header_start = len(MAGIC) + 8
+        try:
+            header = json.loads(bytes(view[header_start:header_start + header_size]))
+            if header["version"] != STORE_VERSION:
+                return None
+            # Offsets are relative to the end of the header
+            start = _aligned(header_start + header_size)
+            sizes = [header["pickle"]] + header["buffers"]
+            sections = [view[start + offset:start + offset + size] for offset, size in sizes]
+            if any(section.nbytes != size for section, (_, size) in zip(sections, sizes)):
+                # Truncated
+                return None
+            return pickle.loads(sections[0], buffers=sections[1:])
+        except (ValueError, KeyError, TypeError, EOFError, pickle.UnpicklingError):
+            # Corrupt entries are treated as missing, so that the template is compiled again
+            return None
+
+    def save(self, compiled: CompiledTemplate) -> str:
+        """
+        Saves a compiled template, replacing any existing entry atomically.
+
+        Any spectra and resized copies cached by searches done with the template are saved too.
+
+        Returns:
+            The template's key.
+        """
+        key = self.key(compiled.template, compiled.scales, compiled.angles, compiled.flips,
+                       compiled.features is not None)
+        buffers = []
+        payload = pickle.dumps(compiled, protocol=5, buffer_callback=buffers.append)
+        sections = [memoryview(payload)] + [buffer.raw() for buffer in buffers]
+        locations, offset = [], 0
+        for section in sections:
+            locations.append([offset, section.nbytes])
+            offset = _aligned(offset + section.nbytes)
+        header = json.dumps({"version": STORE_VERSION, "pickle": locations[0],
+                             "buffers": locations[1:]}).encode()
+        start = _aligned(len(MAGIC) + 8 + len(header))
+        self.path.mkdir(parents=True, exist_ok=True)
+        with files.replace_atomically(self._entry(key)) as file:
+            file.write(MAGIC + len(header).to_bytes(8, "little") + header)
+            for (offset, _), section in zip(locations, sections):
+                file.seek(start + offset)
+                file.write(section)
+        return key
+
+    def compile(self, template: Image, scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                angles: Optional[Iterable[float]] = (0,), flips: bool = False,
+                use_features: bool = False,
+                max_difference: Optional[float] = None) -> CompiledTemplate:
+        """Loads a compiled template from the store, compiling and saving it if it isn't there."""
+        key = self.key(template, scales, angles, flips, use_features)
+        compiled = self.load(key)
+        metrics.record_cache("template_store", compiled is not None)
+        if compiled is None:
+            compiled = CompiledTemplate(template, scales, angles, flips, use_features)
+            self.save(compiled)
+        # Only a search setting, so entries are shared by templates compiled with any value of it
+        compiled.max_difference = max_difference
+        return compiled
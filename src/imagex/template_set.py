@@ -0,0 +1,182 @@
+"""
+Searching for many templates in the same image at once.
+
+Like a regex alternation compiled into one automaton, a template set looks for all of its templates
+in one pass over the image. The image is decoded and converted once, and its pyramid, summed-area
+tables and FFT spectra are shared by every template. Templates of the same size also share their
+window statistics and rolling hashes, and are correlated together, with batched inverse FFTs, both
+at their original size and at every scale of the coarse stage of the pyramid search. Refining the
+candidates of each template, and finding rotated matches, is still done template by template.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import time
+from typing import Hashable, Iterable, Mapping, NamedTuple, Optional, Union
+
+from . import correlation, exact, features, metrics, pyramid
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BoundingBox, Image
+
+
+class TemplateHit(NamedTuple):
+    """A match of one of the templates of a template set."""
+    label: Hashable
+    box: BoundingBox
+    score: float
+
+
+class TemplateSet:
+    """Templates compiled to be searched for together, each with a label."""
+
+    def __init__(self, templates: Union[Mapping[Hashable, Union[Image, CompiledTemplate]],
+                                        Iterable[Union[Image, CompiledTemplate]]],
+                 scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                 angles: Optional[Iterable[float]] = (0,), flips: bool = False,
+                 max_difference: Optional[float] = None):
+        """
+        Compiles the templates. See imagex.compile() for the other arguments.
+
+        Args:
+            templates: The templates, either as a mapping from labels to templates, or as a
+                sequence (labelled by their index). Templates can be compiled, in which case
+                scales, angles, flips and max_difference are ignored in favor of their compiled
+                ones.
+        """
+        items = templates.items() if isinstance(templates, Mapping) else enumerate(templates)
+        angles = None if angles is None else tuple(angles)
+        self.templates = {label: template if isinstance(template, CompiledTemplate)
+                          else CompiledTemplate(template, scales, angles, flips,
+                                                max_difference=max_difference)
+                          for label, template in items}
+        # Labels by template size, for exact matching
+        self._sizes = {}
+        # (label, variant index) pairs by variant size and max_difference, for correlation
+        self._variant_sizes = {}
+        for label, template in self.templates.items():
+            self._sizes.setdefault(template.template.image.shape[:2], []).append(label)
+            for index, variant in enumerate(template.variants):
+                self._variant_sizes.setdefault((variant.shape[:2], template.max_difference),
+                                               []).append((label, index))
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def _search_exact(self, image: Image) -> dict:
+        """Returns the exact matches of every template that has one, by label."""
+        pixels = image.colors(image.channel_order)
+        height, width = pixels.shape[:2]
+        results = {}
+        for (h, w), labels in self._sizes.items():
+            hashes = None
+            if h <= height and w <= width and any(self.templates[label].template.mask is None
+                                                  for label in labels):
+                hashes = exact.window_hashes(pixels, h, w)
+            for label in labels:
+                candidate = self.templates[label].search_exact(pixels, image.channel_order, hashes)
+                if candidate is not None:
+                    results[label] = candidate
+        return results
+
+    def match(self, image: Image, method: str = correlation.AUTO,
+              threshold: Optional[float] = None) -> dict:
+        """
+        Finds the best match of every template in the image, along with its score.
+
+        Each template is searched for as by CompiledTemplate.match(), except that the
+        correlations at the templates' original sizes, and at the coarse scales of the pyramid
+        search, are batched by size.
+
+        Args:
+            image: The image to search in.
+            method: The correlation engine to use.
+            threshold: If given, scaled candidates that can't reach this score are dropped early.
+
+        Returns:
+            A dict from each label to the template's best candidate, or None if the template
+            doesn't fit in the image.
+        """
+        results = self._search_exact(image)
+        # Keypoint matches too weak to be accepted are still compared with the other candidates
+        weak = {}
+        for label, template in self.templates.items():
+            if label not in results and template.features is not None:
+                candidate = template.features.search(image, template.scales, template.angles,
+                                                     method)
+                if candidate is not None and candidate.score >= features.ACCEPT_THRESHOLD:
+                    results[label] = candidate
+                else:
+                    weak[label] = candidate
+        levels = image.pyramid
+        original = {label: [None] * len(template.variants)
+                    for label, template in self.templates.items() if label not in results}
+        for ((h, w), max_difference), members in self._variant_sizes.items():
+            members = [(label, index) for label, index in members if label in original]
+            if not members:
+                continue
+            prepared = [self.templates[label].variants[index].prepared for label, index in members]
+            scores = correlation.match_templates(levels[0], prepared, method, levels.integrals(0),
+                                                 max_difference, levels.spectra(0))
+            for (label, index), score_map in zip(members, scores):
+                original[label][index] = correlation.best_candidate(score_map, h, w)
+        scaled = self._search_scales(levels, original, method, threshold)
+        for label, candidates in original.items():
+            results[label] = correlation.pick_best(
+                [weak.get(label), self.templates[label].search(levels, method, candidates,
+                                                                 threshold,
+                                                                 scaled=scaled.get(label))])
+        return {label: results[label] for label in self.templates}
+
+    def _search_scales(self, levels: pyramid.Pyramid, original: dict, method: str,
+                       threshold: Optional[float]) -> dict:
+        """
+        Searches the scales of the templates that need it, together for variants of equal shape.
+
+        Returns:
+            The best scaled candidate of every variant, by label, for the templates whose search
+            goes on to other scales.
+        """
+        groups = {}
+        for label, candidates in original.items():
+            template = self.templates[label]
+            if not template.needs_scales(correlation.pick_best(
+                    [candidate for candidate in candidates if candidate is not None])):
+                continue
+            for index, variant in enumerate(template.variants):
+                groups.setdefault((variant.shape, template.scales, template.max_difference),
+                                  []).append((label, index))
+        scaled = {}
+        for (_, scales, max_difference), members in groups.items():
+            variants = [self.templates[label].variants[index] for label, index in members]
+            if len(variants) == 1:
+                found = [pyramid.search_scales(levels, variants[0], scales, method, threshold,
+                                               max_difference)]
+            else:
+                found = pyramid.search_scales_batch(levels, variants, scales, method, threshold,
+                                                    max_difference)
+            for (label, index), candidate in zip(members, found):
+                count = len(self.templates[label].variants)
+                scaled.setdefault(label, [None] * count)[index] = candidate
+        return scaled
+
+    def find(self, image: Image, threshold: float = DEFAULT_THRESHOLD,
+             method: str = correlation.AUTO) -> list:
+        """
+        Finds every template in the image.
+
+        Args:
+            image: The image to search in.
+            threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+            method: The correlation engine to use.
+
+        Returns:
+            The best match of every template that was found, sorted by decreasing score.
+        """
+        start = time.perf_counter()
+        hits = [TemplateHit(label, BoundingBox(c.x, c.y, c.w, c.h), c.score)
+                for label, c in self.match(image, method, threshold).items()
+                if c is not None and c.score >= threshold]
+        hits.sort(key=lambda hit: hit.score, reverse=True)
+        metrics.record_call("find_any", image.image.shape, time.perf_counter() - start, bool(hits))
+        return hits
@@ -0,0 +1,168 @@
+"""
+Tiled, memory-bounded search for very large images.
+
+The image is split into blocks of template positions. Each tile holds one block, plus an overlap
+big enough for the largest template searched to fit at every position of the block, plus one
+extra position on each side so that local maxima are found exactly as on the full image. Tiles
+are read from the image one at a time (from a memory-mapped .npy file, only the tile's pages are
+read), searched, and their results are merged.
+
+For templates searched at their original size, scores depend only on the pixels of each window,
+so the results are identical to a search of the full image. The overlap also fits the template at
+its largest scale, so pyramid (scaled) searches find the same matches. Their scores can differ by
+rounding though, since each tile has its own pyramid levels (and may be correlated by another
+engine), so matches that score (nearly) the same can be ordered differently.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import math
+from typing import Iterator, Optional
+
+from . import correlation, peaks, pyramid, tracing
+from .correlation import Candidate
+
+# Estimated working memory of a search, in bytes per image pixel and channel
+BYTES_PER_PIXEL = 64
+
+
+def search_memory(shape: tuple) -> int:
+    """Returns the estimated working memory of searching an image of the given shape."""
+    channels = shape[2] if len(shape) > 2 else 1
+    return shape[0] * shape[1] * channels * BYTES_PER_PIXEL
+
+
+def template_extent(compiled, image_shape: tuple) -> tuple:
+    """
+    Returns the (h, w) of the largest window a compiled template can match in an image.
+
+    Args:
+        compiled: The CompiledTemplate.
+        image_shape: The shape of the image.
+    """
+    max_scale = 1.0 if compiled.scales is None else compiled.scales[1]
+    h, w = 0, 0
+    for variant in compiled.variants:
+        vh, vw = variant.shape[:2]
+        if compiled.angles is None:
+            # Any rotation of the variant fits in a square as wide as its diagonal
+            vh = vw = math.ceil(math.hypot(vh, vw))
+        h, w = max(h, math.ceil(vh * max_scale)), max(w, math.ceil(vw * max_scale))
+    return min(h, image_shape[0]), min(w, image_shape[1])
+
+
+def tiles(image_shape: tuple, extent: tuple, max_memory: int) -> Iterator[tuple]:
+    """
+    Splits an image into overlapping tiles that fit in a memory budget.
+
+    Args:
+        image_shape: The shape of the image.
+        extent: The (h, w) of the largest window to search for.
+        max_memory: The memory budget of searching one tile, in bytes.
+
+    Yields:
+        The (x1, y1, x2, y2) pixel region of each tile, along with the (bx1, by1, bx2, by2) block of
+        window positions that the tile is responsible for, both in image coordinates.
+    """
+    height, width = image_shape[:2]
+    channels = image_shape[2] if len(image_shape) > 2 else 1
+    side = math.isqrt(max_memory // (channels * BYTES_PER_PIXEL))
+    block_h, block_w = side - extent[0] - 1, side - extent[1] - 1
+    if block_h < 1 or block_w < 1:
+        raise ValueError(f"max_memory of {max_memory} bytes is too small for a template of size "
+                         f"{extent[1]}x{extent[0]}")
+    for by1 in range(0, height - extent[0] + 1, block_h):
+        by2 = min(by1 + block_h, height - extent[0] + 1)
+        for bx1 in range(0, width - extent[1] + 1, block_w):
+            bx2 = min(bx1 + block_w, width - extent[1] + 1)
+            # One extra position on each side, for finding local maxima
+            region = (max(0, bx1 - 1), max(0, by1 - 1), min(width, bx2 + extent[1]),
+                      min(height, by2 + extent[0]))
+            yield region, (bx1, by1, bx2, by2)
+
+
+def _tile_pyramid(image, region: tuple) -> pyramid.Pyramid:
+    """Reads one tile of an image and builds its pyramid."""
+    x1, y1, x2, y2 = region
+    return pyramid.Pyramid(correlation.to_float(image.array()[y1:y2, x1:x2]))
+
+
+@tracing.timed("tiles")
+def search(compiled, image, method: str, max_memory: int, threshold: Optional[float] = None,
+           scales: Optional[tuple] = None,
+           max_difference: Optional[float] = None) -> Optional[Candidate]:
+    """
+    Finds the best match of a compiled template, one tile at a time.
+
+    Args:
+        compiled: The CompiledTemplate.
+        image: The Image to search in.
+        method: The correlation engine to use.
+        max_memory: The memory budget of searching one tile, in bytes.
+        threshold: If given, scaled candidates that can't reach this score are dropped early.
+        scales: If given, the range of scales to search instead of the compiled one.
+        max_difference: If given, the largest RMS color difference of a matching window to use
+            instead of the compiled one.
+
+    Returns:
+        The best candidate, in image coordinates, or None if the template doesn't fit.
+    """
+    shape = image.image.shape
+    regions = list(tiles(shape, template_extent(compiled, shape), max_memory))
+    # Exact copies win over everything else, so look for them in every tile first
+    exact = []
+    for (x1, y1, x2, y2), _ in regions:
+        candidate = compiled.search_exact(image.image[y1:y2, x1:x2], image.channel_order)
+        if candidate is not None:
+            exact.append(candidate._replace(x=candidate.x + x1, y=candidate.y + y1))
+    if exact:
+        return min(exact, key=lambda c: (c.y, c.x))
+    candidates = []
+    for region, _ in regions:
+        candidate = compiled.search(_tile_pyramid(image, region), method, threshold=threshold,
+                                    scales=scales, max_difference=max_difference)
+        if candidate is not None:
+            candidates.append(candidate._replace(x=candidate.x + region[0],
+                                                 y=candidate.y + region[1]))
+    # Break exact ties like a search of the full image would, in row-major order
+    candidates.sort(key=lambda c: (c.y, c.x))
+    return correlation.pick_best(candidates)
+
+
+@tracing.timed("tiles")
+def search_all(compiled, image, threshold: float, max_results: Optional[int], method: str,
+               max_overlap: float, max_memory: int,
+               max_difference: Optional[float] = None) -> list:
+    """
+    Finds all matches of a compiled template, one tile at a time.
+
+    Each tile keeps every match whose top-left corner is in its block, without suppressing any,
+    and non-maximum suppression is done once over all tiles.
+
+    Args:
+        compiled: The CompiledTemplate.
+        image: The Image to search in.
+        threshold: The minimum score of a match.
+        max_results: If given, at most this many (best scoring) matches are returned.
+        method: The correlation engine to use.
+        max_overlap: The maximum fraction of a match that may be covered by a better match.
+        max_memory: The memory budget of searching one tile, in bytes.
+        max_difference: If given, the largest RMS color difference of a matching window to use
+            instead of the compiled one.
+
+    Returns:
+        A list of candidates in image coordinates, sorted by decreasing score.
+    """
+    shape = image.image.shape
+    candidates = []
+    for region, (bx1, by1, bx2, by2) in tiles(shape, template_extent(compiled, shape), max_memory):
+        for candidate in compiled.search_all(_tile_pyramid(image, region), threshold,
+                                             method=method, max_overlap=1.0,
+                                             max_difference=max_difference):
+            x, y = candidate.x + region[0], candidate.y + region[1]
+            if bx1 <= x < bx2 and by1 <= y < by2:
+                candidates.append(candidate._replace(x=x, y=y))
+    # Sorted like the peaks of a full-image score map, so that ties are broken the same way
+    candidates.sort(key=lambda c: (c.y, c.x))
+    return peaks.suppress_candidates(candidates, max_overlap, max_results)
@@ -0,0 +1,321 @@
+"""
+Opt-in instrumentation of searches.
+
+While a search is traced, every stage (decoding, color conversion, pyramid building, correlation,
+peak extraction, verification, ...) records its time and the memory it allocated, and the coarse
+pyramid search records how many candidates each level produced. Stages nest, so a stage is named
+by its path, like "scales/correlate" for correlations done by the pyramid search.
+
+Tracing is off unless a call asks for it (like imagex.find(..., trace=True)) or a collect_traces()
+block is active, and then costs one context variable lookup per stage. Traced calls are slower than
+untraced ones, since memory is measured with tracemalloc, which hooks every allocation made by
+Python and NumPy; compare timings of traced calls with each other, not with untraced calls.
+
+Memory peaks are process-wide, so only one trace at a time can measure them. Traces that start
+while another one is measuring (like in other threads) report their memory as None. The measured
+trace can also include allocations made by other threads while it runs.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+import tracemalloc
+from typing import Callable, Iterator, Optional
+
+# Separates the names of nested stages
+SEPARATOR = "/"
+
+# The trace of the current call, if it is being traced
+_current = contextvars.ContextVar("imagex_trace", default=None)
+# The active collect_traces() collector, if any
+_collector = contextvars.ContextVar("imagex_collector", default=None)
+
+# Guards the tracemalloc state below, which is shared by every trace in the process
+_memory_lock = threading.Lock()
+# Number of traces in progress
+_active_traces = 0
+# Whether tracing started tracemalloc, in which case the last trace to finish stops it
+_started_tracemalloc = False
+# Whether a trace is measuring memory (and so resetting tracemalloc's peak)
+_measuring = False
+
+
+class Stage:
+    """The totals of one stage of a traced call."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        # Peak memory allocated by the stage (through NumPy or Python), in bytes, or None if it
+        # wasn't measured
+        self.bytes = 0
+
+    def __repr__(self) -> str:
+        return f"Stage({self.seconds * 1000:.3f} ms, {self.calls} calls, {self.bytes} bytes)"
+
+
+class Trace:
+    """A stage-by-stage breakdown of one traced call."""
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name: The name of the traced call, like "find".
+        """
+        self.name = name
+        # The value returned by the call
+        self.result = None
+        # Total time of the call, in seconds
+        self.seconds = 0.0
+        # Peak memory allocated during the call, in bytes, or None if it wasn't measured
+        self.bytes = 0
+        # Stages by path, in the order they were first entered
+        self.stages = {}
+        # Named counts, like the candidates found on each pyramid level
+        self.counts = {}
+        # Each frame is [path, start time, memory at start, peak memory seen so far]
+        self._stack = []
+        # Whether this trace measures memory
+        self._measures = False
+
+    def __repr__(self) -> str:
+        return (f"Trace({self.name!r}, {self.seconds * 1000:.3f} ms, {self.bytes} bytes, "
+                f"{len(self.stages)} stages)")
+
+    def _enter(self, name: str) -> None:
+        """Starts timing a (nested) stage."""
+        parent = self._stack[-1][0] if self._stack else ""
+        path = SEPARATOR.join([parent, name]) if parent else name
+        if not self._measures:
+            self._stack.append([path, time.perf_counter(), None, None])
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1][3] = max(self._stack[-1][3], peak)
+        tracemalloc.reset_peak()
+        self._stack.append([path, time.perf_counter(), current, current])
+
+    def _exit(self) -> tuple:
+        """Stops timing the innermost stage, returning its (path, seconds, bytes or None)."""
+        path, start, start_memory, peak = self._stack.pop()
+        seconds = time.perf_counter() - start
+        if not self._measures:
+            return path, seconds, None
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if self._stack:
+            self._stack[-1][3] = max(self._stack[-1][3], peak)
+        return path, seconds, peak - start_memory
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Times a stage of the call."""
+        self._enter(name)
+        stage = self.stages.setdefault(self._stack[-1][0], Stage())
+        try:
+            yield
+        finally:
+            _, seconds, allocated = self._exit()
+            stage.seconds += seconds
+            stage.calls += 1
+            stage.bytes = None if allocated is None else max(stage.bytes, allocated)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Adds to a named count."""
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def summary(self) -> str:
+        """Returns a human readable table of the stages, as indented paths."""
+        lines = [f"{self.name}: {self.seconds * 1000:.3f} ms, {_mebibytes(self.bytes)} MiB"]
+        for path, stage in self.stages.items():
+            depth = path.count(SEPARATOR)
+            name = "  " * (depth + 1) + path.rsplit(SEPARATOR, 1)[-1]
+            lines.append(f"{name:<40} {stage.seconds * 1000:>10.3f} ms {stage.calls:>6} calls "
+                         f"{_mebibytes(stage.bytes):>8} MiB")
+        for name, amount in self.counts.items():
+            lines.append(f"  {name:<38} {amount:>10}")
+        return "\n".join(lines)
+
+
+class TraceCollector:
+    """The traces of every call made inside a collect_traces() block."""
+
+    def __init__(self):
+        self.traces = []
+
+    def __len__(self) -> int:
+        return len(self.traces)
+
+    def stages(self) -> dict:
+        """Returns the totals of every stage path over all collected traces."""
+        totals = {}
+        for trace in self.traces:
+            for path, stage in trace.stages.items():
+                total = totals.setdefault(path, Stage())
+                total.seconds += stage.seconds
+                total.calls += stage.calls
+                if stage.bytes is not None:
+                    total.bytes = max(total.bytes, stage.bytes)
+        return totals
+
+
+def _mebibytes(size: Optional[int]) -> str:
+    """Formats a number of bytes in MiB, or "n/a" if it wasn't measured."""
+    return "n/a" if size is None else f"{size / 2 ** 20:.1f}"
+
+
+def current() -> Optional[Trace]:
+    """Returns the trace of the current call, or None if it isn't traced."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times a stage of the current call, if it is traced."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+
+def timed(name: str) -> Callable:
+    """Decorates a function so that every call to it is timed as a stage, if traced."""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return function(*args, **kwargs)
+            with trace.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Adds to a named count of the current call, if it is traced."""
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, amount)
+
+
+@contextlib.contextmanager
+def traced(name: str, enabled: bool = False) -> Iterator[Optional[Trace]]:
+    """
+    Traces a call, if asked to or if traces are being collected.
+
+    Inside a call that is already traced, this is just another stage of the outer trace. If the
+    call asks to be traced, it still gets a trace of its own, whose stages are also added to the
+    outer trace, under the call's stage.
+
+    Args:
+        name: The name of the call.
+        enabled: Whether to trace the call even if no traces are being collected.
+
+    Yields:
+        The new trace, or None if the call isn't traced (or is part of an outer trace, without
+        asking to be traced).
+    """
+    outer = _current.get()
+    if outer is not None:
+        with outer.stage(name):
+            if not enabled:
+                yield None
+                return
+            with _child_trace(outer, name) as trace:
+                yield trace
+        return
+    collector = _collector.get()
+    if not enabled and collector is None:
+        yield None
+        return
+    trace = Trace(name)
+    _start_trace(trace)
+    token = _current.set(trace)
+    # The call itself is the unnamed outermost stage
+    trace._enter("")
+    try:
+        yield trace
+    finally:
+        _, trace.seconds, trace.bytes = trace._exit()
+        _current.reset(token)
+        _finish_trace(trace)
+        if collector is not None:
+            collector.traces.append(trace)
+
+
+@contextlib.contextmanager
+def _child_trace(outer: Trace, name: str) -> Iterator[Trace]:
+    """Traces a call inside the current stage of an outer trace, adding its stages to it."""
+    trace = Trace(name)
+    # The outer trace already holds tracemalloc, and measures memory if it is allowed to
+    trace._measures = outer._measures
+    token = _current.set(trace)
+    trace._enter("")
+    start_memory = trace._stack[0][2]
+    try:
+        yield trace
+    finally:
+        _, trace.seconds, trace.bytes = trace._exit()
+        _current.reset(token)
+        parent = outer._stack[-1]
+        if trace.bytes is not None:
+            # The child reset tracemalloc's peak, so pass its peak on to the outer stage
+            parent[3] = max(parent[3], start_memory + trace.bytes)
+        for path, child in trace.stages.items():
+            total = outer.stages.setdefault(SEPARATOR.join([parent[0], path]), Stage())
+            total.seconds += child.seconds
+            total.calls += child.calls
+            total.bytes = None if child.bytes is None else max(total.bytes or 0, child.bytes)
+        for count_name, amount in trace.counts.items():
+            outer.count(count_name, amount)
+
+
+def _start_trace(trace: Trace) -> None:
+    """Starts tracemalloc if needed, and lets the trace measure memory if no other trace is."""
+    global _active_traces, _started_tracemalloc, _measuring
+    with _memory_lock:
+        if _active_traces == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracemalloc = True
+        _active_traces += 1
+        if not _measuring:
+            _measuring = trace._measures = True
+
+
+def _finish_trace(trace: Trace) -> None:
+    """Stops tracemalloc once the last trace is done, if tracing started it."""
+    global _active_traces, _started_tracemalloc, _measuring
+    with _memory_lock:
+        if trace._measures:
+            _measuring = False
+        _active_traces -= 1
+        if _active_traces == 0 and _started_tracemalloc:
+            tracemalloc.stop()
+            _started_tracemalloc = False
+
+
+@contextlib.contextmanager
+def collect_traces() -> Iterator[TraceCollector]:
+    """
+    Traces every search made inside the block.
+
+    Example:
+        with imagex.collect_traces() as traces:
+            for image in images:
+                imagex.find(image, template)
+        for path, stage in traces.stages().items():
+            print(path, stage)
+    """
+    collector = TraceCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
@@ -0,0 +1,145 @@
+"""
+Template tracking over streams of frames, like video or screen captures.
+
+Once the template has been found, the next frame is only searched in a region around the previous
+match, and only at scales near the previous match's. If the template isn't found there with enough
+confidence, the whole frame is searched, at every scale.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import time
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+from . import correlation, metrics, pyramid
+from .compiled import CompiledTemplate, DEFAULT_THRESHOLD
+from .image import BoundingBox, Image
+
+# Margin searched around the previous match, as a fraction of its size, on each side
+SEARCH_MARGIN = 0.5
+# Smallest margin searched around the previous match, in pixels
+MIN_SEARCH_MARGIN = 8
+# Largest ratio between the scales of the previous match and of a match searched for near it
+SCALE_CHANGE = 1.25
+
+
+class Tracker:
+    """Follows a template from frame to frame, searching near its last position first."""
+
+    def __init__(self, template: Union[Image, CompiledTemplate],
+                 threshold: float = DEFAULT_THRESHOLD, method: str = correlation.AUTO,
+                 scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                 margin: float = SEARCH_MARGIN):
+        """
+        Args:
+            template: The template to track. Can be a compiled template, in which case scales is
+                ignored in favor of the compiled scales.
+            threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+                A match near the previous one scoring below this triggers a search of the whole
+                frame.
+            method: The correlation engine to use.
+            scales: The (min_scale, max_scale) range of template scales to search, or None to only
+                search for the template at its original size.
+            margin: How far around the previous match to search, as a fraction of its size.
+        """
+        if not isinstance(template, CompiledTemplate):
+            template = CompiledTemplate(template, scales)
+        self.template = template
+        self.threshold = threshold
+        self.method = method
+        self.margin = margin
+        # The last match and its scale, or None if the template was lost
+        self.box = None
+        self.scale = None
+
+    def reset(self) -> None:
+        """Forgets the last match, so that the next frame is searched in full."""
+        self.box = None
+        self.scale = None
+
+    def _search_scales(self) -> Optional[tuple]:
+        """Returns the range of scales near the last match's, within the compiled range."""
+        compiled = self.template.scales
+        if compiled is None or self.scale is None:
+            return None
+        scale = min(max(self.scale, compiled[0]), compiled[1])
+        return max(compiled[0], scale / SCALE_CHANGE), min(compiled[1], scale * SCALE_CHANGE)
+
+    def _search_region(self, frame: Image) -> Optional[tuple]:
+        """Returns the (x1, y1, x2, y2) region of the frame around the last match, if any."""
+        if self.box is None:
+            return None
+        height, width = frame.image.shape[:2]
+        margin_x = max(MIN_SEARCH_MARGIN, round(self.box.w * self.margin))
+        margin_y = max(MIN_SEARCH_MARGIN, round(self.box.h * self.margin))
+        x1, y1 = max(0, self.box.x - margin_x), max(0, self.box.y - margin_y)
+        x2 = min(width, self.box.x + self.box.w + margin_x)
+        y2 = min(height, self.box.y + self.box.h + margin_y)
+        if x1 == 0 and y1 == 0 and x2 == width and y2 == height:
+            # The region is the whole frame anyway
+            return None
+        return x1, y1, x2, y2
+
+    def update(self, frame: Union[Image, np.ndarray]) -> Optional[BoundingBox]:
+        """
+        Finds the template in the next frame.
+
+        Args:
+            frame: The frame, as an Image or as a uint8 array in BGR order.
+
+        Returns:
+            The bounding box of the template in the frame, or None if it wasn't found.
+        """
+        if not isinstance(frame, Image):
+            frame = Image.from_array(frame)
+        start = time.perf_counter()
+        best = None
+        region = self._search_region(frame)
+        if region is not None:
+            x1, y1, x2, y2 = region
+            # A view of the region, so only its pixels are converted and searched
+            crop = Image.from_array(frame.image[y1:y2, x1:x2], frame.channel_order)
+            best = self.template.match(crop, self.method, scales=self._search_scales())
+            if best is not None:
+                best = best._replace(x=best.x + x1, y=best.y + y1)
+        if best is None or best.score < self.threshold:
+            best = self.template.match(frame, self.method)
+        if best is None or best.score < self.threshold:
+            self.reset()
+        else:
+            self.box = BoundingBox(best.x, best.y, best.w, best.h)
+            self.scale = best.scale
+        metrics.record_call("track", frame.image.shape, time.perf_counter() - start,
+                            self.box is not None)
+        return self.box
+
+
+def find_stream(frames: Iterable[Union[Image, np.ndarray]],
+                template: Union[Image, CompiledTemplate], threshold: float = DEFAULT_THRESHOLD,
+                method: str = correlation.AUTO,
+                scales: Optional[tuple] = pyramid.DEFAULT_SCALE_RANGE,
+                margin: float = SEARCH_MARGIN) -> Iterator[Optional[BoundingBox]]:
+    """
+    Finds the template in every frame of a stream, tracking it from frame to frame.
+
+    See Tracker for how frames are searched.
+
+    Args:
+        frames: The frames, as Images or as uint8 arrays in BGR order. Read lazily, one at a time.
+        template: The template to track. Can be a compiled template, in which case scales is
+            ignored in favor of the compiled scales.
+        threshold: The minimum normalized cross-correlation score of a match, between -1 and 1.
+        method: The correlation engine to use.
+        scales: The (min_scale, max_scale) range of template scales to search, or None to only
+            search for the template at its original size.
+        margin: How far around the previous match to search, as a fraction of its size.
+
+    Yields:
+        The bounding box of the template in each frame, or None if it wasn't found.
+    """
+    tracker = Tracker(template, threshold, method, scales, margin)
+    for frame in frames:
+        yield tracker.update(frame)
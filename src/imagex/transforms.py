@@ -0,0 +1,53 @@
+"""
+Geometric transforms of templates.
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# Minimum coverage of a rotated pixel for it to be part of the rotated template's mask
+ROTATED_MASK_COVERAGE = 0.99
+
+
+def resize(pixels: np.ndarray, w: int, h: int) -> np.ndarray:
+    """Resizes a float image of shape (H, W, C) to the given width and height."""
+    shrinking = w < pixels.shape[1] or h < pixels.shape[0]
+    resized = cv2.resize(pixels, (w, h), interpolation=cv2.INTER_AREA if shrinking
+                         else cv2.INTER_LINEAR)
+    return resized.reshape(h, w, pixels.shape[2])
+
+
+def rotate(pixels: np.ndarray, mask: Optional[np.ndarray], angle: float) -> tuple:
+    """
+    Rotates a template counterclockwise, expanding the canvas so that the whole template fits.
+
+    Args:
+        pixels: A float32 template of shape (h, w, C).
+        mask: An optional mask of shape (h, w).
+        angle: The rotation angle, in degrees.
+
+    Returns:
+        The rotated (pixels, mask). The mask marks which pixels of the expanded canvas are covered
+        by the template, and is None if every pixel is.
+    """
+    angle %= 360
+    if angle % 90 == 0:
+        # Exact rotation, no interpolation needed
+        turns = int(angle // 90)
+        return (np.ascontiguousarray(np.rot90(pixels, turns)),
+                None if mask is None else np.ascontiguousarray(np.rot90(mask, turns)))
+    h, w, channels = pixels.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_w, new_h = round(h * sin + w * cos), round(h * cos + w * sin)
+    matrix[0, 2] += new_w / 2 - w / 2
+    matrix[1, 2] += new_h / 2 - h / 2
+    rotated = cv2.warpAffine(pixels, matrix, (new_w, new_h), flags=cv2.INTER_LINEAR)
+    coverage = cv2.warpAffine(np.ones((h, w), np.float32) if mask is None else mask, matrix,
+                              (new_w, new_h), flags=cv2.INTER_LINEAR)
+    return rotated.reshape(new_h, new_w, channels), (coverage >= ROTATED_MASK_COVERAGE)
@@ -0,0 +1,219 @@
+"""
+Benchmarks the speed of imagex.find() on every test group, and on synthetic images and templates
+of varying sizes. The time taken to import imagex (by itself, and along with its engines) is
+benchmarked too, in fresh interpreters, since it dominates short-lived command line runs.
+
+For each benchmark, every case is timed over several runs (after one warmup run, which also
+measures the peak memory allocated by NumPy), and the latency percentiles, throughput and peak
+memory are reported. Images are decoded before timing starts, so only the search is measured.
+
+Usage:
+    python tests/benchmark.py [--groups 01 02] [--repeat 5] [--output results.json]
+    python tests/benchmark.py --baseline results.json  # Flags regressions against a saved run
+
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+# Add source directory to path (for importing imagex)
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "src"))
+
+from conftest import *
+
+# Image (h, w) and template sizes of the synthetic benchmarks
+SWEEP_IMAGE_SIZES = [(240, 320), (480, 640), (1080, 1920)]
+SWEEP_TEMPLATE_SIZES = [16, 32, 64, 128]
+# Standard deviation of the noise added to templates in the noisy synthetic benchmarks
+SWEEP_NOISE = 8
+# Relative slowdown of the median latency that counts as a regression
+DEFAULT_TOLERANCE = 0.2
+PERCENTILES = [50, 90, 99]
+# Statements whose time is benchmarked in fresh interpreters, by benchmark name
+IMPORT_STATEMENTS = {"import": "import imagex", "import-engines": "import imagex; imagex.find"}
+
+
+def group_cases(group: Path) -> list:
+    """Returns the (image, template) pairs of every test in a test group, decoded."""
+    cases = []
+    for test_path in sorted(group.rglob("*.json")):
+        with test_path.open("r") as file:
+            test_data = json.load(file)
+        image = imagex.Image(str(RES_PATH / test_data["image"]))
+        template = imagex.Image(str(RES_PATH / test_data["template"]))
+        image.image, template.image
+        cases.append((image, template))
+    return cases
+
+
+def sweep_cases(image_size: tuple, template_size: int, noise: bool) -> list:
+    """Returns a synthetic (image, template) pair, with the template cut out of the image."""
+    rng = np.random.default_rng(image_size[0] * template_size)
+    # Smooth random images, so that correlation peaks are as wide as in real images
+    pixels = rng.integers(0, 256, (image_size[0] // 8 + 1, image_size[1] // 8 + 1, 3), np.uint8)
+    pixels = cv2.resize(pixels, image_size[::-1], interpolation=cv2.INTER_CUBIC)
+    y, x = image_size[0] // 3, image_size[1] // 2
+    template = pixels[y:y+template_size, x:x+template_size].copy()
+    if noise:
+        template = np.clip(template + rng.normal(0, SWEEP_NOISE, template.shape), 0, 255)
+        template = template.astype(np.uint8)
+    return [(imagex.Image.from_array(pixels), imagex.Image.from_array(template))]
+
+
+def run_benchmark(cases: list, search: Callable, repeat: int) -> dict:
+    """
+    Times a search over a list of (image, template) pairs.
+
+    Every run uses fresh copies of the images, so that derived data cached by earlier runs isn't
+    reused.
+
+    Returns:
+        The latency percentiles and mean (in milliseconds), throughput (in searches per second) and
+        peak memory (in bytes) of the search.
+    """
+    def fresh(image: imagex.Image) -> imagex.Image:
+        return imagex.Image.from_array(image.image, image.channel_order)
+
+    # Warmup run, measuring the peak memory of the largest case
+    peak_memory = 0
+    for image, template in cases:
+        tracemalloc.start()
+        search(fresh(image), fresh(template))
+        peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    latencies = []
+    for _ in range(repeat):
+        for image, template in cases:
+            image, template = fresh(image), fresh(template)
+            start = time.perf_counter()
+            search(image, template)
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    result = {f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES}
+    result["mean_ms"] = float(latencies.mean())
+    result["throughput"] = float(1000 * len(latencies) / latencies.sum())
+    result["peak_memory"] = peak_memory
+    result["runs"] = len(latencies)
+    return result
+
+
+def time_import(statement: str, repeat: int) -> dict:
+    """
+    Times a statement in fresh interpreters, minus the startup time of an interpreter.
+
+    Returns:
+        The same results as run_benchmark(), without peak memory.
+    """
+    env = {**os.environ, "PYTHONPATH": str(ROOT_PATH / "src")}
+
+    def run(code: str) -> float:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], env=env, check=True)
+        return time.perf_counter() - start
+
+    # Warmup run, so that every run finds the bytecode and shared libraries cached
+    run(statement)
+    startup = min(run("pass") for _ in range(repeat))
+    latencies = np.array([max(0.0, run(statement) - startup) for _ in range(repeat)]) * 1000
+    result = {f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES}
+    result["mean_ms"] = float(latencies.mean())
+    result["throughput"] = float(1000 * len(latencies) / max(latencies.sum(), 1e-9))
+    result["peak_memory"] = 0
+    result["runs"] = len(latencies)
+    return result
+
+
+def find(image: imagex.Image, template: imagex.Image) -> Optional[imagex.BoundingBox]:
+    """The search that is benchmarked."""
+    return imagex.find(image, template)
+
+
+def benchmarks(groups: Optional[list], sweep: bool) -> dict:
+    """Returns the cases of every benchmark, by name."""
+    cases = {}
+    for group in sorted(path for path in TEST_DATA_PATH.iterdir() if path.is_dir()):
+        if groups is None or any(group.name.startswith(prefix) for prefix in groups):
+            cases[group.name] = lambda group=group: group_cases(group)
+    if sweep:
+        for h, w in SWEEP_IMAGE_SIZES:
+            for size in SWEEP_TEMPLATE_SIZES:
+                for noise in (False, True):
+                    name = f"sweep-{w}x{h}-{size}{'-noise' if noise else ''}"
+                    cases[name] = lambda h=h, w=w, size=size, noise=noise: sweep_cases(
+                        (h, w), size, noise)
+    return cases
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns the names of the benchmarks whose median latency regressed against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result["p50_ms"] > baseline[name]["p50_ms"] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks imagex.find()")
+    parser.add_argument("--groups", nargs="*", help="Prefixes of the test groups to run "
+                        "(like 01 or 07-find-scaled-noise); all of them by default")
+    parser.add_argument("--no-sweep", action="store_true", help="Skip the synthetic benchmarks")
+    parser.add_argument("--no-imports", action="store_true", help="Skip the import benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of every case")
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="Compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative slowdown of the median latency that counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    header = f"{'benchmark':<36} {'cases':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} " \
+             f"{'per s':>8} {'peak MiB':>9}"
+    print(header)
+    print("-" * len(header))
+
+    def report(name: str, count: int, result: dict) -> None:
+        result["cases"] = count
+        results[name] = result
+        print(f"{name:<36} {count:>5} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['throughput']:>8.1f} "
+              f"{result['peak_memory'] / 2 ** 20:>9.1f}")
+
+    if not args.no_imports:
+        for name, statement in IMPORT_STATEMENTS.items():
+            report(name, 1, time_import(statement, args.repeat))
+    for name, load_cases in benchmarks(args.groups, not args.no_sweep).items():
+        cases = load_cases()
+        report(name, len(cases), run_benchmark(cases, find, args.repeat))
+
+    if args.output:
+        with args.output.open("w") as file:
+            json.dump({"platform": platform.platform(), "python": platform.python_version(),
+                       "results": results}, file, indent=2)
+    if args.baseline:
+        with args.baseline.open("r") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name in regressions:
+            print(f"REGRESSION: {name} median {results[name]['p50_ms']:.2f} ms, "
+                  f"was {baseline[name]['p50_ms']:.2f} ms")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
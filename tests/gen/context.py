@@ -17,6 +17,9 @@ TEST_DATA_PATH = TEST_PATH / "tests"
 RES_PATH = TEST_PATH / "res"
 NONE = (0, 0, 0, 0)
 
+# Add source directory to path (for importing imagex)
+sys.path.insert(0, str(ROOT_PATH / "src"))
+
 
 def seed_gens(label: str) -> None:
     """Seeds all random number generators, given a string."""
@@ -56,6 +56,7 @@ def find_heuristic(image: np.ndarray, template: np.ndarray) -> list:
     # Try different template sizes
     best_val = 1
     best_match = None
+    image = image.astype(np.float32) / 255
     for scale in [1, 0.5, 2]:
         # Resize the image according to the scale
         resized = skimage.transform.rescale(template, scale, channel_axis=2, anti_aliasing=True)
@@ -63,7 +64,6 @@ def find_heuristic(image: np.ndarray, template: np.ndarray) -> list:
         if resized.shape[0] > image.shape[0] or resized.shape[1] > image.shape[1]:
             continue
         resized = resized.astype(np.float32) / 255
-        image = image.astype(np.float32) / 255
         res = cv2.matchTemplate(image, resized, cv2.TM_SQDIFF_NORMED)
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
         if min_val <= min(0.4, best_val):
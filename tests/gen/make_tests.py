@@ -5,12 +5,23 @@ ImageX - Regex for images
 https://github.com/Giantpizzahead/imagex
 Copyright (C) 2022 Giantpizzahead
 """
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import json
+import os
 from typing import Optional
 
 import imagex_mock
 import imagex_manual
 from context import *
+import imagex
+
+# Cache of automatically generated labels, keyed by the contents of the image and template
+LABEL_CACHE_PATH = TEMP_PATH / "label_cache.json"
+# Version of the automatic labeling. Bump it when labeling changes, to invalidate cached labels.
+LABEL_VERSION = 1
+# Number of processes that generate labels
+WORKERS = os.cpu_count() or 1
 
 
 def clear_dir(output_dir: Path) -> None:
@@ -46,8 +57,67 @@ def regenerate_dir(output_dir: Path, reason: str) -> bool:
     return True
 
 
+def file_hash(path: Path) -> str:
+    """Returns the SHA-256 hash of a file's contents."""
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def label_key(image_path: Path, template_path: Path) -> str:
+    """Returns the label cache key of an image and template pair."""
+    return f"{LABEL_VERSION}:{file_hash(image_path)}:{file_hash(template_path)}"
+
+
+def load_label_cache() -> dict:
+    """Loads the label cache, or returns an empty one if there is none."""
+    if not LABEL_CACHE_PATH.exists():
+        return {}
+    with LABEL_CACHE_PATH.open("r") as file:
+        return json.load(file)
+
+
+def save_label_cache(cache: dict) -> None:
+    """Saves the label cache to disk."""
+    LABEL_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with LABEL_CACHE_PATH.open("w") as file:
+        json.dump(cache, file)
+
+
+def auto_label(pair: tuple) -> list:
+    """Returns the bounding boxes of every exact copy of a template in an image."""
+    image_path, template_path = pair
+    matches = imagex.find_exact(imagex.Image(image_path), imagex.Image(template_path))
+    return [list(box.to_tuple()) for box in matches] or [list(NONE)]
+
+
+def auto_labels(pairs: list) -> list:
+    """
+    Labels image and template pairs automatically, with exact matching.
+
+    Labels are looked up in the label cache first. The remaining pairs are labeled across a process
+    pool, and their labels are added to the cache.
+
+    Args:
+        pairs: A list of (image path, template path) pairs.
+
+    Returns:
+        The bounding boxes of each pair.
+    """
+    cache = load_label_cache()
+    keys = [label_key(image_path, template_path) for image_path, template_path in pairs]
+    missing = list({key: pair for key, pair in zip(keys, pairs) if key not in cache}.items())
+    if len(missing) > 1 and WORKERS > 1:
+        with ProcessPoolExecutor(WORKERS) as executor:
+            labels = list(executor.map(auto_label, [pair for _, pair in missing], chunksize=4))
+    else:
+        labels = [auto_label(pair) for _, pair in missing]
+    if missing:
+        cache.update((key, label) for (key, _), label in zip(missing, labels))
+        save_label_cache(cache)
+    return [cache[key] for key in keys]
+
+
 def gen_test_data(image_path: Path, template_path: Path, manual_labels: bool = False,
-                  test_dir: Optional[Path] = None) -> dict:
+                  test_dir: Optional[Path] = None, labels: Optional[list] = None) -> dict:
     """
     Generate test data dictionary for a "find-one" test.
 
@@ -56,16 +126,19 @@ def gen_test_data(image_path: Path, template_path: Path, manual_labels: bool = F
         template_path: The path to the template. Must be in the resource folder.
         manual_labels: Whether to generate test data manually (human labeling).
         test_dir: The path to the test data directory. Needs to be set when manual_labels is True.
+        labels: The bounding boxes, if they were already generated (with auto_labels()).
     """
     # Generate answers
-    image = imagex_mock.load_image(image_path)
-    template = imagex_mock.load_image(template_path)
     # print(f"Finding {template_path.name} in {image_path.name}")
-    if not manual_labels:
-        bounding_boxes = imagex_mock.find(image, template)
+    if labels is not None:
+        bounding_boxes = labels
+    elif not manual_labels:
+        bounding_boxes = auto_labels([(image_path, template_path)])[0]
     else:
         if test_dir is None:
             raise ValueError("test_dir must be set when manual_labels is True")
+        image = imagex_mock.load_image(image_path)
+        template = imagex_mock.load_image(template_path)
         bounding_boxes = imagex_manual.find(image, template, test_dir)
     # Get relative paths
     try:
@@ -133,12 +206,14 @@ def gen_test_suite(test_dir: Path, images: list, templates: list,
     # Limit number of tests
     if max_tests >= 0:
         tests = tests[:max_tests]
+    # Label every test at once, so that labeling can be done in parallel
+    labels = [None] * len(tests) if manual_labels else auto_labels(tests)
     # Create tests
     for i, (image_path, template_path) in enumerate(tests):
         if manual_labels:
             print(f"Test {i + 1}/{len(tests)}")
         test_data = gen_test_data(image_path, template_path, manual_labels=manual_labels,
-                                  test_dir=test_dir)
+                                  test_dir=test_dir, labels=labels[i])
         # Get image name without prefix
         image_name = image_path.stem
         if image_name.startswith("image_"):
@@ -0,0 +1,599 @@
+"""
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import asyncio
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import *
+from imagex import transforms
+
+
+def load(name: str) -> imagex.Image:
+    """Loads an image from the basic_shapes resource folder."""
+    return imagex.Image(str(RES_PATH / "basic_shapes" / f"{name}.png"))
+
+
+def test_lazy_import():
+    code = ("import sys, imagex; heavy = lambda: {'cv2', 'numpy'} & set(sys.modules); "
+            "print(sorted(heavy())); imagex.metrics, imagex.collect_traces; "
+            "print(sorted(heavy())); imagex.find; print(sorted(heavy())); "
+            "print(sorted({'batch', 'store', 'template_set', 'tracking', 'aio', 'server'} "
+            "& {name.split('.')[-1] for name in sys.modules}))")
+    env = {**os.environ, "PYTHONPATH": str(ROOT_PATH / "src")}
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    # find() only imports the submodules it needs
+    assert output.split("\n")[:4] == ["[]", "[]", "['cv2', 'numpy']", "[]"]
+
+
+def test_image_sources(tmp_path):
+    path = RES_PATH / "basic_shapes" / "image_exact_medium_1.png"
+    template = load("template_normal_circle")
+    image = imagex.Image(path)
+    assert not image.decoded
+    expected = [(19, 151, 28, 28)]
+    assert [box.to_tuple() for box in imagex.find_exact(image, template)] == expected
+    assert image.decoded
+    rgb = np.ascontiguousarray(image.image[:, :, ::-1])
+    wrapped = imagex.Image.from_array(rgb, channel_order=imagex.RGB)
+    assert np.shares_memory(wrapped.image, rgb)
+    assert [box.to_tuple() for box in imagex.find_exact(wrapped, template)] == expected
+    assert imagex.find(wrapped, template).to_tuple() == expected[0]
+    encoded = imagex.Image.from_bytes(memoryview(path.read_bytes()))
+    assert np.array_equal(encoded.image, image.image)
+    np.save(tmp_path / "frame.npy", rgb)
+    mapped = imagex.Image(tmp_path / "frame.npy", channel_order=imagex.RGB)
+    assert isinstance(mapped.image, np.memmap)
+    assert imagex.find(mapped, template).to_tuple() == expected[0]
+    raw = imagex.Image.from_array(memoryview(rgb.tobytes() + b"extra"), imagex.RGB, rgb.shape)
+    assert np.array_equal(raw.image, rgb)
+    for array, shape in [(rgb[:, :, :1], None), (rgb.astype(np.float32), None), (rgb[0, 0], None),
+                         (rgb.tobytes(), (1000, 1000, 3)), (rgb, rgb.shape)]:
+        with pytest.raises(ValueError):
+            imagex.Image.from_array(array, shape=shape)
+    # Grayscale images and templates match color ones
+    gray = cv2.cvtColor(image.image, cv2.COLOR_BGR2GRAY)
+    color = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    np.save(tmp_path / "gray.npy", gray)
+    for scene, patch in [(imagex.Image.from_array(gray), color[151:179, 19:47]),
+                         (imagex.Image(tmp_path / "gray.npy"), color[151:179, 19:47]),
+                         (imagex.Image.from_array(color), gray[151:179, 19:47].copy()),
+                         (imagex.Image.from_array(gray.tobytes(), shape=gray.shape),
+                          gray[151:179, 19:47].copy())]:
+        patch = imagex.Image.from_array(patch)
+        assert [box.to_tuple() for box in imagex.find_exact(scene, patch)] == expected
+        assert imagex.find(scene, patch).to_tuple() == expected[0]
+
+
+def test_image_cache():
+    image = load("image_exact_medium_1")
+    circle = imagex.compile(load("template_normal_circle"))
+    triangle = imagex.compile(load("template_normal_triangle"))
+    circle.search(image.pyramid)
+    levels = image.pyramid
+    triangle.search(image.pyramid)
+    assert image.pyramid is levels
+    assert 0 < image.cache.nbytes <= image.cache.max_bytes
+    image.cache.max_bytes = image.pixels.nbytes
+    assert image.cache.nbytes <= image.cache.max_bytes
+    assert "pyramid" not in image.cache
+    # Spectra and summed-area tables added to a cached pyramid count towards the budget too
+    noisy = load("image_noised_gaussian_light_1")
+    imagex.find(noisy, circle, method=imagex.correlation.FFT)
+    full = noisy.cache.nbytes
+    noisy = load("image_noised_gaussian_light_1")
+    noisy.cache.max_bytes = full - 1
+    imagex.find(noisy, circle, method=imagex.correlation.FFT)
+    assert noisy.cache.nbytes <= full - 1
+    assert noisy.cache.nbytes == imagex.cache.nbytes(list(noisy.cache._values.values()))
+
+
+def test_compile_reuse():
+    template = imagex.compile(load("template_normal_circle"))
+    assert template.find(load("image_exact_medium_1")).to_tuple() == (19, 151, 28, 28)
+    assert template.find(load("image_exact_medium_2")).to_tuple() == (19, 132, 28, 28)
+    assert template.find(load("image_exact_solid_1")) is None
+
+
+def test_max_difference():
+    template = load("template_normal_circle")
+    image = load("image_noised_gaussian_light_1")
+    darker = imagex.Image.from_array((image.image * 0.4).astype(np.uint8))
+    max_difference = imagex.correlation.MAX_RMS_DIFFERENCE
+    assert imagex.find(image, template, max_difference=max_difference).to_tuple() == \
+        imagex.find(image, template).to_tuple()
+    # Off by default, since copies of a different brightness or contrast are then rejected
+    assert imagex.find(darker, template) is not None
+    assert imagex.find(darker, template, max_difference=max_difference) is None
+    assert imagex.find_all(darker, template, max_difference=max_difference) == []
+    compiled = imagex.compile(template, max_difference=max_difference)
+    assert compiled.find(darker) is None
+    assert [hit.label for hit in imagex.find_any(darker, [template], max_difference=0.1)] == []
+    rejected = imagex.metrics.CORRELATIONS.get("rejected")
+    assert compiled.find(load("image_exact_solid_1")) is None
+    assert imagex.metrics.CORRELATIONS.get("rejected") > rejected
+
+
+def test_template_store(tmp_path, monkeypatch):
+    from imagex import store
+    template = load("template_normal_triangle")
+    compiled = imagex.compile(template, angles=(0, 180), flips=True, store=tmp_path)
+    assert len(list(tmp_path.glob(f"*{store.SUFFIX}"))) == 1
+    loaded = imagex.compile(load("template_normal_triangle"), angles=(0, 180), flips=True,
+                            store=tmp_path)
+    # Loaded arrays are memory-mapped from the store
+    assert not loaded.variants[0].prepared.centered.flags.writeable
+    for name in ["image_exact_medium_1", "image_scaled_double_1"]:
+        assert loaded.find(load(name)).to_tuple() == compiled.find(load(name)).to_tuple()
+    # Entries of other compile parameters, or written by other versions, aren't used
+    templates = imagex.TemplateStore(tmp_path)
+    assert templates.load(templates.key(template, angles=(0, 180))) is None
+    key = templates.key(template, angles=(0, 180), flips=True)
+    entry = tmp_path / f"{key}{store.SUFFIX}"
+    umask = os.umask(0o022)
+    try:
+        templates.save(compiled)
+    finally:
+        os.umask(umask)
+    if os.name == "posix":
+        assert entry.stat().st_mode & 0o777 == 0o644
+    # Corrupt entries are compiled again, and failed writes leave no temporary files behind
+    data = entry.read_bytes()
+    for corrupt in [data[:len(data) // 2], data[:40] + b"x" * (len(data) - 40)]:
+        entry.write_bytes(corrupt)
+        assert templates.load(key) is None
+        recompiled = imagex.compile(template, angles=(0, 180), flips=True, store=tmp_path)
+        assert recompiled.find(load("image_exact_medium_1")).to_tuple() == (58, 166, 24, 30)
+        assert templates.load(key) is not None
+    monkeypatch.setattr(os, "replace", lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        templates.save(compiled)
+    assert list(tmp_path.iterdir()) == [entry]
+    monkeypatch.setattr(store, "STORE_VERSION", store.STORE_VERSION + 1)
+    assert templates.load(key) is None
+
+
+def test_find_exact():
+    template = load("template_normal_circle")
+    boxes = imagex.find_exact(load("image_exact_medium_1"), template)
+    assert [box.to_tuple() for box in boxes] == [(19, 151, 28, 28)]
+    assert imagex.find_exact(load("image_exact_solid_1"), template) == []
+
+
+def test_transparent_template(tmp_path):
+    image = load("image_exact_medium_1")
+    pixels = image.image[140:190, 10:60].copy()
+    # Garbage colors in the transparent border, which must not affect matching
+    alpha = np.full(pixels.shape[:2], 255, np.uint8)
+    alpha[:8], alpha[:, :8] = 0, 0
+    pixels[alpha == 0] = (255, 0, 255)
+    cv2.imwrite(str(tmp_path / "template.png"), np.dstack([pixels, alpha]))
+    template = imagex.Image(tmp_path / "template.png")
+    assert template.image.shape == (50, 50, 4) and template.mask is not None
+    assert [box.to_tuple() for box in imagex.find_exact(image, template)] == [(10, 140, 50, 50)]
+    assert imagex.find(image, template, scales=None).to_tuple() == (10, 140, 50, 50)
+    assert imagex.find_exact(image, imagex.Image.from_array(pixels)) == []
+
+
+def test_compile_rotated():
+    template = load("template_normal_triangle")
+    for angle in [90, 30]:
+        pixels, mask = transforms.rotate(template.image, None, angle)
+        h, w = pixels.shape[:2]
+        image = imagex.Image.from_array(np.full((120, 150, 3), 255, np.uint8))
+        region = image.image[40:40+h, 70:70+w]
+        if mask is not None:
+            region[mask] = pixels[mask]
+        else:
+            region[:] = pixels
+        assert imagex.find(image, template, scales=None) is None
+        result = imagex.compile(template, scales=None, angles=range(0, 360, 30)).find(image)
+        assert result.to_tuple() == (70, 40, w, h)
+
+
+def test_compile_any_rotation():
+    texture = np.random.default_rng(0).random((40, 46, 3), dtype=np.float32)
+    texture = (cv2.GaussianBlur(texture, (0, 0), 2) * 255).astype(np.uint8)
+    textured = imagex.Image.from_array(texture)
+    triangle = load("template_normal_triangle")
+    cases = [(triangle, 40, 1), (triangle, 130, 1.5), (triangle, 250, 1), (textured, 130, 1.5),
+             (textured, 250, 0.8)]
+    for template, angle, scale in cases:
+        h, w = (round(side * scale) for side in template.image.shape[:2])
+        resized = transforms.resize(template.image.astype(np.float32), w, h)
+        pixels, mask = transforms.rotate(resized, None, angle)
+        h, w = pixels.shape[:2]
+        image = imagex.Image.from_array(np.full((130, 150, 3), 255, np.uint8))
+        image.image[30:30+h, 50:50+w][mask] = pixels[mask].round().astype(np.uint8)
+        compiled = imagex.compile(template, scales=(0.5, 2), angles=None)
+        x, y, found_w, found_h = compiled.find(image).to_tuple()
+        # The estimated scale can be slightly off, so compare centers
+        assert abs(2 * x + found_w - (100 + w)) <= 4 and abs(2 * y + found_h - (60 + h)) <= 4
+
+
+def test_compile_features():
+    rng = np.random.default_rng(1)
+    blocks = rng.integers(0, 256, (20, 25, 3), dtype=np.uint8)
+    template = imagex.Image.from_array(cv2.resize(blocks, (100, 80),
+                                                  interpolation=cv2.INTER_NEAREST))
+    background = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    image = imagex.Image.from_array(cv2.GaussianBlur(cv2.resize(background, (480, 360)), (0, 0), 3))
+    # Mirrored, scaled by 1.5 and rotated by 30 degrees
+    mirrored = np.flip(template.image, axis=1).astype(np.float32)
+    pixels, mask = transforms.rotate(transforms.resize(mirrored, 150, 120), None, 30)
+    h, w = pixels.shape[:2]
+    image.image[100:100+h, 200:200+w][mask] = pixels[mask].round().astype(np.uint8)
+    compiled = imagex.compile(template, scales=(0.5, 2), angles=None, flips=True,
+                              use_features=True)
+    candidate = compiled.features.search(image, compiled.scales)
+    assert candidate.flipped and candidate.score >= 0.9
+    assert candidate.scale == pytest.approx(1.5, abs=0.05)
+    assert candidate.angle == pytest.approx(30, abs=2)
+    x, y, found_w, found_h = compiled.find(image).to_tuple()
+    assert abs(2 * x + found_w - (400 + w)) <= 4 and abs(2 * y + found_h - (200 + h)) <= 4
+
+
+def test_find_any():
+    names = ["template_normal_circle", "template_normal_rect", "template_normal_triangle"]
+    templates = {name: load(name) for name in names}
+    for image_name in ["image_exact_medium_1", "image_noised_gaussian_light_1"]:
+        image = load(image_name)
+        hits = imagex.find_any(image, templates, scales=None)
+        assert [hit.score for hit in hits] == sorted([hit.score for hit in hits], reverse=True)
+        found = {hit.label: hit.box.to_tuple() for hit in hits}
+        for name, template in templates.items():
+            expected = imagex.find(image, template, scales=None)
+            assert found.get(name) == (None if expected is None else expected.to_tuple())
+    # Glyphs of the same size, correlated together
+    rng = np.random.default_rng(2)
+    pixels = cv2.GaussianBlur(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8), (0, 0), 1)
+    glyphs = [pixels[y:y+16, x:x+16].copy() for y, x in [(5, 7), (60, 100), (90, 30)]]
+    noisy = np.clip(pixels + rng.normal(0, 4, pixels.shape), 0, 255).astype(np.uint8)
+    template_set = imagex.TemplateSet([imagex.Image.from_array(g) for g in glyphs], scales=None)
+    hits = imagex.find_any(imagex.Image.from_array(noisy), template_set)
+    assert sorted((hit.label, hit.box.to_tuple()) for hit in hits) == [
+        (0, (7, 5, 16, 16)), (1, (100, 60, 16, 16)), (2, (30, 90, 16, 16))]
+
+
+def test_find_all_grid():
+    template = load("template_normal_circle")
+    tile = np.full((30, 35, 3), 255, np.uint8)
+    tile[1:29, 3:31] = template.image
+    image = imagex.Image.from_array(np.tile(tile, (10, 12, 1)))
+    results = imagex.find_all(image, template, scales=None)
+    assert len(results) == 120
+    assert {box.to_tuple() for box in results} == {(3 + 35 * i, 1 + 30 * j, 28, 28)
+                                                   for i in range(12) for j in range(10)}
+    assert len(imagex.find_all(image, template, scales=None, max_results=5)) == 5
+
+
+def test_tiled_search(tmp_path):
+    template = load("template_normal_circle")
+    rng = np.random.default_rng(5)
+    pixels = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    for x, y in [(10, 20), (140, 95), (300, 250), (361, 3)]:
+        pixels[y:y+28, x:x+28] = template.image
+    pixels[150:178, 200:228] = np.clip(template.image.astype(int) + 12, 0, 255)
+    np.save(tmp_path / "large.npy", pixels)
+    image = imagex.Image(tmp_path / "large.npy")
+    full = imagex.find_all(imagex.Image.from_array(pixels), template, scales=None)
+    assert len(full) == 5
+    budget = 150 ** 2 * 3 * 64
+    tiled = imagex.find_all(image, template, scales=None, max_memory=budget)
+    assert [box.to_tuple() for box in tiled] == [box.to_tuple() for box in full]
+    assert (imagex.find(image, template, scales=None, max_memory=budget).to_tuple()
+            == (361, 3, 28, 28))
+    for x, y in [(10, 20), (140, 95), (300, 250), (361, 3)]:
+        pixels[y + 14, x + 14] ^= 1
+    inexact = imagex.Image.from_array(pixels)
+    assert (imagex.find(inexact, template, scales=None, max_memory=budget).to_tuple()
+            == imagex.find(inexact, template, scales=None).to_tuple())
+    # Scaled searches find the same matches, though equal scores can differ by rounding
+    pixels = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    scaled = cv2.resize(template.image, (42, 42))
+    for x, y in [(10, 20), (140, 95), (300, 240), (340, 3)]:
+        pixels[y:y+42, x:x+42] = scaled
+    image = imagex.Image.from_array(pixels)
+    full = imagex.find_all(image, template, scales=(0.5, 2))
+    assert len(full) == 4
+    tiled = imagex.find_all(image, template, scales=(0.5, 2), max_memory=budget)
+    assert sorted(box.to_tuple() for box in tiled) == sorted(box.to_tuple() for box in full)
+    best = imagex.find(image, template, scales=(0.5, 2), max_memory=budget)
+    assert best.to_tuple() in [box.to_tuple() for box in full]
+    with pytest.raises(ValueError):
+        imagex.find(image, template, max_memory=1000)
+
+
+@pytest.mark.parametrize("executor", [imagex.THREAD, imagex.PROCESS])
+def test_find_many(executor):
+    names = ["image_exact_medium_1", "image_exact_large_1", "image_exact_small_1"]
+    paths = [str(RES_PATH / "basic_shapes" / f"{name}.png") for name in names]
+    templates = [load("template_normal_circle"), load("template_normal_triangle")]
+    compiled = imagex.compile(templates[1], scales=None)
+    results = list(imagex.find_many(iter(paths), [templates[0], compiled], scales=None,
+                                    workers=2, executor=executor))
+    assert len(results) == 6
+    for result in results:
+        template = [templates[0], compiled][result.template]
+        expected = imagex.find(imagex.Image(paths[result.image]), template, scales=None)
+        assert (result.box is None) == (expected is None)
+        assert result.box is None or result.box.to_tuple() == expected.to_tuple()
+
+
+def test_cli_batch(tmp_path):
+    shapes = RES_PATH / "basic_shapes"
+    manifest = "\n".join([str(shapes / "image_exact_medium_2.png"),
+                          json.dumps({"image": str(tmp_path / "missing.png")}), ""])
+    env = {**os.environ, "PYTHONPATH": str(ROOT_PATH / "src")}
+    cli = ROOT_PATH / "src" / "cli.py"
+    process = subprocess.run(
+        [sys.executable, str(cli), str(shapes / "image_exact_medium_*.png"), "-", "-t",
+         str(shapes / "template_normal_circle.png"), "--no-scales", "--workers", "2"],
+        input=manifest, env=env, capture_output=True, text=True)
+    assert process.returncode == 1
+    lines = sorted((json.loads(line) for line in process.stdout.splitlines()),
+                   key=lambda line: Path(line["image"]).name)
+    assert [Path(line["image"]).name for line in lines] == [
+        "image_exact_medium_1.png", "image_exact_medium_2.png", "image_exact_medium_2.png",
+        "missing.png"]
+    assert [line["matches"][0]["box"] for line in lines[:3]] == [
+        [19, 151, 28, 28], [19, 132, 28, 28], [19, 132, 28, 28]]
+    assert "error" in lines[3]
+
+
+@pytest.mark.parametrize("unix", [False, pytest.param(True, marks=pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="Unix sockets are not supported"))])
+def test_server(tmp_path, unix):
+    from multiprocessing import shared_memory
+    from imagex.server import MatchClient, MatchServer, ServerError, SharedImage
+    shapes = RES_PATH / "basic_shapes"
+    path = shapes / "image_exact_medium_1.png"
+    circle = shapes / "template_normal_circle.png"
+    pixels = cv2.imread(str(path))
+    address = str(tmp_path / "imagex.sock") if unix else ("127.0.0.1", 0)
+    with MatchServer({"circle": imagex.Image(circle)}, address, workers=2).start() as server:
+        expected = (19, 151, 28, 28)
+        with MatchClient(server.address) as client:
+            assert client.templates() == ["circle"]
+            assert client.find(path.read_bytes())["circle"].to_tuple() == expected
+            assert client.find(pixels)["circle"].to_tuple() == expected
+            assert [box.to_tuple() for box in client.find_all(pixels, max_results=1)["circle"]] \
+                == [expected]
+            segment = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+            try:
+                np.ndarray(pixels.shape, np.uint8, buffer=segment.buf)[:] = pixels
+                found = client.find(SharedImage(segment.name, pixels.shape))
+                assert found["circle"].to_tuple() == expected
+            finally:
+                segment.close()
+                segment.unlink()
+            client.add_template("rect", shapes / "template_normal_rect.png", None)
+            assert client.templates() == ["circle", "rect"]
+            with pytest.raises(ServerError) as error:
+                client.find(pixels, ["triangle"])
+            assert error.value.status == 400
+            with pytest.raises(ServerError) as error:
+                client.find(pixels[:, :, :1])
+            assert error.value.status == 400 and "Invalid image shape" in str(error.value)
+            for query, message in [([("shm", "segment")], "Missing query parameter: shape"),
+                                   ([("all", "1"), ("max_results", "0")], "Invalid max_results")]:
+                with pytest.raises(ServerError) as error:
+                    client._request("POST", "/find", query, pixels.tobytes(),
+                                    {"X-Image-Shape": ",".join(map(str, pixels.shape))})
+                assert error.value.status == 400 and message in str(error.value)
+            # Grayscale uploads are matched like color ones
+            gray = tmp_path / "gray_circle.png"
+            cv2.imwrite(str(gray), cv2.imread(str(circle), cv2.IMREAD_GRAYSCALE))
+            client.add_template("gray circle", gray)
+            found = client.find(cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY), ["gray circle"])
+            assert found["gray circle"].to_tuple() == expected
+            # The connection is still usable after an error
+            assert client.find(pixels, ["circle"])["circle"].to_tuple() == expected
+
+            # Concurrent requests for the same image are all answered
+            def search(_):
+                with MatchClient(server.address) as other:
+                    return [other.find(pixels, ["circle"])["circle"].to_tuple() for _ in range(5)]
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                assert list(pool.map(search, range(4))) == [[expected] * 5] * 4
+            batches = client.metrics(imagex.metrics.JSON)["imagex_server_batch_requests"]
+            assert sum(value["sum"] for value in batches["values"]) >= 24
+            assert "imagex_calls_total" in client.metrics()
+        # A negative Content-Length is rejected instead of reading until the connection closes
+        with MatchClient(server.address, timeout=10) as client:
+            client._connection.request("POST", "/find", None, {"Content-Length": "-1"})
+            response = client._connection.getresponse()
+            assert response.status == 400 and b"Invalid Content-Length" in response.read()
+    if unix:
+        assert not os.path.exists(address)
+
+
+def test_find_async():
+    shapes = RES_PATH / "basic_shapes"
+    template = imagex.compile(imagex.Image(shapes / "template_normal_circle.png"))
+    images = [imagex.Image(shapes / f"image_exact_medium_{i}.png") for i in (1, 2)]
+    expected = [imagex.find(image, template).to_tuple() for image in images]
+    pool = imagex.AsyncPool(workers=2, max_in_flight=2)
+
+    async def main():
+        tasks = [imagex.find_async(image, template, pool=pool) for image in images * 4]
+        boxes = await asyncio.gather(*tasks)
+        assert [box.to_tuple() for box in boxes] == expected * 4
+        found = await imagex.find_all_async(images[0], template, max_results=1, pool=pool)
+        assert [box.to_tuple() for box in found] == expected[:1]
+        # Slow searches time out, and are dropped if they haven't started yet
+        noise = np.random.default_rng(0).integers(0, 256, (600, 600, 3), np.uint8)
+        large = imagex.Image.from_array(noise)
+        slow = [asyncio.create_task(imagex.find_async(large, template, pool=pool, timeout=0.05))
+                for _ in range(4)]
+        for task in slow:
+            with pytest.raises(asyncio.TimeoutError):
+                await task
+        assert pool.in_flight <= pool.max_in_flight
+        task = asyncio.create_task(imagex.find_async(images[0], template, pool=pool))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    pool.close()
+    assert pool.in_flight == 0
+
+    # The bound holds over every event loop using the pool
+    pool = imagex.AsyncPool(workers=2, max_in_flight=1)
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def work():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    async def burst():
+        await asyncio.gather(*[pool.run(work) for _ in range(4)])
+    loops = [threading.Thread(target=asyncio.run, args=(burst(),)) for _ in range(2)]
+    for thread in loops:
+        thread.start()
+    for thread in loops:
+        thread.join()
+    pool.close()
+    assert peak[0] == 1 and pool.in_flight == 0
+
+
+def test_find_stream():
+    template = load("template_normal_circle")
+    rng = np.random.default_rng(6)
+    background = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    positions = [(40, 30), (44, 33), (49, 35), (250, 180), (252, 178), None, (100, 120)]
+    frames = []
+    for position in positions:
+        frame = background.copy()
+        if position is not None:
+            x, y = position
+            frame[y:y+28, x:x+28] = np.clip(template.image.astype(int) + rng.integers(
+                -10, 10, template.image.shape), 0, 255)
+        frames.append(frame)
+    results = list(imagex.find_stream(iter(frames), template, scales=None))
+    assert len(results) == len(positions)
+    for box, position in zip(results, positions):
+        assert (box is None) == (position is None)
+        assert box is None or box.to_tuple() == (*position, 28, 28)
+    tracker = imagex.Tracker(template, scales=None)
+    assert tracker.update(imagex.Image.from_array(frames[0])).to_tuple() == (40, 30, 28, 28)
+    assert tracker.box is not None
+    tracker.reset()
+    assert tracker.box is None
+
+    # Near the last match, only scales near its scale are searched
+    scaled = cv2.resize(template.image, (42, 42))
+    tracker = imagex.Tracker(template, scales=(0.5, 2))
+    searched = []
+    match = tracker.template.match
+    tracker.template.match = lambda *args, **kwargs: searched.append(kwargs.get("scales")) \
+        or match(*args, **kwargs)
+    for x in (60, 64):
+        frame = background.copy()
+        frame[50:92, x:x+42] = scaled
+        assert tracker.update(frame).to_tuple() == (x, 50, 42, 42)
+    assert tracker.scale == pytest.approx(1.5, abs=0.05)
+    low, high = searched[-1]
+    assert 0.5 < low < 1.5 < high < 2
+
+
+def test_trace():
+    image = imagex.Image(RES_PATH / "basic_shapes" / "image_scaled_double_1.png")
+    template = load("template_normal_circle")
+    trace = imagex.find(image, template, trace=True)
+    assert isinstance(trace, imagex.Trace)
+    assert trace.result is None or isinstance(trace.result, imagex.BoundingBox)
+    for stage in ["compile", "decode", "exact", "convert", "pyramid", "correlate", "scales"]:
+        assert stage in trace.stages
+    assert "scales/correlate" in trace.stages
+    assert any(name.startswith("level ") for name in trace.counts)
+    assert 0 < trace.stages["correlate"].seconds <= trace.seconds
+    assert trace.bytes > 0
+    assert "correlate" in trace.summary()
+    with imagex.collect_traces() as traces:
+        untraced = imagex.find(load("image_exact_medium_1"), template)
+        imagex.find_all(load("image_exact_medium_1"), template, scales=None)
+    assert untraced.to_tuple() == (19, 151, 28, 28)
+    assert [t.name for t in traces.traces] == ["find", "find_all"]
+    assert traces.stages()["exact"].calls == 1
+    # Only one trace at a time measures memory
+    with imagex.tracing.traced("outer", True) as outer:
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            inner = pool.submit(imagex.find, image, template, trace=True).result()
+    assert outer.bytes >= 0 and inner.bytes is None
+    assert inner.stages["correlate"].bytes is None and "n/a" in inner.summary()
+    assert not tracemalloc.is_tracing()
+    # A call traced inside another one gets its own trace, which also counts towards the outer
+    with imagex.tracing.traced("outer", True) as outer:
+        inner = imagex.find(image, template, trace=True)
+        untraced = imagex.find(image, template)
+    assert isinstance(inner, imagex.Trace) and inner.result.to_tuple() == untraced.to_tuple()
+    assert "scales/correlate" in inner.stages and inner.bytes > 0
+    assert outer.stages["find"].calls == 2
+    assert outer.stages["find/scales/correlate"].calls > inner.stages["scales/correlate"].calls
+    assert outer.bytes >= inner.bytes
+    assert not tracemalloc.is_tracing()
+
+
+def test_metrics(tmp_path, monkeypatch):
+    imagex.metrics.reset()
+    template = imagex.compile(load("template_normal_circle"), scales=None)
+    image = load("image_exact_medium_1")
+    imagex.find(image, template)
+    imagex.find(image, template)
+    imagex.find(load("image_exact_solid_1"), template)
+    imagex.find_all(image, template)
+    metrics = imagex.metrics
+    assert metrics.CALLS.get("find", "hit") == 2
+    assert metrics.CALLS.get("find", "miss") == 1
+    assert metrics.CALLS.get("find_all", "hit") == 1
+    assert metrics.CALL_SECONDS.count("find", "<=0.1MP") == 3
+    assert metrics.CACHE_REQUESTS.get("image", "hit") > 0
+    text = metrics.REGISTRY.to_prometheus()
+    assert '# TYPE imagex_call_seconds histogram' in text
+    assert 'imagex_calls_total{function="find",result="hit"} 2' in text
+    assert 'imagex_call_seconds_bucket{function="find",image_size="<=0.1MP",le="+Inf"} 3' in text
+    metrics.export(tmp_path / "metrics.json", metrics.JSON)
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["imagex_calls_total"]["type"] == "counter"
+    umask = os.umask(0o022)
+    try:
+        metrics.export(tmp_path / "metrics.prom")
+    finally:
+        os.umask(umask)
+    if os.name == "posix":
+        assert (tmp_path / "metrics.prom").stat().st_mode & 0o777 == 0o644
+    if os.path.exists("/proc/self/status"):
+        # The umask is read without setting it, which would race with other threads
+        monkeypatch.setattr(os, "umask", None)
+        assert imagex.files.umask() == umask
+        monkeypatch.undo()
+    # No temporary files are left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["metrics.json", "metrics.prom"]
+    exported = []
+    metrics.export(exported.append)
+    assert exported == [text]
+    # NaN is ignored instead of breaking the bucket search or the sum
+    metrics.CALL_SECONDS.observe(float("nan"), "find", "<=0.1MP")
+    assert metrics.CALL_SECONDS.count("find", "<=0.1MP") == 3
+    assert "nan" not in metrics.REGISTRY.to_prometheus().lower()
@@ -0,0 +1,186 @@
+"""
+ImageX - Regex for images
+https://github.com/Giantpizzahead/imagex
+Copyright (C) 2022 Giantpizzahead
+"""
+import cv2
+import numpy as np
+import pytest
+
+from conftest import *
+from imagex import correlation, exact, fourier_mellin, peaks, pyramid, transforms
+
+
+def random_image(height: int, width: int, channels: int = 3, seed: int = 0) -> np.ndarray:
+    """Returns a random float32 image in [0, 1]."""
+    return np.random.default_rng(seed).random((height, width, channels), dtype=np.float32)
+
+
+@pytest.mark.parametrize("template_size", [(5, 7), (20, 16), (60, 60)])
+def test_fft_matches_spatial(template_size):
+    image = random_image(80, 90)
+    h, w = template_size
+    template = image[10:10+h, 15:15+w].copy()
+    spatial = correlation.match_template(image, template, correlation.SPATIAL)
+    fft = correlation.match_template(image, template, correlation.FFT)
+    assert spatial.shape == fft.shape == (80 - h + 1, 90 - w + 1)
+    assert np.allclose(spatial, fft, atol=1e-3)
+    assert np.unravel_index(np.argmax(fft), fft.shape) == (10, 15)
+    assert fft[10, 15] == pytest.approx(1, abs=1e-4)
+
+
+def test_masked_fft_matches_spatial():
+    image = random_image(80, 90)
+    mask = np.ones((20, 16), np.float32)
+    mask[:6, :5] = 0
+    template = correlation.PreparedTemplate(image[10:30, 15:31].copy(), mask)
+    spatial = correlation.match_template(image, template, correlation.SPATIAL)
+    fft = correlation.match_template(image, template, correlation.FFT)
+    assert np.allclose(spatial, fft, atol=1e-3)
+    assert fft[10, 15] == pytest.approx(1, abs=1e-4)
+
+
+@pytest.mark.parametrize("method", [correlation.SPATIAL, correlation.FFT])
+def test_match_templates(method):
+    image = random_image(70, 80)
+    templates = [image[y:y+12, x:x+15].copy() for y, x in [(3, 4), (40, 50), (20, 61)]]
+    templates.append(np.full((12, 15, 3), 0.5, np.float32))
+    batched = correlation.match_templates(image, templates, method, max_difference=0.2)
+    for template, scores in zip(templates, batched):
+        expected = correlation.match_template(image, template, method, max_difference=0.2)
+        assert np.allclose(scores, expected, atol=1e-3)
+    with pytest.raises(ValueError):
+        correlation.match_templates(image, [templates[0], templates[0][:5]])
+
+
+def test_flat_template():
+    image = np.zeros((30, 30, 3), np.float32)
+    image[5:15, 8:20] = [0.2, 0.4, 0.6]
+    template = np.full((10, 12, 3), [0.2, 0.4, 0.6], np.float32)
+    scores = correlation.match_template(image, template)
+    assert scores[5, 8] == pytest.approx(1, abs=1e-3)
+    assert scores[0, 0] < 0.7
+
+
+def test_statistics_prefilter():
+    image = random_image(60, 80, seed=4) * 0.5
+    template = image[10:30, 20:45].copy()
+    image[35:55, 50:75] = template + 0.4
+    image[5:25, 50:75] = template * 0.4 - 20 / 255
+    max_difference = correlation.MAX_RMS_DIFFERENCE
+    scores = correlation.match_template(image, template, max_difference=max_difference)
+    assert scores[10, 20] == pytest.approx(1, abs=1e-4)
+    # The brightened copy correlates perfectly, but its colors are too far off
+    assert scores[35, 50] == 0
+    # Without the prefilter (the default), scores are invariant to brightness and contrast
+    unfiltered = correlation.match_template(image, template)
+    assert unfiltered[35, 50] == pytest.approx(1, abs=1e-4)
+    assert unfiltered[5, 50] == pytest.approx(1, abs=1e-4)
+    solid = np.full((60, 80, 3), 0.9, np.float32)
+    assert not correlation.match_template(solid, template, max_difference=max_difference).any()
+
+
+def test_spectrum_cache():
+    template = correlation.PreparedTemplate(random_image(8, 8))
+    shapes = [(size, size) for size in range(16, 16 + 2 * correlation.MAX_CACHED_SPECTRA + 4, 2)]
+    for shape in shapes:
+        template.spectrum(shape)
+    template.spectrum(shapes[-2])
+    # Only the most recently used spectra are kept
+    assert list(template._spectra) == shapes[-correlation.MAX_CACHED_SPECTRA:-2] + shapes[-1:] \
+        + shapes[-2:-1]
+
+
+def test_transformed_cache():
+    template = fourier_mellin.LogPolarTemplate(pyramid.ScaledTemplates(random_image(20, 20)))
+    for angle in range(fourier_mellin.MAX_TRANSFORMED + 5):
+        template.transformed(angle, 1.0)
+    first = template.transformed(5.0, 1.0)
+    assert len(template._transformed) == fourier_mellin.MAX_TRANSFORMED
+    assert template.transformed(5.0, 1.0) is first
+    assert (0.0, 1.0) not in template._transformed
+
+
+def test_template_larger_than_image():
+    assert correlation.match_template(random_image(10, 10), random_image(11, 5)).size == 0
+
+
+def test_find():
+    image = imagex.Image(str(RES_PATH / "basic_shapes" / "image_exact_medium_1.png"))
+    template = imagex.Image(str(RES_PATH / "basic_shapes" / "template_normal_circle.png"))
+    for method in correlation.METHODS:
+        assert imagex.find(image, template, method=method).to_tuple() == (19, 151, 28, 28)
+
+
+def test_match_exact():
+    rng = np.random.default_rng(3)
+    image = rng.integers(0, 2, (40, 50, 3), dtype=np.uint8)
+    template = image[7:10, 12:15].copy()
+    expected = [(y, x) for y in range(38) for x in range(48)
+                if np.array_equal(image[y:y+3, x:x+3], template)]
+    ys, xs = exact.match_exact(image, template)
+    assert list(zip(ys.tolist(), xs.tolist())) == expected
+    assert (7, 12) in expected
+    assert len(exact.match_exact(image, template[:, :, :2])[0]) == 0
+
+
+def test_search_scales():
+    template = random_image(20, 24, seed=1)
+    image = random_image(300, 320, seed=2)
+    scaled = transforms.resize(template, 60, 50)
+    image[100:150, 200:260] = scaled
+    result = pyramid.search_scales(image, template)
+    assert result.score > 0.95
+    assert abs(result.scale - 2.5) < 0.15
+    assert abs(result.x - 200) <= 2 and abs(result.y - 100) <= 2
+
+
+def test_search_scales_threshold():
+    template = random_image(20, 24, seed=1)
+    image = random_image(300, 320, seed=2)
+    # Noise never gets close to a textured template, so nothing is refined
+    assert pyramid.search_scales(image, template, threshold=0.8) is None
+    assert pyramid.search_scales(image, template) is not None
+
+
+def test_search_scales_batch():
+    image = cv2.GaussianBlur(random_image(200, 240, seed=3), (0, 0), 2)
+    templates = [pyramid.ScaledTemplates(image[y:y+20, x:x+24].copy())
+                 for y, x in [(10, 10), (100, 150), (150, 30)]]
+    image = cv2.resize(image, (360, 300))
+    found = pyramid.search_scales_batch(image, templates, (0.5, 2))
+    for template, candidate in zip(templates, found):
+        expected = pyramid.search_scales(image, template, (0.5, 2))
+        assert candidate[1:5] == expected[1:5]
+        assert candidate.score == pytest.approx(expected.score, abs=1e-3)
+    with pytest.raises(ValueError):
+        pyramid.search_scales_batch(image, [templates[0], pyramid.ScaledTemplates(image[:5, :5])])
+
+
+def test_pick_best():
+    Candidate = correlation.Candidate
+    best = Candidate(0.9, 50, 50, 10, 10)
+    # A tied larger candidate wins only where it covers the best one
+    elsewhere = Candidate(0.89, 0, 0, 40, 40)
+    around = Candidate(0.89, 45, 45, 20, 20)
+    assert correlation.pick_best([best, elsewhere]) == best
+    assert correlation.pick_best([best, elsewhere, around]) == around
+    assert correlation.pick_best([best, Candidate(0.8, 45, 45, 20, 20)]) == best
+    assert correlation.pick_best([None]) is None
+
+
+def test_non_max_suppression():
+    boxes = np.array([[0, 0, 10, 10], [1, 0, 10, 10], [5, 5, 10, 10], [30, 30, 4, 4]])
+    scores = np.array([0.9, 0.95, 0.8, 0.5])
+    assert peaks.non_max_suppression(boxes, scores).tolist() == [1, 2, 3]
+    assert peaks.non_max_suppression(boxes, scores, max_results=2).tolist() == [1, 2]
+    assert peaks.non_max_suppression(boxes, scores, max_overlap=0.1).tolist() == [1, 3]
+
+
+def test_local_maxima_plateau():
+    scores = np.zeros((60, 60), np.float32)
+    scores[50:55, 10:20] = 0.95
+    scores[50, 30] = 0.9
+    ys, xs, values = peaks.local_maxima(scores, 0.5)
+    assert ys.tolist() == [50, 50] and xs.tolist() == [10, 30]
+    assert values.tolist() == pytest.approx([0.95, 0.9])
@@ -3,8 +3,13 @@ ImageX - Regex for images
 https://github.com/Giantpizzahead/imagex
 Copyright (C) 2022 Giantpizzahead
 """
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
+import os
+import time
 
+import numpy as np
 import pytest
 
 from conftest import *
@@ -19,6 +24,11 @@ MAX_POS_ERROR_FLAT = 15
 # Special None constant
 NONE = [0, 0, 0, 0]
 
+# Number of tests of a group that are run at once
+WORKERS = int(os.environ.get("IMAGEX_TEST_WORKERS", os.cpu_count() or 1))
+# Number of slowest tests recorded for each group
+SLOWEST_SHOWN = 5
+
 
 # Get list of all test groups
 test_groups = [path.name for idx, path in enumerate(TEST_DATA_PATH.iterdir()) if path.is_dir()]
@@ -30,6 +40,14 @@ test_groups = [pytest.param(name, marks=[pytest.mark.xfail] if idx >= 1 else [])
 # test_groups = test_groups[:1]
 
 
+@functools.lru_cache(maxsize=None)
+def load_pixels(path: str) -> np.ndarray:
+    """Decodes a resource image once per session. The pixels are shared, so they're read-only."""
+    pixels = imagex.Image(path).image
+    pixels.flags.writeable = False
+    return pixels
+
+
 def run_test(test_path: Path, test_name: str):
     """Run a test, returning a debug string if it fails"""
     # print(f"Running test {test_name}...")
@@ -39,8 +57,9 @@ def run_test(test_path: Path, test_name: str):
     # Run test
     image_path = str(RES_PATH / test_data["image"])
     template_path = str(RES_PATH / test_data["template"])
-    image = imagex.Image(image_path)
-    template = imagex.Image(template_path)
+    # Fresh images around the shared pixels, so that tests don't share derived data
+    image = imagex.Image.from_array(load_pixels(image_path))
+    template = imagex.Image.from_array(load_pixels(template_path))
     result = imagex.find(image, template)
     answers = test_data["bounding_boxes"]
 
@@ -101,17 +120,31 @@ def run_test(test_path: Path, test_name: str):
         return output
 
 
+def timed_test(test_path: Path) -> tuple:
+    """
+    Runs a test, returning its debug string (if it failed) and the CPU time it took.
+
+    CPU time of the running thread isn't inflated by the tests running alongside it, unlike wall
+    time. Work that OpenCV hands off to its own threads isn't counted.
+    """
+    start = time.thread_time()
+    result = run_test(test_path, test_path.name)
+    return result, time.thread_time() - start
+
+
 @pytest.mark.parametrize("test_group", test_groups)
-def test(test_group: Path):
+def test(test_group: Path, record_property):
     # print("Testing", test_group)
-    # For each test in the test group
-    failed = []
-    tests = list((TEST_DATA_PATH / test_group).rglob("*.json"))
-    for test_path in tests:
-        # Run test
-        result = run_test(test_path, test_path.name)
-        if result:
-            failed.append(result)
+    # Run every test in the test group, a few at a time
+    tests = sorted((TEST_DATA_PATH / test_group).rglob("*.json"))
+    with ThreadPoolExecutor(WORKERS) as executor:
+        results = list(executor.map(timed_test, tests))
+    failed = [result for result, _ in results if result]
+    timings = {str(test_path.relative_to(TEST_DATA_PATH / test_group)): seconds
+               for test_path, (_, seconds) in zip(tests, results)}
+    record_property("cpu_seconds", timings)
+    record_property("total_cpu_seconds", sum(timings.values()))
+    record_property("slowest", sorted(timings, key=timings.get, reverse=True)[:SLOWEST_SHOWN])
     if failed:
         output_msg = [  # "\n" + "-" * 20 + "   TESTS FAILED   " + "-" * 20,
                       f"Missed {len(failed)}/{len(tests)} tests in {test_group}, first failure:",